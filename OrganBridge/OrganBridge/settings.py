@@ -50,6 +50,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main.middleware.ProfilingMiddleware',  # inactive unless PROFILING_* is set
     'corsheaders.middleware.CorsMiddleware',  # Add this
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -95,9 +96,38 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20},
     }
 }
 
+# Read replicas for list and match views (see main/db.py). Locally these are
+# SQLite copies of db.sqlite3 refreshed by `manage.py sync_replicas`, e.g.
+# DATABASE_REPLICAS=replica1,replica2
+DATABASE_REPLICAS = [a for a in os.environ.get('DATABASE_REPLICAS', '').split(',') if a]
+for _alias in DATABASE_REPLICAS:
+    DATABASES[_alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db_{_alias}.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['main.db.ReadReplicaRouter']
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
@@ -155,4 +185,120 @@ REST_FRAMEWORK = {
 
 # CORS settings for frontend
 CORS_ALLOW_ALL_ORIGINS = True
-CORS_ALLOW_CREDENTIALS = True
\ No newline at end of file
+CORS_ALLOW_CREDENTIALS = True
+
+# Matching request coalescing (see ml_dispatcher.py)
+MATCH_BATCHING_ENABLED = True
+MATCH_BATCH_WINDOW_MS = 2  # clamped to 1-5 ms
+MATCH_BATCH_MAX_SIZE = 32
+MATCH_BATCH_TIMEOUT = 5.0  # seconds a caller waits for its batch
+
+# Cached donor/recipient profile vectors (see ml_vectors.py)
+PROFILE_VECTOR_CACHE_SIZE = 100000
+PROFILE_VECTOR_CACHE_PERSIST = True
+COMPATIBILITY_MAX_PAIRS = 100000
+
+# Materialized per-recipient top-k matches (see main/matching.py)
+RECIPIENT_MATCH_TOP_K = 10
+RECIPIENT_MATCH_MIN_SCORE = 0.0
+MATCH_INDEX_REFRESH_SECONDS = 3600
+MATCH_INDEX_EXPIRY_LAG_SECONDS = 60  # re-check window for organs expired by another process
+MATCH_UPDATES_ASYNC = True  # re-score on a background thread after commit, not in the request
+
+# Organ viability windows in hours, by organ type (see main/expiry.py)
+ORGAN_VIABILITY_HOURS = {
+    'heart': 6,
+    'lung': 8,
+    'liver': 12,
+    'pancreas': 18,
+    'intestine': 12,
+    'kidney': 36,
+}
+ORGAN_VIABILITY_DEFAULT_HOURS = 24
+# Run the expiry scheduler inside the web process (single-process deployments);
+# otherwise run `manage.py run_expiry_scheduler`
+ORGAN_EXPIRY_THREAD = False
+ORGAN_EXPIRY_MAX_SLEEP = 60.0
+
+# Donor search index: 'exact' (NearestNeighbors) or 'ivf' (approximate, see ml_ann.py)
+MATCH_INDEX_BACKEND = 'exact'
+MATCH_ANN_NLISTS = None  # None = about sqrt(number of donors)
+MATCH_ANN_NPROBE = 8     # more cells per query = higher recall, lower QPS
+
+# Per-organ model registry (see ml_registry.py); models live in ml_models/<organ>/
+MATCH_DEFAULT_ORGAN = 'kidney'
+MATCH_MODEL_MEMORY_BUDGET_MB = 512
+MATCH_MODEL_RETRY_SECONDS = 300  # wait before retrying an organ model that failed to load
+
+# Region-sharded donor index, used when MATCH_INDEX_BACKEND = 'sharded' (see ml_sharding.py)
+MATCH_SHARD_PROCESSES = None   # None = one per CPU, at most one per region
+MATCH_SHARD_FANOUT = 'region'  # 'region': recipient's state (+ neighbors), 'all': every shard
+MATCH_SHARD_NEIGHBORS = {}     # e.g. {'wa': ['or', 'id']}
+MATCH_CITY_REGIONS = None      # city -> state for datasets without a State column
+
+# Match job queue (see main/jobs.py); run workers with `manage.py run_match_workers`
+MATCH_JOB_RESULT_TTL = 24 * 3600  # seconds finished results are kept
+MATCH_JOB_CHUNK_SIZE = 100  # rows processed, and stored, per chunk
+MATCH_JOB_LEASE_SECONDS = 300  # a running job without a heartbeat for this long is reclaimed
+MATCH_JOB_MAX_ATTEMPTS = 3
+MATCH_JOB_WORKERS_IN_PROCESS = 0  # >0 starts that many worker threads in the web process
+
+# Opt-in request profiling (see main/middleware.py); staff list dumps at profiles/
+PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', 0))
+PROFILING_HEADER_TOKEN = os.environ.get('PROFILING_HEADER_TOKEN', '')  # send as X-Profile
+PROFILING_DIR = os.path.join(BASE_DIR, 'profiles')
+PROFILING_MAX_DUMPS = 200
+PROFILING_PATHS = ()  # optional path prefixes, e.g. ('/find-matches/',)
+
+# Post image derivatives and media serving (see main/media.py)
+MEDIA_DERIVATIVE_WIDTHS = (320, 960)
+MEDIA_DERIVATIVE_FORMATS = ('webp', 'jpeg')
+MEDIA_DERIVATIVE_QUALITY = 80
+MEDIA_DERIVATIVE_WORKERS = 2
+MEDIA_CACHE_MAX_AGE = 86400
+# 'X-Accel-Redirect' (nginx, served from MEDIA_SENDFILE_PREFIX) or 'X-Sendfile'; None streams from
+# Django, which routes MEDIA_URL only when this or DEBUG is set
+MEDIA_SENDFILE_HEADER = os.environ.get('MEDIA_SENDFILE_HEADER') or None
+MEDIA_SENDFILE_PREFIX = '/protected-media/'
+
+# Admin changelists on large tables (see main/admin.py)
+ADMIN_COUNT_LIMIT = 100000  # filtered changelists count at most this many rows
+ADMIN_ACTION_BATCH_SIZE = 500
+
+# Match query log for offline replay (see ml_querylog.py); None disables capture
+MATCH_QUERY_LOG = os.environ.get('MATCH_QUERY_LOG') or None
+MATCH_QUERY_LOG_SAMPLE_RATE = 1.0
+MATCH_QUERY_LOG_MAX_MB = 100
+
+# Admission control in front of matching work (see ml_admission.py)
+MATCH_ADMISSION_ENABLED = True
+MATCH_ADMISSION_CAPACITY = 16  # matching calls in flight per process
+MATCH_ADMISSION_CLASSES = {
+    # priority 0 is served first; queue and max_wait bound how long work may wait
+    'urgent': {'priority': 0, 'concurrency': 16, 'queue': 64, 'max_wait': 10.0},
+    'interactive': {'priority': 1, 'concurrency': 12, 'queue': 32, 'max_wait': 2.0},
+    'batch': {'priority': 2, 'concurrency': 4, 'queue': 16, 'max_wait': 30.0},
+    'background': {'priority': 3, 'concurrency': 2, 'queue': 4, 'max_wait': 0.5},
+}
+MATCH_ADMISSION_ROLE_CLASSES = {}  # e.g. {'staff': 'interactive'} to lift coordinator dashboards
+
+# Prometheus scrape token for metrics/ (Authorization: Bearer <token>); unset means staff login only
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Quantized donor vectors, used when MATCH_INDEX_BACKEND = 'quantized' (see ml_quantized.py)
+MATCH_QUANT_DTYPE = 'int8'       # or 'float16'
+MATCH_QUANT_RERANK = False       # re-score at full precision; keeps tf_matrix resident too
+MATCH_QUANT_RERANK_FACTOR = 4    # candidates per requested match
+MATCH_QUANT_BLOCK_ROWS = 65536
+MATCH_QUANT_MMAP = True          # memory-map ml_models/quantized.npy when present
+
+# Precompiled TF-IDF encoder for match queries and profile vectors (see ml_encoder.py)
+MATCH_FAST_ENCODER = True
+MATCH_ENCODER_CACHE_SIZE = 65536  # distinct field values kept analyzed
+
+# Upper bound on n_matches per find-matches request or job
+MATCH_MAX_RESULTS = 100
+
+# Incremental registry exports (see main/export.py) re-read this many seconds before
+# the watermark, to catch rows whose transaction committed after a newer one
+EXPORT_WATERMARK_OVERLAP_SECONDS = 300
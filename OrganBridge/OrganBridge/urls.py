@@ -14,10 +14,10 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.conf import settings
-from django.conf.urls.static import static
+from main.media import serve_media
 
 
 urlpatterns = [
@@ -25,6 +25,11 @@ urlpatterns = [
     path('post/', include('post.urls')),
     path('auth/', include('userauth.urls')),
     path('organ/', include('donation.urls')),
-]+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+# In production the web server serves media directly, unless Django is
+# asked to check access and hand files off through a sendfile header
+if settings.DEBUG or getattr(settings, 'MEDIA_SENDFILE_HEADER', None):
+    urlpatterns.append(re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve_media))
 
 urlpatterns += staticfiles_urlpatterns()
\ No newline at end of file
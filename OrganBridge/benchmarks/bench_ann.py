@@ -0,0 +1,83 @@
+# backend/benchmarks/bench_ann.py
+"""
+Recall@10 and QPS of the IVF approximate index against exact search
+
+Exact search is a blocked brute-force NumPy scan over the same unit vectors.
+Synthetic profiles contain many exact duplicates, so recall counts a returned
+donor as a hit when its score reaches the 10th exact score (tie-aware).
+
+Usage: python benchmarks/bench_ann.py --sizes 100000 1000000 --nprobe 1 4 8 16
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import make_profiles, make_tfidf
+from ml_ann import IVFIndex, to_unit_rows
+
+
+def exact_search(vectors, query, k):
+    scores = vectors @ query
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def measure_qps(search, queries):
+    started = time.perf_counter()
+    for query in queries:
+        search(query)
+    return len(queries) / (time.perf_counter() - started)
+
+
+def bench_size(n_donors, nprobes, n_queries, k):
+    tf_model, tf_matrix, _ = make_tfidf(n_donors)
+    vectors = to_unit_rows(tf_matrix)
+    query_strings = [', '.join([p['city'], p['blood_group'], p['organ'], p['age']])
+                     for p in make_profiles(n_queries)]
+    queries = to_unit_rows(tf_model.transform(query_strings))
+
+    # Score of the k-th exact neighbor of each query
+    kth = np.array([(vectors @ q)[exact_search(vectors, q, k)[-1]] for q in queries])
+
+    started = time.perf_counter()
+    index = IVFIndex().fit(vectors)
+    build_seconds = time.perf_counter() - started
+
+    report = {
+        'donors': n_donors,
+        'dimensions': vectors.shape[1],
+        'n_lists': index.n_lists,
+        'build_seconds': round(build_seconds, 2),
+        'exact_qps': round(measure_qps(lambda q: exact_search(vectors, q, k), queries), 1),
+        'ivf': [],
+    }
+    for n_probe in nprobes:
+        _, found = index.search(queries, k, n_probe=n_probe)
+        hits = [
+            min(k, int(np.sum(vectors[found[row][found[row] >= 0]] @ queries[row] >= kth[row] - 1e-6)))
+            for row in range(len(queries))
+        ]
+        report['ivf'].append({
+            'n_probe': n_probe,
+            f'recall@{k}': round(sum(hits) / (k * len(queries)), 4),
+            'qps': round(measure_qps(lambda q: index.search(q[None, :], k, n_probe=n_probe), queries), 1),
+        })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    results = [bench_size(n, args.nprobe, args.queries, args.k) for n in args.sizes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# backend/benchmarks/bench_db_concurrency.py
+"""
+Concurrent read/write throughput of SQLite with default settings versus
+the pragmas applied by main.db.configure_sqlite (WAL, synchronous=NORMAL, mmap)
+
+Readers run list-style queries like AvailableDonorsView while writers insert
+and update rows like signups and organ updates.
+
+Usage: python benchmarks/bench_db_concurrency.py --readers 8 --writers 2
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from common import CITIES
+from main.db import DEFAULT_SQLITE_PRAGMAS
+from ml_metrics import summarize_latencies
+
+SCHEMA = '''
+CREATE TABLE organ (id INTEGER PRIMARY KEY, city TEXT, blood_group TEXT,
+                    organ TEXT, avg_sleep INTEGER, expired INTEGER DEFAULT 0);
+CREATE INDEX organ_city ON organ (city);
+'''
+
+
+def connect(path, pragmas):
+    conn = sqlite3.connect(path, timeout=20, isolation_level=None, check_same_thread=False)
+    for name, value in pragmas.items():
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+def run(path, pragmas, readers, writers, duration):
+    reads, writes, errors = [], [], []
+    stop_at = time.perf_counter() + duration
+
+    def reader(slot):
+        conn = connect(path, pragmas)
+        i = slot
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            conn.execute('SELECT id, city, blood_group, organ FROM organ WHERE expired = 0 '
+                         'AND city = ? LIMIT 200', (CITIES[i % len(CITIES)],)).fetchall()
+            reads.append(time.perf_counter() - started)
+            i += 1
+
+    def writer(slot):
+        conn = connect(path, pragmas)
+        i = slot
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('INSERT INTO organ (city, blood_group, organ, avg_sleep) VALUES (?, ?, ?, ?)',
+                             (CITIES[i % len(CITIES)], 'AB+', 'kidney', i % 12))
+                conn.execute('UPDATE organ SET avg_sleep = avg_sleep + 1 WHERE id = ?', (1 + i % 1000,))
+                conn.execute('COMMIT')
+                writes.append(time.perf_counter() - started)
+            except sqlite3.OperationalError as e:
+                conn.execute('ROLLBACK')
+                errors.append(str(e))
+            i += writers
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    threads += [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        'reads': dict(summarize_latencies(reads), per_second=round(len(reads) / duration, 1)),
+        'writes': dict(summarize_latencies(writes), per_second=round(len(writes) / duration, 1)),
+        'errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    args = parser.parse_args()
+
+    configs = {
+        'default': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+        'tuned': DEFAULT_SQLITE_PRAGMAS,
+    }
+    report = {}
+    for name, pragmas in configs.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.sqlite3')
+            conn = connect(path, pragmas)
+            conn.executescript(SCHEMA)
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO organ (city, blood_group, organ, avg_sleep) VALUES (?, ?, ?, ?)',
+                             ((CITIES[i % len(CITIES)], 'O+', 'kidney', i % 12) for i in range(args.rows)))
+            conn.execute('COMMIT')
+            conn.close()
+            report[name] = run(path, pragmas, args.readers, args.writers, args.duration)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# backend/benchmarks/bench_dispatcher.py
+"""
+Throughput and latency of find_matches under concurrent load,
+called directly versus through the coalescing MatchDispatcher
+
+Usage: python benchmarks/bench_dispatcher.py --donors 20000 --threads 32
+"""
+import argparse
+import json
+import threading
+import time
+
+from common import build_service, make_profiles, setup_django
+from ml_metrics import summarize_latencies
+
+
+def run_load(call, profiles, threads, duration):
+    """Closed-loop load: each thread issues queries back to back for `duration` seconds"""
+    latencies = [[] for _ in range(threads)]
+    stop_at = time.perf_counter() + duration
+
+    def worker(slot):
+        i = slot
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            call(profiles[i % len(profiles)], 10)
+            latencies[slot].append(time.perf_counter() - started)
+            i += threads
+
+    pool = [threading.Thread(target=worker, args=(slot,)) for slot in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    samples = [s for per_thread in latencies for s in per_thread]
+    summary = summarize_latencies(samples)
+    summary['throughput_qps'] = round(len(samples) / elapsed, 1)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--donors', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--distinct', type=int, default=200,
+                        help='number of unique profiles in the query stream')
+    parser.add_argument('--window-ms', type=float, default=2)
+    parser.add_argument('--max-batch', type=int, default=32)
+    args = parser.parse_args()
+
+    # ml_dispatcher builds its module-level dispatcher from settings on import
+    setup_django()
+    from ml_dispatcher import MatchDispatcher
+
+    service = build_service(args.donors)
+    profiles = make_profiles(5000, distinct=args.distinct)
+    dispatcher = MatchDispatcher(service, window_ms=args.window_ms, max_batch=args.max_batch)
+
+    report = {
+        'donors': args.donors,
+        'threads': args.threads,
+        'distinct_profiles': args.distinct,
+        'direct': run_load(service.find_matches, profiles, args.threads, args.duration),
+        'dispatcher': run_load(dispatcher.find_matches, profiles, args.threads, args.duration),
+    }
+    stats = dispatcher.stats()
+    report['dispatcher']['coalesced'] = stats['coalesced']
+    report['dispatcher']['mean_batch_size'] = round(
+        stats['batched_queries'] / max(stats['batches'], 1), 2
+    )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
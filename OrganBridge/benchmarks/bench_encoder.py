@@ -0,0 +1,103 @@
+# backend/benchmarks/bench_encoder.py
+"""
+Per-query encoding time of TfidfVectorizer.transform versus ProfileEncoder
+
+Queries are built the way OrganMatchingService builds them: match queries
+from city, blood group and organ, and compatibility profiles from city,
+age, blood group and organ. Every encoded row is also checked for exact
+equality with transform's output.
+
+Usage: python benchmarks/bench_encoder.py --donors 20000 --queries 5000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import make_profiles, make_tfidf
+from ml_encoder import SEPARATOR, ProfileEncoder
+
+SHAPES = {
+    'match_query': ('city', 'blood_group', 'organ'),
+    'compatibility_profile': ('city', 'age', 'blood_group', 'organ'),
+}
+
+
+def per_query_us(encode, field_lists, batch, repeats):
+    """Best-of-repeats microseconds per query, encoding `batch` queries per call"""
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for start in range(0, len(field_lists), batch):
+            encode(field_lists[start:start + batch])
+        best = min(best, time.perf_counter() - started)
+    return round(1e6 * best / len(field_lists), 2)
+
+
+def identical(tf_model, encoder, field_lists):
+    """Rows whose indices and weights equal transform's bit for bit"""
+    expected = tf_model.transform([SEPARATOR.join(f) for f in field_lists]).tocsr()
+    expected.sort_indices()
+    actual = encoder.transform(field_lists)
+    same = 0
+    for row in range(len(field_lists)):
+        a = slice(expected.indptr[row], expected.indptr[row + 1])
+        b = slice(actual.indptr[row], actual.indptr[row + 1])
+        same += (np.array_equal(expected.indices[a], actual.indices[b])
+                 and np.array_equal(expected.data[a], actual.data[b]))
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--donors', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--distinct', type=int, default=None,
+                        help='Draw queries from this many unique profiles')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    tf_model, _, _ = make_tfidf(args.donors)
+    if not ProfileEncoder.supports(tf_model):
+        raise SystemExit('ProfileEncoder does not support this TF-IDF configuration')
+    profiles = make_profiles(args.queries, distinct=args.distinct)
+
+    results = {'donors': args.donors, 'queries': args.queries, 'vocabulary': len(tf_model.vocabulary_)}
+    for shape, fields in SHAPES.items():
+        field_lists = [[p[f] for f in fields] for p in profiles]
+        transform = lambda chunk: tf_model.transform([SEPARATOR.join(f) for f in chunk])
+
+        cold = ProfileEncoder(tf_model)
+        started = time.perf_counter()
+        cold.transform(field_lists)
+        cold_us = round(1e6 * (time.perf_counter() - started) / len(field_lists), 2)
+
+        encoder = ProfileEncoder(tf_model)
+        encoder.transform(field_lists)
+        report = {
+            'identical_rows': identical(tf_model, encoder, field_lists),
+            'encoder_cold_cache_us': cold_us,
+            'cached_field_values': len(encoder),
+            'cache_bytes': encoder.nbytes(),
+            'batches': {},
+        }
+        for batch in args.batches:
+            before = per_query_us(transform, field_lists, batch, args.repeats)
+            after = per_query_us(encoder.transform, field_lists, batch, args.repeats)
+            report['batches'][batch] = {
+                'transform_us': before,
+                'encoder_us': after,
+                'speedup': round(before / after, 1) if after else None,
+            }
+        # Without building a CSR matrix, as used for single compatibility vectors
+        report['encode_fields_us'] = per_query_us(
+            lambda chunk: [encoder.encode_fields(f) for f in chunk], field_lists, 1, args.repeats
+        )
+        results[shape] = report
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
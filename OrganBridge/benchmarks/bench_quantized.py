@@ -0,0 +1,114 @@
+# backend/benchmarks/bench_quantized.py
+"""
+Memory, throughput and ranking agreement of the quantized vector store
+
+For each size the float64 TF-IDF CSR rows are the reference. The int8 and
+float16 stores are compared with and without full-precision re-ranking on:
+- resident bytes against the float64 CSR matrix (re-ranking keeps that
+  matrix in memory too, so it is added to the store's own bytes)
+- batched QPS against a blocked float64 scan with the same dense-query kernel
+  and top-k selection, so the difference comes from the stored values
+- tie-aware recall@k and exact top-k order agreement with the float64 ranking
+
+Usage: python benchmarks/bench_quantized.py --sizes 100000 1000000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import make_profiles, make_tfidf
+from ml_memory import sparse_nbytes
+from ml_quantized import QuantizedStore, select_top_k
+
+
+def float64_scan(matrix, queries, k, block_rows=65536):
+    """Reference top-k with float64 sparse-by-dense products, blocked and selected like the store"""
+    best_scores = np.full((queries.shape[0], k), -np.inf)
+    best_rows = np.full((queries.shape[0], k), -1, dtype=np.int64)
+    dense_queries = np.ascontiguousarray(queries.toarray().T)
+    for start in range(0, matrix.shape[0], block_rows):
+        select_top_k(best_scores, best_rows, np.asarray(matrix[start:start + block_rows] @ dense_queries), start)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+
+def measure_qps(search, queries, batch):
+    started = time.perf_counter()
+    for start in range(0, queries.shape[0], batch):
+        search(queries[start:start + batch])
+    return queries.shape[0] / (time.perf_counter() - started)
+
+
+def agreement(matrix, queries, found, ref_scores, ref_rows, k):
+    """Tie-aware recall@k (a hit reaches the k-th float64 score) and identical top-k order"""
+    hits, same_order = 0, 0
+    for i in range(queries.shape[0]):
+        rows = found[i][found[i] >= 0]
+        query = queries[i].toarray().ravel()
+        scores = np.asarray(matrix[rows] @ query).ravel()
+        hits += min(k, int(np.sum(scores >= ref_scores[i, k - 1] - 1e-9)))
+        same_order += np.array_equal(rows, ref_rows[i])
+    return round(hits / (k * queries.shape[0]), 4), round(same_order / queries.shape[0], 4)
+
+
+def bench_size(n_donors, n_queries, k, batch):
+    tf_model, tf_matrix, _ = make_tfidf(n_donors)
+    tf_matrix = tf_matrix.tocsr().astype(np.float64)
+    query_strings = [', '.join([p['city'], p['blood_group'], p['organ'], p['age']])
+                     for p in make_profiles(n_queries)]
+    queries = tf_model.transform(query_strings).astype(np.float64)
+
+    ref_scores, ref_rows = float64_scan(tf_matrix, queries, k)
+    csr_bytes = sparse_nbytes(tf_matrix)
+    report = {
+        'donors': n_donors,
+        'dimensions': tf_matrix.shape[1],
+        'float64_csr_bytes': csr_bytes,
+        'float64_bytes_per_donor': round(csr_bytes / n_donors, 1),
+        'float64_qps': round(measure_qps(lambda q: float64_scan(tf_matrix, q, k), queries, batch), 1),
+        'stores': [],
+    }
+    for dtype in ('int8', 'float16'):
+        started = time.perf_counter()
+        store = QuantizedStore(dtype=dtype).fit(tf_matrix)
+        build_seconds = time.perf_counter() - started
+        for rerank in (False, True):
+            if rerank:
+                # Only the re-ranking configuration holds on to the float64 rows
+                store.attach_exact(tf_matrix)
+            resident = store.nbytes + (csr_bytes if rerank else 0)
+            _, found = store.search(queries, k, rerank=rerank)
+            recall, identical = agreement(tf_matrix, queries, found, ref_scores, ref_rows, k)
+            qps = measure_qps(lambda q: store.search(q, k, rerank=rerank), queries, batch)
+            report['stores'].append({
+                'dtype': dtype,
+                'rerank': rerank,
+                'bytes': store.nbytes,
+                'resident_bytes': resident,
+                'bytes_per_donor': round(resident / n_donors, 1),
+                'saved_vs_float64_csr': round(1 - resident / csr_bytes, 4),
+                'build_seconds': round(build_seconds, 2),
+                'qps': round(qps, 1),
+                'speedup_vs_float64': round(qps / report['float64_qps'], 2),
+                f'recall@{k}': recall,
+                'identical_top_k': identical,
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--queries', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=32, help='Queries per search call')
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    results = [bench_size(n, args.queries, args.k, args.batch) for n in args.sizes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# backend/benchmarks/bench_sharding.py
+"""
+Latency and throughput of the region-sharded index as the number of
+worker processes grows
+
+Synthetic donors are spread over --regions states. Each configuration is
+measured for single queries (latency) and for batches (throughput), both
+fanning out to every shard and routed to one region.
+
+Usage: python benchmarks/bench_sharding.py --donors 1000000 --processes 1 2 4 8
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from common import make_profiles, make_tfidf
+from ml_metrics import summarize_latencies
+from ml_sharding import ShardedIndex
+
+
+def run(index, queries, regions, batch):
+    latencies = []
+    for i in range(len(queries)):
+        started = time.perf_counter()
+        index.search(queries[i:i + 1], 10, [regions[i]] if regions else None)
+        latencies.append(time.perf_counter() - started)
+    report = summarize_latencies(latencies)
+
+    started = time.perf_counter()
+    for start in range(0, len(queries), batch):
+        index.search(queries[start:start + batch], 10,
+                     regions[start:start + batch] if regions else None)
+    report['batch_qps'] = round(len(queries) / (time.perf_counter() - started), 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--donors', type=int, default=1000000)
+    parser.add_argument('--regions', type=int, default=50)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=64)
+    args = parser.parse_args()
+
+    tf_model, tf_matrix, _ = make_tfidf(args.donors)
+    rng = np.random.default_rng(2)
+    states = [f's{i:02d}' for i in range(args.regions)]
+    donor_regions = rng.choice(states, size=args.donors)
+    profiles = make_profiles(args.queries)
+    queries = tf_model.transform([', '.join([p['city'], p['blood_group'], p['organ']])
+                                  for p in profiles]).toarray()
+    query_regions = rng.choice(states, size=args.queries).tolist()
+
+    results = []
+    for n_processes in args.processes:
+        index = ShardedIndex(tf_matrix, donor_regions, n_processes=n_processes)
+        index.start()
+        run(index, queries[:20], None, args.batch)  # warm up the workers
+        results.append({
+            'processes': index.n_processes,
+            'shards': len(index.shards),
+            'all_shards': run(index, queries, None, args.batch),
+            'one_region': run(index, queries, query_regions, args.batch),
+        })
+        index.close()
+    print(json.dumps({'donors': args.donors, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
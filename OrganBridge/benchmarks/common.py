@@ -0,0 +1,95 @@
+# backend/benchmarks/common.py
+"""
+Shared helpers for the benchmark scripts: Django bootstrapping and
+synthetic donor/recipient data shaped like KidneyData.csv
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+CITIES = ['Seattle', 'Detroit', 'Phoenix', 'Houston', 'Baltimore', 'Atlanta',
+          'New York', 'San Fransisco']
+RACES = ['Indigenious', 'Black', 'White', 'Asian']
+BLOOD_TYPES = ['O', 'A', 'B', 'AB']
+ORGANS = ['kidney', 'liver', 'heart', 'lung', 'pancreas']
+
+
+def setup_django():
+    """Configure the minimal settings ml_services needs outside of manage.py"""
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(BASE_DIR=BACKEND_DIR)
+
+
+def make_donors(n, seed=0):
+    """Synthetic donor rows with the same columns as KidneyData.csv"""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'Delta': rng.choice(['alive', 'dead'], size=n, p=[0.84, 0.16]),
+        'Gender': rng.choice(['Boy', 'Girl'], size=n),
+        'Race': rng.choice(RACES, size=n),
+        'Age': rng.integers(18, 75, size=n),
+        'Blood Type': rng.choice(BLOOD_TYPES, size=n),
+        'PosNeg': rng.choice(['Pos', 'Neg'], size=n),
+        'Smoke': rng.choice(['STrue', 'SFalse'], size=n),
+        'Drug': rng.choice(['DTrue', 'DFalse'], size=n),
+        'Alcohol': rng.choice(['ATrue', 'AFalse'], size=n),
+        'AvgSleep': rng.integers(5, 12, size=n),
+        'City': rng.choice(CITIES, size=n),
+    })
+
+
+def make_profiles(n, seed=1, distinct=None):
+    """
+    Synthetic recipient profiles as built by FindOrganMatchesView
+
+    Args:
+        n (int): Number of profiles
+        seed (int): Random seed
+        distinct (int): If given, draw the n profiles from this many unique ones
+    """
+    rng = np.random.default_rng(seed)
+    pool = distinct or n
+    unique = [{
+        'city': str(rng.choice(CITIES)),
+        'blood_group': str(rng.choice(BLOOD_TYPES)) + str(rng.choice(['+', '-'])),
+        'organ': str(rng.choice(ORGANS)),
+        'age': str(rng.integers(18, 75)),
+    } for _ in range(pool)]
+    return [unique[i] for i in rng.integers(0, pool, size=n)]
+
+
+def make_tfidf(n_donors, seed=0):
+    """
+    Fit the production TF-IDF configuration on synthetic donors
+
+    Returns:
+        tuple: (tf_model, tf_matrix, data)
+    """
+    from train_model import train_tfidf_model
+
+    data = make_donors(n_donors, seed)
+    for col in data.columns:
+        if col != 'Delta':
+            data[col] = data[col].astype(str)
+    data['category'] = data['City'].str.cat(
+        data[['Gender', 'Race', 'Age', 'Blood Type', 'PosNeg', 'Smoke', 'Drug',
+              'Alcohol', 'AvgSleep']], sep=','
+    )
+    tf_model, tf_matrix = train_tfidf_model(data)
+    return tf_model, tf_matrix, data
+
+
+def build_service(n_donors, seed=0, backend='exact'):
+    """Fit TF-IDF + the donor index on synthetic donors and wrap them in a service"""
+    setup_django()
+    from ml_services import OrganMatchingService
+
+    tf_model, tf_matrix, data = make_tfidf(n_donors, seed)
+    return OrganMatchingService.from_components(tf_model, tf_matrix, data, backend=backend)
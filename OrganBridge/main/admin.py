@@ -1,9 +1,170 @@
-from django.contrib import admin
-from . import models
+import sys
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.db.models import Q
+from django.utils.text import smart_split, unescape_string_literal
+from . import jobs, models
+from .db import EstimatedCountPaginator
+from .expiry import expire_organs
 
 # Register your models here.
-admin.site.register(models.Organ)
-admin.site.register(models.Post)
+
+
+def queue_rebuild(request, kind, key, queryset):
+    """Queue one match rebuild job per batch of the selection; returns (jobs, rows)"""
+    queued = count = 0
+    for ids in chunked_ids(queryset):
+        jobs.submit(request.user, kind, {key: ids})
+        queued += 1
+        count += len(ids)
+    return queued, count
+
+
+def chunked_ids(queryset):
+    """Primary keys of a (possibly very large) selection in batches"""
+    size = getattr(settings, 'ADMIN_ACTION_BATCH_SIZE', 500)
+    batch = []
+    for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=size):
+        batch.append(pk)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefix_range(field, term):
+    """Strings starting with term as a range on field, which a b-tree index can scan"""
+    if term[-1] == chr(sys.maxunicode):
+        return Q(**{f'{field}__gte': term})
+    return Q(**{f'{field}__gte': term, f'{field}__lt': term[:-1] + chr(ord(term[-1]) + 1)})
+
+
+def indexed_lookup(model, path, condition):
+    """
+    condition(column) on the field at the end of path, reached through an IN
+    subquery per relation rather than a join, so that every branch of an OR
+    is on an indexed column of model itself
+    """
+    relation, _, rest = path.partition('__')
+    if not rest:
+        return condition(relation)
+    related = model._meta.get_field(relation).related_model
+    subquery = related.objects.filter(indexed_lookup(related, rest, condition)).values('pk')
+    return Q(**{f'{relation}__in': subquery})
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist defaults for tables with millions of rows
+
+    Search terms are matched only with lookups an index can answer: the
+    primary key when the term is a number, a range for prefix fields and
+    equality for exact fields. Django's own search fields would compile to
+    LIKE, which scans the table on SQLite even for '=' and '^' fields.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    ordering = ('-id',)
+    search_prefix_fields = ()
+    search_exact_fields = ()
+
+    def get_search_fields(self, request):
+        # Only decides whether the changelist shows a search box
+        return ('pk',) + tuple(self.search_prefix_fields) + tuple(self.search_exact_fields)
+
+    def get_search_results(self, request, queryset, search_term):
+        for bit in smart_split(search_term):
+            if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+                bit = unescape_string_literal(bit)
+            if not bit:
+                continue
+            match = Q()
+            if bit.isdigit():
+                match |= Q(pk=int(bit))
+            for field in self.search_prefix_fields:
+                match |= indexed_lookup(self.model, field, lambda column: prefix_range(column, bit))
+            for field in self.search_exact_fields:
+                match |= indexed_lookup(self.model, field, lambda column: Q(**{column: bit}))
+            if not match:
+                return queryset.none(), False
+            queryset = queryset.filter(match)
+        # No joins are added, so rows are never repeated
+        return queryset, False
+
+
+class OrganAdmin(LargeTableAdmin):
+    list_display = ('id', 'organ', 'blood_group', 'donor', 'organ_date_time', 'expired')
+    list_select_related = ('donor__user',)
+    list_filter = ('organ', 'blood_group', 'expired')
+    search_prefix_fields = ('donor__user__username',)
+    search_exact_fields = ('donor__city',)
+    raw_id_fields = ('donor',)
+    actions = ('expire_selected', 'rebuild_matches')
+
+    @admin.action(description='Expire selected organs')
+    def expire_selected(self, request, queryset):
+        count = 0
+        for ids in chunked_ids(queryset.filter(expired=False)):
+            expire_organs(ids)
+            count += len(ids)
+        self.message_user(request, f'Expired {count} organs', messages.SUCCESS)
+
+    @admin.action(description='Rebuild recipient matches for selected organs')
+    def rebuild_matches(self, request, queryset):
+        queued, count = queue_rebuild(request, 'rebuild_organs', 'organ_ids', queryset.filter(expired=False))
+        self.message_user(request, f'Queued {queued} match jobs for {count} organs', messages.SUCCESS)
+
+
+class PostAdmin(LargeTableAdmin):
+    list_display = ('id', 'title', 'author', 'created_at', 'done')
+    list_select_related = ('author__user',)
+    list_filter = ('done',)
+    search_prefix_fields = ('title', 'author__user__username')
+    raw_id_fields = ('author',)
+    exclude = ('derivatives',)
+    actions = ('mark_done',)
+
+    @admin.action(description='Mark selected posts as done')
+    def mark_done(self, request, queryset):
+        count = 0
+        for ids in chunked_ids(queryset):
+            count += models.Post.objects.filter(id__in=ids).update(done=True)
+        self.message_user(request, f'Marked {count} posts as done', messages.SUCCESS)
+
+
+class DonorAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'city', 'state', 'phone_number')
+    list_select_related = ('user',)
+    list_filter = ('state', 'city')
+    search_prefix_fields = ('user__username',)
+    search_exact_fields = ('city', 'health_card_number')
+    raw_id_fields = ('user',)
+
+
+class RecipientAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'organ', 'blood_group', 'city', 'state')
+    list_select_related = ('user',)
+    list_filter = ('organ', 'blood_group', 'state', 'city')
+    search_prefix_fields = ('user__username',)
+    search_exact_fields = ('city', 'health_card_number')
+    raw_id_fields = ('user',)
+
+
+class WaitlistRecipientAdmin(RecipientAdmin):
+    """userauth.Recipient, the model RecipientMatch rows belong to"""
+    actions = ('rebuild_matches',)
+
+    @admin.action(description='Rebuild match lists for selected recipients')
+    def rebuild_matches(self, request, queryset):
+        queued, count = queue_rebuild(request, 'rebuild_recipients', 'recipient_ids', queryset)
+        self.message_user(request, f'Queued {queued} match jobs for {count} recipients', messages.SUCCESS)
+
+
+admin.site.register(models.Organ, OrganAdmin)
+admin.site.register(models.Post, PostAdmin)
 # admin.site.register(models.User)
-admin.site.register(models.Donor)
-admin.site.register(models.Recipient)
\ No newline at end of file
+admin.site.register(models.Donor, DonorAdmin)
+admin.site.register(models.Recipient, RecipientAdmin)
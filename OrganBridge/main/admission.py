@@ -0,0 +1,50 @@
+# backend/donation/admission.py
+"""
+Admission control for API views that call the matching service
+
+Views opt in with AdmissionControlMixin and name their default class. The
+class is chosen per request from the endpoint, then an `urgency` field
+(honoured for recipients and staff only), and unauthenticated callers always
+count as background. Shed requests get 429 with Retry-After.
+"""
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from ml_admission import AdmissionRejected, admission_controller
+
+URGENT_VALUES = {'urgent', 'critical', 'high'}
+
+
+def classify_request(request, default):
+    """Priority class for a request to an endpoint whose default class is `default`"""
+    user = request.user
+    if not user or not user.is_authenticated:
+        return 'background'
+    urgency = str(request.data.get('urgency') or request.query_params.get('urgency') or '').lower()
+    if urgency in URGENT_VALUES and (user.is_staff or hasattr(user, 'recipient')):
+        return 'urgent'
+    overrides = getattr(settings, 'MATCH_ADMISSION_ROLE_CLASSES', {})
+    if user.is_staff and 'staff' in overrides:
+        return overrides['staff']
+    return default
+
+
+class AdmissionControlMixin:
+    """APIView mixin: hold an admission slot from authentication to the response"""
+    admission_class = 'interactive'
+
+    def get_admission_class(self, request):
+        return classify_request(request, self.admission_class)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        try:
+            self._admission_ticket = admission_controller.acquire(self.get_admission_class(request))
+        except AdmissionRejected as e:
+            raise Throttled(wait=e.retry_after, detail=f'Server busy ({e.reason}), please retry later')
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        ticket = getattr(self, '_admission_ticket', None)
+        if ticket is not None:
+            self._admission_ticket = None
+            admission_controller.release(ticket)
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -4,3 +4,19 @@ from django.apps import AppConfig
 class MainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_migrate
+        from . import signals  # noqa: F401
+        from .db import configure_sqlite
+        from .search import create_search_index
+        connection_created.connect(configure_sqlite)
+        post_migrate.connect(create_search_index, sender=self)
+        if getattr(settings, 'ORGAN_EXPIRY_THREAD', False):
+            from .expiry import expiry_scheduler
+            expiry_scheduler.start_thread()
+        if getattr(settings, 'MATCH_JOB_WORKERS_IN_PROCESS', 0):
+            from .jobs import WorkerPool
+            WorkerPool(workers=settings.MATCH_JOB_WORKERS_IN_PROCESS).start()
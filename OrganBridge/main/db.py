@@ -0,0 +1,170 @@
+# backend/donation/db.py
+"""
+Database connection tuning and read-replica routing
+
+configure_sqlite runs on every new connection and applies the pragmas in
+SQLITE_PRAGMAS (WAL, synchronous=NORMAL, mmap). ReadReplicaRouter sends reads
+made inside use_replica() to the one replica of DATABASE_REPLICAS picked when
+the block was entered, so a request sees a single copy of the data; views opt
+in with ReplicaReadMixin. first_or_primary moves the rest of the block to the
+primary when a row is not on the replica yet (e.g. a user who just signed
+up). Locally the replicas are SQLite copies of the primary,
+refreshed with `manage.py sync_replicas`. EstimatedCountPaginator keeps admin
+changelists on large tables from running an exact COUNT(*).
+"""
+import itertools
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64000,  # KiB
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # ms
+}
+
+# Pragmas that change the database file and cannot be set from a replica reader
+WRITE_PRAGMAS = {'journal_mode', 'synchronous'}
+
+_state = threading.local()
+_replica_cycle = None
+_cycle_lock = threading.Lock()
+
+
+def replica_aliases():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created handler applying SQLITE_PRAGMAS to SQLite connections"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    is_replica = connection.alias in replica_aliases()
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if is_replica and name in WRITE_PRAGMAS:
+                continue
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def next_replica():
+    """Round-robin over DATABASE_REPLICAS; None when there are none"""
+    global _replica_cycle
+    aliases = replica_aliases()
+    if not aliases:
+        return None
+    with _cycle_lock:
+        if _replica_cycle is None:
+            _replica_cycle = itertools.cycle(aliases)
+        return next(_replica_cycle)
+
+
+def current_replica():
+    """Replica alias reads are routed to right now, or None for the primary"""
+    return getattr(_state, 'replica', None)
+
+
+@contextmanager
+def use_replica():
+    """Route ORM reads made inside the block to one read replica"""
+    previous = getattr(_state, 'replica', None)
+    entered = getattr(_state, 'depth', 0)
+    # Nested blocks keep the replica (or primary fallback) of the outermost one
+    if not entered:
+        _state.replica = next_replica()
+    _state.depth = entered + 1
+    try:
+        yield
+    finally:
+        _state.depth = entered
+        _state.replica = previous
+
+
+def first_or_primary(queryset):
+    """
+    First row of queryset, looked up again on the primary if the replica
+    does not have it yet
+
+    After a fallback, the rest of the use_replica() block also reads from the
+    primary, so rows written together with the missing one are seen too.
+    """
+    row = queryset.first()
+    if row is None and current_replica() is not None:
+        _state.replica = None
+        row = queryset.first()
+    return row
+
+
+class ReplicaReadMixin:
+    """APIView mixin: run the whole request against a read replica"""
+
+    def dispatch(self, request, *args, **kwargs):
+        with use_replica():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ReadReplicaRouter:
+    # Authentication must see fresh logins and sessions, so it stays on the primary
+    primary_apps = {'auth', 'sessions', 'contenttypes', 'admin'}
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label in self.primary_apps:
+            return None
+        return current_replica()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copied from the primary, never migrated on their own
+        return db not in replica_aliases()
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that estimates large counts instead of scanning the table
+
+    Unfiltered querysets use the planner statistics (reltuples) on PostgreSQL
+    and MAX(id) on SQLite, which over-counts only by deleted rows. Filtered
+    querysets are counted exactly up to ADMIN_COUNT_LIMIT rows.
+    """
+    exact_below = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if queryset.query.where:
+            limit = getattr(settings, 'ADMIN_COUNT_LIMIT', 100000)
+            return queryset.order_by()[:limit].count()
+        estimate = self.estimate(queryset)
+        if estimate is None or estimate < self.exact_below:
+            return queryset.count()
+        return estimate
+
+    @staticmethod
+    def estimate(queryset):
+        model = queryset.model
+        connection = connections[queryset.db]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [model._meta.db_table])
+            elif connection.vendor == 'sqlite':
+                table = connection.ops.quote_name(model._meta.db_table)
+                column = connection.ops.quote_name(model._meta.pk.column)
+                cursor.execute(f'SELECT MAX({column}) FROM {table}')
+            else:
+                return None
+            row = cursor.fetchone()
+        # reltuples is -1 before the first ANALYZE
+        return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
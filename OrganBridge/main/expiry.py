@@ -0,0 +1,157 @@
+# backend/donation/expiry.py
+"""
+Organ viability expiry
+
+Every live organ has a deadline of organ_date_time plus the viability window
+of its organ type. Deadlines sit in a min-heap; due organs are popped in
+O(log n) each, dropped from the in-memory match index, and marked expired
+in the database in batches.
+"""
+import heapq
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from . import matching, stats
+
+
+def viability_window(organ_type):
+    """How long an organ of this type stays viable after organ_date_time"""
+    hours = getattr(settings, 'ORGAN_VIABILITY_HOURS', {}).get(
+        (organ_type or '').strip().lower(),
+        getattr(settings, 'ORGAN_VIABILITY_DEFAULT_HOURS', 24),
+    )
+    return timedelta(hours=hours)
+
+
+def expiry_deadline(organ):
+    return organ.organ_date_time + viability_window(organ.organ)
+
+
+class ExpiryScheduler:
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self._heap = []       # (deadline, organ_id)
+        self._deadlines = {}  # organ_id -> current deadline; heap entries that disagree are stale
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self.expired_count = 0
+
+    def schedule(self, organ):
+        """Add or move an organ's deadline; superseded heap entries are skipped lazily"""
+        deadline = expiry_deadline(organ)
+        with self._lock:
+            if self._deadlines.get(organ.id) == deadline:
+                return
+            self._deadlines[organ.id] = deadline
+            heapq.heappush(self._heap, (deadline, organ.id))
+            if self._heap[0][1] == organ.id:
+                self._wakeup.notify()
+
+    def cancel(self, organ_id):
+        with self._lock:
+            self._deadlines.pop(organ_id, None)
+
+    def load(self):
+        """(Re)build the heap from every organ that is not yet marked expired"""
+        from . import models
+
+        entries = {}
+        for organ in models.Organ.objects.filter(expired=False).only('id', 'organ', 'organ_date_time').iterator():
+            entries[organ.id] = expiry_deadline(organ)
+        heap = [(deadline, organ_id) for organ_id, deadline in entries.items()]
+        heapq.heapify(heap)
+        with self._lock:
+            self._deadlines = entries
+            self._heap = heap
+            self._wakeup.notify()
+
+    def pop_due(self, now=None):
+        """Pop every organ whose deadline has passed"""
+        now = now or timezone.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, organ_id = heapq.heappop(self._heap)
+                if self._deadlines.get(organ_id) == deadline:
+                    del self._deadlines[organ_id]
+                    due.append(organ_id)
+        return due
+
+    def next_deadline(self):
+        with self._lock:
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def run_once(self, now=None):
+        """Expire every due organ; returns how many were expired"""
+        due = self.pop_due(now)
+        if due:
+            for start in range(0, len(due), self.batch_size):
+                expire_organs(due[start:start + self.batch_size])
+            self.expired_count += len(due)
+        return len(due)
+
+    def run_forever(self, max_sleep=60.0, reload_every=300.0):
+        """Sleep until the next deadline (or max_sleep), expire, repeat"""
+        self.load()
+        reloaded_at = time.monotonic()
+        while True:
+            try:
+                self.run_once()
+                if time.monotonic() - reloaded_at > reload_every:
+                    # Pick up organs registered by other processes
+                    self.load()
+                    reloaded_at = time.monotonic()
+            except Exception as e:
+                print(f"Error expiring organs: {e}")
+            deadline = self.next_deadline()
+            timeout = max_sleep
+            if deadline is not None:
+                timeout = min(max_sleep, max((deadline - timezone.now()).total_seconds(), 0.0))
+            with self._lock:
+                self._wakeup.wait(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start_thread(self):
+        """Run the scheduler loop in a daemon thread of this process"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self.run_forever, name='organ-expiry', daemon=True,
+                kwargs={'max_sleep': getattr(settings, 'ORGAN_EXPIRY_MAX_SLEEP', 60.0)},
+            )
+            self._thread.start()
+
+
+def expire_organs(organ_ids):
+    """Mark one batch of organs expired and backfill the match lists that held them"""
+    from . import models
+
+    holders = set(models.RecipientMatch.objects.filter(organ_id__in=organ_ids)
+                  .values_list('recipient_id', flat=True))
+    # The bulk update sends no signals, so the supply counters are adjusted here,
+    # in the same transaction and only for organs this call actually expires
+    with transaction.atomic():
+        live = list(models.Organ.objects.select_for_update(of=('self',)).filter(
+            id__in=organ_ids, expired=False
+        ).values_list('id', 'organ', 'blood_group', 'donor__city'))
+        models.Organ.objects.filter(id__in=[row[0] for row in live]).update(
+            expired=True, updated_at=timezone.now()
+        )
+        stats.organs_expired([stats.normalize_key(*row[1:]) for row in live])
+    matching.match_index.ensure_loaded()
+    for organ_id in organ_ids:
+        matching.match_index.update('organ', organ_id, None)
+    models.RecipientMatch.objects.filter(organ_id__in=organ_ids).delete()
+    for recipient_id in holders:
+        matching.rescore_recipient(recipient_id)
+
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,259 @@
+# backend/donation/export.py
+"""
+Streaming bulk export of the registry
+
+Donor, Recipient and Organ joins are read with QuerySet.iterator() (a
+server-side cursor on PostgreSQL) and encoded chunk by chunk as CSV, NDJSON
+or Parquet row groups, so memory stays bounded whatever the table size. The
+'training' dataset writes available organs in the KidneyData.csv layout that
+train_model.py reads. Passing `since` exports only rows changed since then.
+The watermark for the next run is the newest updated_at in the database
+being read, taken before the rows are read. It is not the clock of the
+server running the export, which can be ahead of a lagging replica.
+updated_at is stamped before commit, so a row can become visible after
+a newer one. Incremental exports therefore reach back
+EXPORT_WATERMARK_OVERLAP_SECONDS before the watermark. The overlapping
+rows are exported again, and consumers upsert by id.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, timedelta
+from django.conf import settings
+from django.db.models import Max, Q
+from userauth import models as userauth_models
+from . import models
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+CHUNK_SIZE = 2000
+
+# dataset -> list of (column, queryset field, type)
+DATASETS = {
+    'organs': [
+        ('organ_id', 'id', 'int'), ('organ', 'organ', 'str'), ('blood_group', 'blood_group', 'str'),
+        ('organ_date_time', 'organ_date_time', 'datetime'), ('smoke', 'smoke', 'bool'),
+        ('alcohol', 'alcohol', 'bool'), ('drug', 'drug', 'bool'), ('avg_sleep', 'avg_sleep', 'int'),
+        ('daily_exercise', 'daily_exercise', 'int'), ('expired', 'expired', 'bool'),
+        ('donor_id', 'donor_id', 'int'), ('username', 'donor__user__username', 'str'),
+        ('city', 'donor__city', 'str'), ('state', 'donor__state', 'str'),
+        ('zipcode', 'donor__zipcode', 'str'), ('birthday', 'donor__birthday', 'date'),
+        ('updated_at', 'updated_at', 'datetime'),
+    ],
+    'donors': [
+        ('donor_id', 'id', 'int'), ('username', 'user__username', 'str'), ('city', 'city', 'str'),
+        ('state', 'state', 'str'), ('zipcode', 'zipcode', 'str'), ('birthday', 'birthday', 'date'),
+        ('updated_at', 'updated_at', 'datetime'),
+    ],
+    'recipients': [
+        ('recipient_id', 'id', 'int'), ('username', 'user__username', 'str'), ('city', 'city', 'str'),
+        ('state', 'state', 'str'), ('zipcode', 'zipcode', 'str'), ('birthday', 'birthday', 'date'),
+        ('blood_group', 'blood_group', 'str'), ('organ', 'organ', 'str'),
+        ('updated_at', 'updated_at', 'datetime'),
+    ],
+}
+
+# Same columns as KidneyData.csv, minus Time (dropped in training) and the
+# Gender/Race fields the registry doesn't collect
+TRAINING_COLUMNS = ['OrganId', 'Delta', 'Age', 'Blood Type', 'PosNeg', 'Smoke', 'Drug',
+                    'Alcohol', 'AvgSleep', 'City']
+TRAINING_TYPES = ['int', 'str', 'int', 'str', 'str', 'str', 'str', 'str', 'int', 'str']
+TRAINING_FIELDS = ['id', 'expired', 'organ_date_time', 'donor__birthday', 'blood_group',
+                   'smoke', 'drug', 'alcohol', 'avg_sleep', 'donor__city']
+
+
+def base_queryset(dataset, using=None):
+    if dataset in ('organs', 'training'):
+        queryset = models.Organ.objects.all()
+    elif dataset == 'donors':
+        queryset = userauth_models.Donor.objects.all()
+    elif dataset == 'recipients':
+        queryset = userauth_models.Recipient.objects.all()
+    else:
+        raise ValueError(f'Unknown dataset: {dataset}')
+    return queryset.using(using) if using else queryset
+
+
+def changed_since(dataset, queryset, since):
+    since -= timedelta(seconds=getattr(settings, 'EXPORT_WATERMARK_OVERLAP_SECONDS', 300))
+    if dataset in ('organs', 'training'):
+        return queryset.filter(Q(updated_at__gte=since) | Q(donor__updated_at__gte=since))
+    return queryset.filter(updated_at__gte=since)
+
+
+def age_at(birthday, when):
+    if not birthday or not when:
+        return None
+    when = when.date() if hasattr(when, 'date') else when
+    return when.year - birthday.year - ((when.month, when.day) < (birthday.month, birthday.day))
+
+
+def training_row(values):
+    organ_id, expired, organ_date, birthday, blood_group, smoke, drug, alcohol, avg_sleep, city = values
+    blood_group = (blood_group or '').strip().upper()
+    return (
+        organ_id,
+        'expired' if expired else 'alive',
+        age_at(birthday, organ_date),
+        blood_group.rstrip('+-'),
+        'Neg' if blood_group.endswith('-') else 'Pos',
+        f'S{bool(smoke)}', f'D{bool(drug)}', f'A{bool(alcohol)}',
+        avg_sleep,
+        city,
+    )
+
+
+def export_rows(dataset, since=None, using=None, organ=None):
+    """
+    Columns, their types and a lazy row iterator for a dataset
+
+    Args:
+        dataset (str): 'organs', 'donors', 'recipients' or 'training'
+        since (datetime): Only rows changed since this watermark, less the overlap
+        using (str): Database alias to read from
+        organ (str): Organ type filter for 'organs' and 'training'
+
+    Returns:
+        tuple: (column names, column types, iterator of row tuples)
+    """
+    queryset = base_queryset(dataset, using)
+    if since is not None:
+        queryset = changed_since(dataset, queryset, since)
+    if organ and dataset in ('organs', 'training'):
+        queryset = queryset.filter(organ__iexact=organ)
+
+    if dataset == 'training':
+        # Expired organs can't be matched, so they don't belong in the index
+        queryset = queryset.filter(expired=False)
+        rows = queryset.order_by('pk').values_list(*TRAINING_FIELDS).iterator(chunk_size=CHUNK_SIZE)
+        return TRAINING_COLUMNS, TRAINING_TYPES, (training_row(r) for r in rows)
+
+    spec = DATASETS[dataset]
+    rows = queryset.order_by('pk').values_list(*[field for _, field, _ in spec]).iterator(chunk_size=CHUNK_SIZE)
+    return [c for c, _, _ in spec], [t for _, _, t in spec], rows
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_csv(columns, types, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in chunks(rows):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def encode_ndjson(columns, types, rows):
+    for chunk in chunks(rows):
+        yield ''.join(
+            json.dumps(dict(zip(columns, map(json_value, row))), separators=(',', ':')) + '\n' for row in chunk
+        ).encode()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain"""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def encode_parquet(columns, types, rows):
+    """One Parquet row group per chunk (requires pyarrow)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_(),
+                   'datetime': pa.timestamp('us', tz='UTC'), 'date': pa.date32()}
+    schema = pa.schema([(c, arrow_types[t]) for c, t in zip(columns, types)])
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for chunk in chunks(rows):
+            arrays = [pa.array(list(values), type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {'csv': encode_csv, 'ndjson': encode_ndjson, 'parquet': encode_parquet}
+
+
+def encode(fmt, columns, types, rows):
+    if fmt == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError('Parquet export requires pyarrow')
+    return ENCODERS[fmt](columns, types, rows)
+
+
+def gzip_stream(pieces, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31: gzip container
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def new_watermark(dataset, using=None, since=None):
+    """
+    Watermark for the next incremental export of a dataset
+
+    Args:
+        dataset (str): Dataset being exported
+        using (str): Database alias the rows are read from
+        since (datetime): Current watermark, kept when the tables are empty
+
+    Returns:
+        datetime: Newest updated_at among the dataset's tables in that database
+    """
+    querysets = [base_queryset(dataset, using)]
+    if dataset in ('organs', 'training'):
+        # Organ rows also change when their donor does
+        donors = userauth_models.Donor.objects.all()
+        querysets.append(donors.using(using) if using else donors)
+    marks = [qs.aggregate(mark=Max('updated_at'))['mark'] for qs in querysets]
+    marks = [m for m in marks if m is not None]
+    return max(marks) if marks else since
@@ -0,0 +1,279 @@
+# backend/donation/jobs.py
+"""
+Database-backed match job queue and its local worker pool
+
+Jobs are rows in MatchJob. Workers claim the highest-priority queued job with
+a conditional UPDATE (so several workers or processes never run the same
+job), run it in chunks on the matching service while reporting progress and
+honouring cancellation, and store the result in MatchJobResult chunks until
+its TTL expires. A running job heartbeats with each progress report; one
+whose worker died is reclaimed after MATCH_JOB_LEASE_SECONDS and queued
+again, and the claim counter keeps a lost worker from writing afterwards.
+"""
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+from ml_admission import admission_controller
+from ml_registry import organ_model_registry
+from ml_services import organ_matching_service
+from . import models
+from .matching import donor_profile, match_index, organ_saved, recipient_profile, rescore_recipient
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLost(Exception):
+    """The job was reclaimed from this worker after its lease ran out"""
+
+
+class JobContext:
+    """Progress reporting, result storage and cancellation checks for a running job"""
+
+    def __init__(self, job):
+        self.job = job
+        self.count = 0
+        self._last_report = 0.0
+
+    def owned(self):
+        return models.MatchJob.objects.filter(pk=self.job.pk, status='running', attempts=self.job.attempts)
+
+    def report(self, done, total):
+        progress = done / total if total else 1.0
+        now = time.monotonic()
+        # Throttle progress writes, but always check for cancellation
+        if progress >= 1.0 or now - self._last_report > 0.5:
+            if not self.owned().update(progress=progress, heartbeat_at=timezone.now()):
+                raise JobLost()
+            self._last_report = now
+        if models.MatchJob.objects.filter(pk=self.job.pk, cancel_requested=True).exists():
+            raise JobCancelled()
+
+    def emit(self, items):
+        """Append result rows, stored in chunks of MATCH_JOB_CHUNK_SIZE"""
+        chunk = getattr(settings, 'MATCH_JOB_CHUNK_SIZE', 100)
+        rows = []
+        for start in range(0, len(items), chunk):
+            part = items[start:start + chunk]
+            rows.append(models.MatchJobResult(
+                job_id=self.job.pk, attempt=self.job.attempts,
+                start=self.count, end=self.count + len(part), items=part,
+            ))
+            self.count += len(part)
+        models.MatchJobResult.objects.bulk_create(rows)
+
+
+def submit(owner, kind, params, priority=0):
+    return models.MatchJob.objects.create(owner=owner, kind=kind, params=params, priority=priority)
+
+
+def reclaim_stale():
+    """
+    Queue again running jobs whose worker stopped heartbeating
+
+    Jobs past MATCH_JOB_MAX_ATTEMPTS fail instead, and ones already asked to
+    stop are marked cancelled.
+
+    Returns:
+        int: Number of jobs reclaimed
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'MATCH_JOB_LEASE_SECONDS', 300))
+    stale = models.MatchJob.objects.filter(status='running').filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+    )
+    finished = {'finished_at': now, 'expires_at': result_expiry()}
+    reclaimed = stale.filter(cancel_requested=True).update(status='cancelled', **finished)
+    reclaimed += stale.filter(attempts__gte=getattr(settings, 'MATCH_JOB_MAX_ATTEMPTS', 3)).update(
+        status='failed', error='Worker stopped responding', **finished
+    )
+    reclaimed += stale.update(status='queued', progress=0.0, started_at=None, heartbeat_at=None)
+    return reclaimed
+
+
+def claim_next():
+    """Atomically move the best queued job to running; None when the queue is empty"""
+    reclaim_stale()
+    while True:
+        candidate = models.MatchJob.objects.filter(status='queued').order_by(
+            '-priority', 'created_at'
+        ).values_list('pk', flat=True).first()
+        if candidate is None:
+            return None
+        now = timezone.now()
+        claimed = models.MatchJob.objects.filter(pk=candidate, status='queued').update(
+            status='running', started_at=now, heartbeat_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            job = models.MatchJob.objects.get(pk=candidate)
+            # Partial results of a reclaimed attempt
+            job.result_chunks.exclude(attempt=job.attempts).delete()
+            return job
+
+
+def cancel(job):
+    """Cancel a queued job immediately, or ask a running one to stop"""
+    if models.MatchJob.objects.filter(pk=job.pk, status='queued').update(
+            status='cancelled', finished_at=timezone.now(), expires_at=result_expiry()):
+        return True
+    return bool(models.MatchJob.objects.filter(pk=job.pk, status='running').update(cancel_requested=True))
+
+
+def result_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, 'MATCH_JOB_RESULT_TTL', 24 * 3600))
+
+
+def run_match(params, context):
+    matches = organ_model_registry.find_matches(params['recipient_profile'], params.get('n_matches', 10))
+    context.emit(matches)
+    context.report(1, 1)
+
+
+def run_rematch(params, context):
+    from userauth import models as userauth_models
+
+    recipients = userauth_models.Recipient.objects.order_by('id')
+    if params.get('recipient_ids'):
+        recipients = recipients.filter(id__in=params['recipient_ids'])
+    recipients = list(recipients)
+    chunk = getattr(settings, 'MATCH_JOB_CHUNK_SIZE', 100)
+    n_matches = params.get('n_matches', 10)
+
+    for start in range(0, len(recipients), chunk):
+        part = recipients[start:start + chunk]
+        profiles = [dict(recipient_profile(r), state=r.state) for r in part]
+        found = organ_model_registry.find_matches_batch(profiles, [n_matches] * len(part))
+        context.emit([{'recipient_id': r.id, 'matches': m} for r, m in zip(part, found)])
+        context.report(start + len(part), len(recipients))
+
+
+def run_compatibility(params, context):
+    from userauth import models as userauth_models
+
+    donors = list(userauth_models.Donor.objects.filter(id__in=params['donor_ids']))
+    recipients = list(userauth_models.Recipient.objects.filter(id__in=params['recipient_ids']))
+    organs = {o.donor_id: o for o in models.Organ.objects.filter(donor__in=donors)}
+    donor_entries = [(d.id, donor_profile(d, organs.get(d.id), params)) for d in donors]
+    chunk = getattr(settings, 'MATCH_JOB_CHUNK_SIZE', 100)
+
+    results = []
+    for start in range(0, len(recipients), chunk):
+        part = recipients[start:start + chunk]
+        scores = organ_matching_service.get_compatibility_scores(
+            donor_entries, [(r.id, recipient_profile(r)) for r in part]
+        )
+        results.extend(
+            {'donor_id': d.id, 'recipient_id': r.id, 'compatibility_score': float(scores[i][j])}
+            for i, d in enumerate(donors) for j, r in enumerate(part)
+        )
+        context.report(start + len(part), len(recipients))
+    # Sorted across every chunk, so stored only once all scores are in
+    results.sort(key=lambda item: item['compatibility_score'], reverse=True)
+    context.emit(results)
+
+
+def run_rebuild_recipients(params, context):
+    """Recompute the stored RecipientMatch rows of the given recipients"""
+    match_index.ensure_loaded()
+    ids = params['recipient_ids']
+    for done, recipient_id in enumerate(ids, 1):
+        rescore_recipient(recipient_id)
+        context.report(done, len(ids))
+
+
+def run_rebuild_organs(params, context):
+    """Re-index the given organs and re-score the recipients they can affect"""
+    ids = params['organ_ids']
+    chunk = getattr(settings, 'MATCH_JOB_CHUNK_SIZE', 100)
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        for organ in models.Organ.objects.filter(id__in=part, expired=False).select_related('donor'):
+            organ_saved(organ)
+        context.report(start + len(part), len(ids))
+
+
+HANDLERS = {
+    'match': run_match,
+    'rematch': run_rematch,
+    'compatibility': run_compatibility,
+    'rebuild_recipients': run_rebuild_recipients,
+    'rebuild_organs': run_rebuild_organs,
+}
+# Kinds clients may submit through the jobs API; the rest are queued by the admin
+API_KINDS = ('match', 'rematch', 'compatibility')
+
+
+def run_job(job):
+    """Run one claimed job and record its outcome"""
+    fields = {}
+    ticket = None
+    context = JobContext(job)
+    try:
+        # Jobs yield to interactive requests in this process, but are never shed
+        ticket = admission_controller.acquire('batch', block=True)
+        HANDLERS[job.kind](job.params, context)
+        fields.update(status='done', progress=1.0, result_count=context.count)
+    except JobLost:
+        return
+    except JobCancelled:
+        fields.update(status='cancelled')
+    except Exception as e:
+        fields.update(status='failed', error=str(e))
+    finally:
+        admission_controller.release(ticket)
+    fields['finished_at'] = timezone.now()
+    fields['expires_at'] = result_expiry()
+    if fields['status'] != 'done':
+        models.MatchJobResult.objects.filter(job_id=job.pk, attempt=job.attempts).delete()
+    context.owned().update(**fields)
+
+
+def cleanup_expired():
+    """Delete finished jobs whose result TTL has passed"""
+    deleted, _ = models.MatchJob.objects.filter(
+        status__in=['done', 'failed', 'cancelled'], expires_at__lt=timezone.now()
+    ).delete()
+    return deleted
+
+
+class WorkerPool:
+    def __init__(self, workers=2, poll_interval=1.0, cleanup_every=300.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.cleanup_every = cleanup_every
+        self._threads = []
+        self._stop = threading.Event()
+        self._last_cleanup = 0.0
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f'match-job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _loop(self):
+        while not self._stop.is_set():
+            close_old_connections()
+            try:
+                if time.monotonic() - self._last_cleanup > self.cleanup_every:
+                    self._last_cleanup = time.monotonic()
+                    cleanup_expired()
+                job = claim_next()
+                if job is not None:
+                    run_job(job)
+                    continue
+            except Exception as e:
+                print(f"Error in match job worker: {e}")
+            self._stop.wait(self.poll_interval)
@@ -0,0 +1,257 @@
+# backend/donation/loadtest.py
+"""
+Open-loop HTTP load generator for the API
+
+Synthetic donors and recipients are signed up, donors register organs, and a
+weighted mix of calls is issued at a fixed target rate. Latency is measured
+from each request's scheduled start, so a slow server shows up as queueing
+delay instead of silently lowering the offered load. Every synthetic user is
+named with the run's tag (RUN_PREFIX + start time), so delete_synthetic_data
+can remove them, and the organs, posts and matches hanging off them, once
+the run is over. Each call draws from its own RNG seeded in schedule order,
+so a --seed replays the same calls whatever thread runs them. Used by the
+`loadtest` management command.
+"""
+import base64
+import http.client
+import itertools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from urllib.parse import urlsplit
+from django.contrib.auth.models import User
+from ml_metrics import summarize_latencies
+
+RUN_PREFIX = 'loadtest_'
+
+CITIES = ['Seattle', 'Detroit', 'Phoenix', 'Houston', 'Baltimore', 'Atlanta', 'New York']
+BLOOD_GROUPS = ['O+', 'O-', 'A+', 'A-', 'B+', 'B-', 'AB+', 'AB-']
+ORGANS = ['kidney', 'liver', 'heart', 'lung', 'pancreas']
+
+DEFAULT_MIX = {
+    'find-matches': 25,
+    'compatibility': 15,
+    'available-donors': 20,
+    'organ': 15,
+    'posts': 15,
+    'post-create': 5,
+    'recipient-matches': 5,
+}
+
+
+def parse_mix(text):
+    """'find-matches=30,organ=10' -> {'find-matches': 30, 'organ': 10}"""
+    mix = {}
+    for part in filter(None, (p.strip() for p in text.split(','))):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def delete_synthetic_data(run_id=None):
+    """
+    Delete the users created by one load test run, or by every run
+
+    Donor and recipient profiles, organs, posts and matches cascade from the
+    user, and deleting through the ORM keeps the statistics counters and the
+    match index in step.
+
+    Returns:
+        int: Number of users deleted
+    """
+    users = User.objects.filter(username__startswith=f'{run_id}_' if run_id else RUN_PREFIX)
+    count = users.count()
+    users.delete()
+    return count
+
+
+class Client:
+    """Keep-alive HTTP client, one connection per thread"""
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def request(self, method, path, body=None, auth=None):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            factory = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            conn = self._local.conn = factory(self.netloc, timeout=self.timeout)
+        headers = {'Accept': 'application/json'}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if auth:
+            token = base64.b64encode(f'{auth[0]}:{auth[1]}'.encode()).decode()
+            headers['Authorization'] = f'Basic {token}'
+        try:
+            conn.request(method, f'{self.prefix}/{path}', body=payload, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            self._local.conn = None
+            raise
+        try:
+            parsed = json.loads(data) if data else None
+        except ValueError:
+            parsed = None
+        return response.status, parsed
+
+
+class LoadTest:
+    def __init__(self, base_url, donors=20, recipients=20, rate=50.0, duration=30.0,
+                 concurrency=32, mix=None, seed=0, log=print):
+        self.client = Client(base_url)
+        self.base_url = base_url
+        self.n_donors = donors
+        self.n_recipients = recipients
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.mix = mix or dict(DEFAULT_MIX)
+        self.random = random.Random(seed)
+        self.log = log
+        self.run_id = f'{RUN_PREFIX}{int(time.time())}'
+        self.donor_users = []
+        self.recipient_users = []
+        self.donor_ids = []
+        self.recipient_ids = []
+        self.samples = []  # (endpoint, seconds, status)
+        self._lock = threading.Lock()
+
+    def setup(self):
+        """Sign up synthetic donors and recipients and register donor organs"""
+        for i in range(self.n_donors):
+            user = (f'{self.run_id}_donor_{i}', 'LoadTest!2024')
+            self.client.request('POST', 'signup/donor/', {
+                'username': user[0], 'password': user[1],
+                'donor': self.person(i, 'donor'),
+            })
+            self.client.request('POST', 'organ/', {
+                'blood_group': self.random.choice(BLOOD_GROUPS),
+                'organ': self.random.choice(ORGANS),
+                'organ_date_time': datetime.now(timezone.utc).isoformat(),
+                'avg_sleep': self.random.randint(5, 10),
+            }, auth=user)
+            self.donor_users.append(user)
+        for i in range(self.n_recipients):
+            user = (f'{self.run_id}_recipient_{i}', 'LoadTest!2024')
+            recipient = dict(self.person(i, 'recipient'),
+                             blood_group=self.random.choice(BLOOD_GROUPS),
+                             organ=self.random.choice(ORGANS))
+            self.client.request('POST', 'signup/recipient/', {
+                'username': user[0], 'password': user[1], 'recipient': recipient,
+            })
+            self.recipient_users.append(user)
+
+        auth = self.recipient_users[0] if self.recipient_users else None
+        _, donors = self.client.request('GET', 'available-donors/', auth=auth)
+        self.donor_ids = [d['id'] for d in (donors or {}).get('donors', [])]
+        _, recipients = self.client.request('GET', 'get/')
+        self.recipient_ids = [r['id'] for r in recipients or [] if isinstance(r, dict)]
+        self.log(f'Set up {len(self.donor_users)} donors ({len(self.donor_ids)} visible) and '
+                 f'{len(self.recipient_users)} recipients ({len(self.recipient_ids)} visible)')
+
+    def person(self, i, role):
+        return {
+            'phone_number': f'555{i:07d}',
+            'address': f'{i} Load Test Ave',
+            'city': self.random.choice(CITIES),
+            'state': 'WA',
+            'zipcode': '98101',
+            'health_card_number': f'{role[0].upper()}{i:011d}',
+            'birthday': date(1980, 1, 1).isoformat(),
+        }
+
+    def call(self, endpoint, rng=None):
+        """Issue one call of the given kind as a random synthetic user"""
+        rng = rng or self.random
+        recipient = rng.choice(self.recipient_users) if self.recipient_users else None
+        donor = rng.choice(self.donor_users) if self.donor_users else None
+        if endpoint == 'find-matches':
+            return self.client.request('POST', 'find-matches/', {'n_matches': 10}, auth=recipient)
+        if endpoint == 'compatibility':
+            return self.client.request('POST', 'compatibility/', {
+                'donor_id': rng.choice(self.donor_ids or [0]),
+                'recipient_id': rng.choice(self.recipient_ids or [0]),
+                'donor_blood_group': rng.choice(BLOOD_GROUPS),
+                'organ': rng.choice(ORGANS),
+            }, auth=recipient)
+        if endpoint == 'available-donors':
+            return self.client.request('GET', 'available-donors/', auth=recipient)
+        if endpoint == 'organ':
+            return self.client.request('GET', 'organ/', auth=donor)
+        if endpoint == 'posts':
+            return self.client.request('GET', '', auth=recipient)
+        if endpoint == 'post-create':
+            return self.client.request('POST', 'author/', {
+                'title': 'Looking for a donor', 'content': 'Synthetic load test post',
+            }, auth=recipient)
+        if endpoint == 'recipient-matches':
+            return self.client.request('GET', 'recipient-matches/', auth=recipient)
+        raise ValueError(f'Unknown endpoint in mix: {endpoint}')
+
+    def run(self):
+        """Replay the mix at the target rate and return the JSON summary"""
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        interval = 1.0 / self.rate
+        started = time.perf_counter()
+
+        def fire(endpoint, scheduled, rng):
+            try:
+                status, _ = self.call(endpoint, rng)
+            except Exception:
+                status = 0
+            with self._lock:
+                self.samples.append((endpoint, time.perf_counter() - scheduled, status))
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for n in itertools.count():
+                scheduled = started + n * interval
+                if scheduled - started >= self.duration:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # Draw in schedule order; pool threads only use their call's own RNG
+                endpoint = self.random.choices(names, weights)[0]
+                pool.submit(fire, endpoint, scheduled, random.Random(self.random.getrandbits(64)))
+        elapsed = time.perf_counter() - started
+        return self.summary(elapsed)
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for name in sorted({s[0] for s in self.samples}):
+            rows = [s for s in self.samples if s[0] == name]
+            stats = summarize_latencies([s[1] for s in rows])
+            stats['errors'] = sum(1 for s in rows if not 200 <= s[2] < 400)
+            stats['throughput_rps'] = round(len(rows) / elapsed, 2)
+            endpoints[name] = stats
+        overall = summarize_latencies([s[1] for s in self.samples])
+        overall['errors'] = sum(1 for s in self.samples if not 200 <= s[2] < 400)
+        overall['throughput_rps'] = round(len(self.samples) / elapsed, 2)
+        return {
+            'config': {
+                'url': self.base_url,
+                'run_id': self.run_id,
+                'target_rate': self.rate,
+                'duration': self.duration,
+                'concurrency': self.concurrency,
+                'donors': self.n_donors,
+                'recipients': self.n_recipients,
+                'mix': self.mix,
+            },
+            'elapsed_seconds': round(elapsed, 3),
+            'overall': overall,
+            'endpoints': endpoints,
+        }
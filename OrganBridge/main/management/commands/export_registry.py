@@ -0,0 +1,73 @@
+import gzip
+import os
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from main import export
+
+
+class Command(BaseCommand):
+    help = 'Stream organs, donors, recipients or training rows to CSV, NDJSON or Parquet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=['organs', 'donors', 'recipients', 'training'])
+        parser.add_argument('--format', choices=list(export.FORMATS),
+                            help='Output format (default from the file extension, else csv)')
+        parser.add_argument('--output', default='-',
+                            help="Output file, '-' for stdout; a .gz suffix compresses. For training, "
+                                 "e.g. ml_models/KidneyData.csv then `python train_model.py --organ kidney`")
+        parser.add_argument('--organ', help='Only this organ type (organs and training)')
+        parser.add_argument('--since', help='Only rows changed after this ISO 8601 time')
+        parser.add_argument('--watermark-file',
+                            help='Read --since from this file if present and store the new watermark in it')
+        parser.add_argument('--database', help='Database alias to read from (e.g. a replica)')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        fmt = options['format'] or self.format_for(output)
+        since = options['since']
+        watermark_file = options['watermark_file']
+        if not since and watermark_file and os.path.exists(watermark_file):
+            with open(watermark_file) as f:
+                since = f.read().strip()
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                raise CommandError('--since must be an ISO 8601 datetime')
+
+        try:
+            watermark = export.new_watermark(options['dataset'], options['database'], since)
+            columns, types, rows = export.export_rows(options['dataset'], since=since,
+                                                      using=options['database'], organ=options['organ'])
+            pieces = export.encode(fmt, columns, types, rows)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if output == '-':
+            stream, close = sys.stdout.buffer, False
+        elif output.endswith('.gz'):
+            stream, close = gzip.open(output, 'wb'), True
+        else:
+            stream, close = open(output, 'wb'), True
+        written = 0
+        try:
+            for piece in pieces:
+                stream.write(piece)
+                written += len(piece)
+        finally:
+            if close:
+                stream.close()
+            else:
+                stream.flush()
+
+        if watermark_file and watermark:
+            with open(watermark_file, 'w') as f:
+                f.write(watermark.isoformat())
+        mark = watermark.isoformat() if watermark else 'none (no rows)'
+        self.stderr.write(f'Exported {options["dataset"]} ({written} bytes); watermark {mark}')
+
+    @staticmethod
+    def format_for(path):
+        name = path[:-3] if path.endswith('.gz') else path
+        extension = os.path.splitext(name)[1].lstrip('.')
+        return {'json': 'ndjson', 'jsonl': 'ndjson'}.get(extension, extension if extension in export.FORMATS else 'csv')
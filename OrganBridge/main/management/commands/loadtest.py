@@ -0,0 +1,87 @@
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.loadtest import DEFAULT_MIX, LoadTest, delete_synthetic_data, parse_mix
+
+
+class Command(BaseCommand):
+    help = 'Replay a realistic API call mix at a target rate and report latency percentiles as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server (default: start runserver)')
+        parser.add_argument('--rate', type=float, default=50.0, help='Target requests per second')
+        parser.add_argument('--duration', type=float, default=30.0, help='Seconds of load')
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--donors', type=int, default=20)
+        parser.add_argument('--recipients', type=int, default=20)
+        parser.add_argument('--mix', default=','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items()),
+                            help='Weighted endpoint mix, e.g. find-matches=30,organ=10')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON summary to this file')
+        parser.add_argument('--keep-data', action='store_true',
+                            help='Keep the synthetic users, organs and posts after the run')
+        parser.add_argument('--purge', action='store_true',
+                            help='Only delete synthetic data left behind by earlier runs')
+
+    def handle(self, *args, **options):
+        if options['purge']:
+            self.stderr.write(f'Deleted {delete_synthetic_data()} synthetic users')
+            return
+        server = None
+        test = None
+        url = options['url']
+        if not url:
+            server, url = self.start_server()
+        try:
+            test = LoadTest(
+                url, donors=options['donors'], recipients=options['recipients'],
+                rate=options['rate'], duration=options['duration'],
+                concurrency=options['concurrency'], mix=parse_mix(options['mix']),
+                seed=options['seed'], log=lambda msg: self.stderr.write(msg),
+            )
+            test.setup()
+            summary = test.run()
+        finally:
+            if server:
+                server.terminate()
+                server.wait(timeout=10)
+            # Only this database is cleaned; a remote --url server needs --purge run there
+            if test and not options['keep_data']:
+                self.stderr.write(f'Deleted {delete_synthetic_data(test.run_id)} synthetic users')
+
+        output = json.dumps(summary, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            self.stderr.write(f"Wrote {options['output']}")
+        self.stdout.write(output)
+
+    def start_server(self):
+        """Start `manage.py runserver` on a free port and wait until it answers"""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        manage = str(settings.BASE_DIR / 'manage.py')
+        server = subprocess.Popen(
+            [sys.executable, manage, 'runserver', f'127.0.0.1:{port}', '--noreload'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        url = f'http://127.0.0.1:{port}/'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                urllib.request.urlopen(url + 'get/', timeout=1)
+                return server, url
+            except urllib.error.HTTPError:
+                # Any HTTP answer means the server is up
+                return server, url
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError('runserver did not start within 30 seconds')
@@ -0,0 +1,37 @@
+import os
+import pickle
+from django.core.management.base import BaseCommand
+from ml_registry import organ_model_registry
+from ml_services import OrganMatchingService
+from ml_vectors import prune_profile_vectors
+
+
+class Command(BaseCommand):
+    help = 'Delete persisted profile vectors of TF-IDF models that are no longer deployed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the versions that are kept')
+
+    def handle(self, *args, **options):
+        keep = set()
+        for organ in organ_model_registry.available_organs():
+            # The default organ's model lives directly in ml_models/
+            model_dir = (organ_model_registry.model_root if organ == organ_model_registry.default_organ
+                         else organ_model_registry.model_dir(organ))
+            path = os.path.join(model_dir, 'tf_model.pkl')
+            if not os.path.exists(path):
+                continue
+            # Only the vectorizer is needed to fingerprint a model
+            service = OrganMatchingService(autoload=False)
+            with open(path, 'rb') as f:
+                service.tf_model = pickle.load(f)
+            version = service.compute_model_version()
+            keep.add(version)
+            self.stdout.write(f'{organ}: keeping model version {version}')
+        if not keep:
+            self.stderr.write('No deployed models found; refusing to prune everything')
+            return
+        if options['dry_run']:
+            return
+        deleted = prune_profile_vectors(keep)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} stale profile vectors'))
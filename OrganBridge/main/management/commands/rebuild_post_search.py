@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from main.search import ensure_index
+
+
+class Command(BaseCommand):
+    help = 'Create the post full-text search index and re-index every post'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        if ensure_index(options['database'], rebuild=True):
+            self.stdout.write(self.style.SUCCESS('Rebuilt post search index'))
+        else:
+            self.stdout.write('This database has no full-text index; search uses substring matching')
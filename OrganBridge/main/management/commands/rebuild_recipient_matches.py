@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from userauth import models as userauth_models
+from main import matching
+
+
+class Command(BaseCommand):
+    help = 'Recompute the RecipientMatch top-k table for every recipient'
+
+    def handle(self, *args, **options):
+        matching.match_index.load()
+        recipient_ids = list(userauth_models.Recipient.objects.values_list('id', flat=True))
+        for i, recipient_id in enumerate(recipient_ids, 1):
+            matching.rescore_recipient(recipient_id)
+            if i % 1000 == 0:
+                self.stdout.write(f'Re-scored {i}/{len(recipient_ids)} recipients')
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt matches for {len(recipient_ids)} recipients '
+            f'against {len(matching.match_index.organs)} organs'
+        ))
@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from main import stats
+
+
+class Command(BaseCommand):
+    help = 'Recount waitlist and supply statistics from the base tables and repair drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, default=0,
+                            help='Keep running, reconciling every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                report = stats.reconcile()
+                drift = sum(n for counts in report.values() for n in counts.values())
+                style = self.style.SUCCESS if not drift else self.style.WARNING
+                self.stdout.write(style(' '.join(
+                    f"{metric}: {c['corrected']} corrected, {c['added']} added, {c['removed']} removed;"
+                    for metric, c in report.items()
+                ).rstrip(';')))
+            except Exception as e:
+                if not options['every']:
+                    raise
+                self.stderr.write(f'Error reconciling statistics: {e}')
+            if not options['every']:
+                return
+            time.sleep(options['every'])
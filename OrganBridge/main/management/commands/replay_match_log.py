@@ -0,0 +1,45 @@
+import json
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ml_querylog import read_log, replay
+from ml_services import OrganMatchingService
+
+
+class Command(BaseCommand):
+    help = 'Replay a captured match query log through a matching backend and compare with what was served'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=getattr(settings, 'MATCH_QUERY_LOG', None),
+                            help='NDJSON query log (default MATCH_QUERY_LOG)')
+        parser.add_argument('--backend', choices=['exact', 'ivf', 'sharded', 'quantized'],
+                            help='Index backend to replay against (default MATCH_INDEX_BACKEND)')
+        parser.add_argument('--model-dir', help='Model directory, e.g. ml_models/liver (default ml_models)')
+        parser.add_argument('--data-file', default='KidneyData.csv',
+                            help="Dataset file in the model directory ('data.csv' for per-organ models)")
+        parser.add_argument('--organ', help='Only replay queries for this organ')
+        parser.add_argument('--batch-size', type=int, default=1, help='Queries per find_matches_batch call')
+        parser.add_argument('--limit', type=int, help='Replay at most this many log lines')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        if not options['log']:
+            raise CommandError('No query log given and MATCH_QUERY_LOG is not set')
+        service = OrganMatchingService(
+            backend=options['backend'], model_dir=options['model_dir'], data_file=options['data_file']
+        )
+        if not service.loaded:
+            raise CommandError('Could not load the matching models')
+        try:
+            report = replay(read_log(options['log'], options['limit']), service,
+                            batch_size=max(options['batch_size'], 1), organ=options['organ'])
+        except FileNotFoundError:
+            raise CommandError(f"Query log not found: {options['log']}")
+        finally:
+            if service.shard_index is not None:
+                service.shard_index.close()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from main.expiry import expiry_scheduler
+
+
+class Command(BaseCommand):
+    help = 'Expire organs whose viability window has passed, continuously or once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Expire due organs and exit')
+        parser.add_argument('--max-sleep', type=float, default=60.0)
+        parser.add_argument('--reload-every', type=float, default=300.0,
+                            help='Seconds between reloads of newly registered organs')
+
+    def handle(self, *args, **options):
+        if options['once']:
+            expiry_scheduler.load()
+            count = expiry_scheduler.run_once()
+            self.stdout.write(self.style.SUCCESS(f'Expired {count} organs'))
+            return
+        self.stdout.write('Organ expiry scheduler running (Ctrl+C to stop)')
+        expiry_scheduler.run_forever(options['max_sleep'], options['reload_every'])
@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+from main import jobs
+
+
+class Command(BaseCommand):
+    help = 'Run the local match job worker pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--cleanup', action='store_true',
+                            help='Only delete expired job results and exit')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            self.stdout.write(self.style.SUCCESS(f'Deleted {jobs.cleanup_expired()} expired jobs'))
+            return
+        pool = jobs.WorkerPool(workers=options['workers'], poll_interval=options['poll_interval'])
+        pool.start()
+        self.stdout.write(f"Running {options['workers']} match job workers (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pool.stop()
@@ -0,0 +1,37 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.db import replica_aliases
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database onto every read replica file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help='Keep syncing every N seconds instead of once')
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES['default']
+        if primary['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('sync_replicas only handles SQLite; use real replication elsewhere')
+        while True:
+            for alias in replica_aliases():
+                started = time.perf_counter()
+                self.copy(str(primary['NAME']), str(settings.DATABASES[alias]['NAME']))
+                self.stdout.write(f'Synced {alias} in {time.perf_counter() - started:.2f}s')
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    @staticmethod
+    def copy(source_path, target_path):
+        # The online backup API gives a consistent snapshot while the primary is in use
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target, pages=4096)
+        finally:
+            target.close()
+            source.close()
@@ -0,0 +1,407 @@
+# backend/donation/matching.py
+"""
+Helpers that turn registry rows into the profile dicts used by ml_services,
+and the event-driven maintenance of the RecipientMatch top-k table
+
+Maintenance runs on a background worker fed by transaction.on_commit, so a
+saving request never waits for index loads or re-scoring. The in-memory
+index is rebuilt off to the side and swapped in whole; changes made while
+a rebuild runs are journaled and replayed onto the new index.
+"""
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from ml_memory import sampled_sizeof, sparse_nbytes
+from ml_services import organ_matching_service
+
+
+def donor_profile(donor, organ=None, fallback=None):
+    """
+    Build a donor profile for compatibility scoring
+
+    Organ details come from the donor's registered Organ when there is one,
+    otherwise from `fallback` (e.g. the request data).
+    """
+    fallback = fallback or {}
+    return {
+        'city': donor.city,
+        'blood_group': organ.blood_group if organ else fallback.get('donor_blood_group', ''),
+        'organ': organ.organ if organ else fallback.get('organ', ''),
+    }
+
+
+def recipient_profile(recipient):
+    """Build a recipient profile for compatibility scoring"""
+    return {
+        'city': recipient.city,
+        'blood_group': recipient.blood_group,
+        'organ': recipient.organ,
+    }
+
+
+def organ_vectors(organs):
+    """Cached normalized vectors of registered organs (keyed by their donors), in one batch"""
+    return organ_matching_service.profile_vectors(
+        'donor', [(organ.donor_id, donor_profile(organ.donor, organ)) for organ in organs]
+    )
+
+
+def recipient_vectors(recipients):
+    """Cached normalized vectors of recipients, in one batch"""
+    return organ_matching_service.profile_vectors(
+        'recipient', [(recipient.id, recipient_profile(recipient)) for recipient in recipients]
+    )
+
+
+def organ_vector(organ):
+    """Cached normalized vector of a registered organ (keyed by its donor)"""
+    profile = donor_profile(organ.donor, organ)
+    return organ_matching_service.profile_vectors('donor', [(organ.donor_id, profile)])[0]
+
+
+def recipient_vector(recipient):
+    """Cached normalized vector of a recipient"""
+    return organ_matching_service.profile_vectors(
+        'recipient', [(recipient.id, recipient_profile(recipient))]
+    )[0]
+
+
+class VectorIndex:
+    """In-memory id -> normalized vector map, stacked into a CSR matrix on demand"""
+
+    def __init__(self):
+        self.vectors = {}
+        self._ids = []
+        self._matrix = None
+        self._lock = threading.RLock()
+
+    def set(self, object_id, vector):
+        with self._lock:
+            self.vectors[object_id] = vector
+            self._matrix = None
+
+    def discard(self, object_id):
+        with self._lock:
+            if self.vectors.pop(object_id, None) is not None:
+                self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self.vectors = {}
+            self._matrix = None
+
+    def __contains__(self, object_id):
+        return object_id in self.vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def nbytes(self):
+        """Approximate memory of the vectors and their stacked matrix"""
+        with self._lock:
+            count = len(self.vectors)
+            sample = list(itertools.islice(self.vectors.items(), 200))
+            matrix = self._matrix
+        return sampled_sizeof(sample, count) + sparse_nbytes(matrix)
+
+    def scores(self, vector):
+        """
+        Score one vector against every indexed vector with a single sparse product
+
+        Returns:
+            tuple: (list of ids, numpy array of cosine scores)
+        """
+        with self._lock:
+            if self._matrix is None:
+                self._ids = list(self.vectors)
+                self._matrix = organ_matching_service.stack_vectors(
+                    [self.vectors[i] for i in self._ids]
+                )
+            ids, matrix = self._ids, self._matrix
+        if not ids:
+            return [], []
+        query = organ_matching_service.stack_vectors([vector])
+        return ids, (matrix @ query.T).toarray().ravel()
+
+
+class MatchIndex:
+    """Vectors of all live organs and waiting recipients, loaded lazily from the DB"""
+
+    def __init__(self, chunk_size=2000):
+        self.organs = VectorIndex()
+        self.recipients = VectorIndex()
+        self.loaded_at = None
+        self.expired_checked_at = None
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()       # guards the swap and the journal
+        self._load_lock = threading.Lock()  # one load at a time
+        self._journal = None                # changes made while a load runs
+
+    def stale(self):
+        refresh = getattr(settings, 'MATCH_INDEX_REFRESH_SECONDS', 3600)
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > refresh
+
+    def ensure_loaded(self):
+        if self.stale():
+            with self._load_lock:
+                if self.stale():
+                    self.load()
+        self.drop_expired()
+
+    def drop_expired(self):
+        """Drop organs expired since the last check, possibly by another process"""
+        from . import models
+
+        since, self.expired_checked_at = self.expired_checked_at, timezone.now()
+        if since is None:
+            return
+        # Allow for transactions that committed after they stamped updated_at
+        since -= timedelta(seconds=getattr(settings, 'MATCH_INDEX_EXPIRY_LAG_SECONDS', 60))
+        for organ_id in models.Organ.objects.filter(expired=True, updated_at__gte=since).values_list('id', flat=True):
+            self.update('organ', organ_id, None)
+
+    def update(self, kind, object_id, vector):
+        """Set an 'organ' or 'recipient' vector, or drop it when vector is None"""
+        with self._lock:
+            self._apply(self.organs if kind == 'organ' else self.recipients, object_id, vector)
+            if self._journal is not None:
+                self._journal.append((kind, object_id, vector))
+
+    @staticmethod
+    def _apply(index, object_id, vector):
+        if vector is None:
+            index.discard(object_id)
+        else:
+            index.set(object_id, vector)
+
+    def load(self):
+        """Build fresh indexes from the database and swap them in atomically"""
+        from . import models
+        from userauth import models as userauth_models
+
+        with self._lock:
+            self._journal = []
+        checked_at = timezone.now()
+        try:
+            organs = VectorIndex()
+            rows = models.Organ.objects.filter(expired=False).select_related('donor').iterator(
+                chunk_size=self.chunk_size
+            )
+            for chunk in iter(lambda: list(itertools.islice(rows, self.chunk_size)), []):
+                for organ, vector in zip(chunk, organ_vectors(chunk)):
+                    organs.vectors[organ.id] = vector
+            recipients = VectorIndex()
+            rows = userauth_models.Recipient.objects.iterator(chunk_size=self.chunk_size)
+            for chunk in iter(lambda: list(itertools.islice(rows, self.chunk_size)), []):
+                for recipient, vector in zip(chunk, recipient_vectors(chunk)):
+                    recipients.vectors[recipient.id] = vector
+            with self._lock:
+                for kind, object_id, vector in self._journal:
+                    self._apply(organs if kind == 'organ' else recipients, object_id, vector)
+                self.organs, self.recipients = organs, recipients
+                self.loaded_at = time.monotonic()
+                self.expired_checked_at = checked_at
+        finally:
+            with self._lock:
+                self._journal = None
+
+
+match_index = MatchIndex()
+
+
+class MatchUpdateQueue:
+    """Runs RecipientMatch maintenance in order on a background thread"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        self._worker_pid = None
+
+    def submit(self, func, *args):
+        """Queue one maintenance step; runs inline when MATCH_UPDATES_ASYNC is off"""
+        if not getattr(settings, 'MATCH_UPDATES_ASYNC', True):
+            self._run(func, args)
+            return
+        with self._lock:
+            self._ensure_worker()
+            self._queue.put((func, args))
+
+    def join(self):
+        """Wait until every queued step has run"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _ensure_worker(self):
+        # Called with the lock held; restarts the worker (and its queue) after a fork
+        if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+            self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._loop, args=(self._queue,),
+                                            name='recipient-match-updates', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _loop(self, tasks):
+        while True:
+            func, args = tasks.get()
+            try:
+                close_old_connections()
+                self._run(func, args)
+            finally:
+                tasks.task_done()
+
+    @staticmethod
+    def _run(func, args):
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"Error updating recipient matches: {e}")
+
+
+match_updates = MatchUpdateQueue()
+
+
+def top_k():
+    return getattr(settings, 'RECIPIENT_MATCH_TOP_K', 10)
+
+
+def min_score():
+    return getattr(settings, 'RECIPIENT_MATCH_MIN_SCORE', 0.0)
+
+
+def live_organs(organ_ids):
+    """The subset of organ ids that still exist and have not expired"""
+    from . import models
+
+    return set(models.Organ.objects.filter(id__in=organ_ids, expired=False).values_list('id', flat=True))
+
+
+def rescore_recipient(recipient_id):
+    """Recompute one recipient's top-k organs from scratch and store them"""
+    from . import models
+
+    vector = match_index.recipients.vectors.get(recipient_id)
+    best = []
+    if vector is not None:
+        organ_ids, scores = match_index.organs.scores(vector)
+        candidates = [(s, o) for o, s in zip(organ_ids, scores) if s > min_score()]
+        # The index can lag expiry done elsewhere, so confirm the winners in
+        # the database, widening the window until k live organs are found
+        k = top_k()
+        window = 2 * k
+        while True:
+            # Equal scores go to the older (lower id) organ
+            ranked = heapq.nlargest(window, candidates, key=lambda c: (c[0], -c[1]))
+            live = live_organs([o for _, o in ranked])
+            for _, organ_id in ranked:
+                if organ_id not in live:
+                    match_index.update('organ', organ_id, None)
+            best = [(s, o) for s, o in ranked if o in live][:k]
+            if len(best) >= k or len(ranked) < window:
+                break
+            window *= 2
+    with transaction.atomic():
+        models.RecipientMatch.objects.filter(recipient_id=recipient_id).delete()
+        models.RecipientMatch.objects.bulk_create([
+            models.RecipientMatch(recipient_id=recipient_id, organ_id=organ_id, score=float(score))
+            for score, organ_id in best
+        ])
+
+
+def merge_organ(organ_id, vector, skip=()):
+    """
+    Merge one organ into the top-k list of every recipient it now fits
+
+    The organ is scored against all recipient vectors in one sparse product.
+    Only recipients whose list is not full, or whose current lowest score is
+    beaten, are touched in the database.
+    """
+    from . import models
+
+    k = top_k()
+    recipient_ids, scores = match_index.recipients.scores(vector)
+    candidates = {
+        r: float(s) for r, s in zip(recipient_ids, scores) if s > min_score() and r not in skip
+    }
+    if not candidates:
+        return 0
+
+    # Current size and lowest score of each candidate's list, chunked for SQLite
+    ids = list(candidates)
+    floors = {}
+    for start in range(0, len(ids), 500):
+        floors.update(
+            (row['recipient_id'], (row['n'], row['floor']))
+            for row in models.RecipientMatch.objects.filter(recipient_id__in=ids[start:start + 500])
+            .values('recipient_id').annotate(n=Count('id'), floor=Min('score'))
+        )
+    affected = [r for r in ids if r not in floors or floors[r][0] < k or candidates[r] > floors[r][1]]
+    full = [r for r in affected if r in floors and floors[r][0] >= k]
+
+    # Evict the lowest entry from each full list through a per-recipient
+    # min-heap; among equal scores the newest organ goes, as in rescore_recipient
+    heaps = {}
+    for start in range(0, len(full), 500):
+        for pk, r, score, organ in models.RecipientMatch.objects.filter(
+                recipient_id__in=full[start:start + 500]).values_list('id', 'recipient_id', 'score', 'organ_id'):
+            heaps.setdefault(r, []).append((score, -organ, pk))
+    evicted = []
+    for r, heap in heaps.items():
+        heapq.heapify(heap)
+        while len(heap) >= k:
+            evicted.append(heapq.heappop(heap)[2])
+
+    with transaction.atomic():
+        for start in range(0, len(evicted), 500):
+            models.RecipientMatch.objects.filter(id__in=evicted[start:start + 500]).delete()
+        models.RecipientMatch.objects.bulk_create([
+            models.RecipientMatch(recipient_id=r, organ_id=organ_id, score=candidates[r])
+            for r in affected
+        ])
+    return len(affected)
+
+
+def organ_saved(organ):
+    """A new or changed organ: re-score only the recipients it can affect"""
+    from . import models
+
+    match_index.ensure_loaded()
+    if organ.expired:
+        match_index.update('organ', organ.id, None)
+        return
+    vector = organ_vector(organ)
+    match_index.update('organ', organ.id, vector)
+
+    # Recipients already holding this organ get a full re-score, since its
+    # new score may push it below organs that were previously cut off
+    holders = set(models.RecipientMatch.objects.filter(organ_id=organ.id)
+                  .values_list('recipient_id', flat=True))
+    for recipient_id in holders:
+        rescore_recipient(recipient_id)
+    merge_organ(organ.id, vector, skip=holders)
+
+
+def organ_removed(organ_id, holders):
+    """An organ left the registry: backfill the lists that contained it"""
+    match_index.ensure_loaded()
+    match_index.update('organ', organ_id, None)
+    for recipient_id in holders:
+        rescore_recipient(recipient_id)
+
+
+def recipient_saved(recipient):
+    match_index.ensure_loaded()
+    match_index.update('recipient', recipient.id, recipient_vector(recipient))
+    rescore_recipient(recipient.id)
+
+
+def recipient_removed(recipient_id):
+    match_index.update('recipient', recipient_id, None)
@@ -0,0 +1,239 @@
+# backend/donation/media.py
+"""
+Post image derivatives and media serving
+
+After a Post is saved, a small thread pool renders WebP and JPEG thumbnails
+of each image field at MEDIA_DERIVATIVE_WIDTHS and records them, with their
+sizes, in Post.derivatives keyed by field name. serve_media answers media
+requests with ETag/Last-Modified validation and single-range requests, or
+hands the file to the web server through MEDIA_SENDFILE_HEADER
+(X-Accel-Redirect for nginx, X-Sendfile for Apache/lighttpd). The media URL
+is only routed to Django when DEBUG or MEDIA_SENDFILE_HEADER is set;
+otherwise the web server is expected to serve MEDIA_ROOT itself.
+"""
+import io
+import mimetypes
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from . import models
+
+IMAGE_FIELDS = ('image', 'image2', 'image3')
+FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpeg': ('JPEG', 'image/jpeg')}
+DERIVATIVE_DIR = 'derivatives'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+_executor = None
+_executor_pid = None
+
+
+def executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'MEDIA_DERIVATIVE_WORKERS', 2), thread_name_prefix='media-derivatives'
+        )
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def needs_derivatives(post):
+    """Whether any image field differs from the image its derivatives were made from"""
+    current = post.derivatives or {}
+    # An empty ImageField's name is None or ''
+    return any((getattr(post, f).name or '') != current.get(f, {}).get('source', '') for f in IMAGE_FIELDS)
+
+
+def schedule_derivatives(post_id):
+    """Render derivatives in the background once the saving transaction commits"""
+    transaction.on_commit(lambda: executor().submit(_run_derivatives, post_id))
+
+
+def _run_derivatives(post_id):
+    close_old_connections()
+    try:
+        generate_derivatives(post_id)
+    except Exception as e:
+        print(f"Error generating image derivatives: {e}")
+    finally:
+        close_old_connections()
+
+
+def render(image, width, fmt):
+    """One resized copy of an opened image as (bytes, width, height)"""
+    from PIL import Image
+
+    if image.width > width:
+        height = max(round(image.height * width / image.width), 1)
+        image = image.resize((width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, FORMATS[fmt][0], quality=getattr(settings, 'MEDIA_DERIVATIVE_QUALITY', 80))
+    return buffer.getvalue(), image.width, image.height
+
+
+def derive_field(name):
+    """Render every configured derivative of one stored image"""
+    from PIL import Image, ImageOps
+
+    widths = getattr(settings, 'MEDIA_DERIVATIVE_WIDTHS', (320, 960))
+    formats = getattr(settings, 'MEDIA_DERIVATIVE_FORMATS', ('webp', 'jpeg'))
+    with default_storage.open(name, 'rb') as source:
+        image = ImageOps.exif_transpose(Image.open(source))
+        image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    entry = {'source': name, 'width': image.width, 'height': image.height, 'thumbnails': []}
+    # Never upscale: widths past the original collapse into one full-width copy
+    for width in sorted({min(w, image.width) for w in widths}):
+        for fmt in formats:
+            data, w, h = render(image, width, fmt)
+            path = default_storage.save(f'{DERIVATIVE_DIR}/{stem}_{width}w.{fmt}', ContentFile(data))
+            entry['thumbnails'].append({'path': path, 'format': fmt, 'width': w, 'height': h, 'size': len(data)})
+    return entry
+
+
+def delete_files(entries):
+    for entry in entries:
+        for thumb in entry.get('thumbnails', []):
+            try:
+                default_storage.delete(thumb['path'])
+            except Exception:
+                pass
+
+
+def generate_derivatives(post_id):
+    """Bring Post.derivatives in line with its current images; unchanged images are skipped"""
+    post = models.Post.objects.filter(pk=post_id).first()
+    if post is None:
+        return
+    current = dict(post.derivatives or {})
+    derivatives, stale = {}, []
+    for field in IMAGE_FIELDS:
+        name = getattr(post, field).name or ''
+        entry = current.get(field)
+        if entry and entry.get('source') == name:
+            derivatives[field] = entry
+            continue
+        if entry:
+            stale.append(entry)
+        if name:
+            derivatives[field] = derive_field(name)
+    if derivatives == current:
+        return
+    # update() rather than save() so the post_save pipeline isn't triggered again
+    models.Post.objects.filter(pk=post_id).update(derivatives=derivatives)
+    delete_files(stale)
+
+
+def thumbnails(post, request=None):
+    """Thumbnail URLs per image field for API responses"""
+    result = {}
+    for field, entry in (post.derivatives or {}).items():
+        result[field] = [
+            {
+                'url': request.build_absolute_uri(default_storage.url(t['path'])) if request else default_storage.url(t['path']),
+                'format': t['format'],
+                'width': t['width'],
+                'height': t['height'],
+            }
+            for t in entry.get('thumbnails', [])
+        ]
+    return result
+
+
+def serve_media(request, path):
+    """Serve a file from MEDIA_ROOT with conditional, range and sendfile support"""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except Exception:
+        raise Http404('Invalid path')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    stat = os.stat(full_path)
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    last_modified = int(stat.st_mtime)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        sendfile_header = getattr(settings, 'MEDIA_SENDFILE_HEADER', None)
+        if sendfile_header:
+            # The web server does the I/O, including ranges
+            response = HttpResponse(content_type=content_type)
+            if sendfile_header == 'X-Accel-Redirect':
+                prefix = getattr(settings, 'MEDIA_SENDFILE_PREFIX', '/protected-media/')
+                response[sendfile_header] = prefix.rstrip('/') + '/' + path.lstrip('/')
+            else:
+                response[sendfile_header] = full_path
+        else:
+            response = ranged_response(request, full_path, size, etag, last_modified, content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Cache-Control'] = f"public, max-age={getattr(settings, 'MEDIA_CACHE_MAX_AGE', 86400)}"
+    return response
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single 'bytes=' range, None to send everything, False if unsatisfiable"""
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or (last and int(last) < start):
+            return False
+    else:
+        length = int(last)
+        if not length:
+            return False
+        start, end = max(size - length, 0), size - 1
+    return start, end
+
+
+def read_file(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def ranged_response(request, full_path, size, etag, last_modified, content_type):
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range is not None and if_range and if_range != etag and parse_http_date_safe(if_range) != last_modified:
+        # The client's copy is stale: ignore the Range, satisfiable or not,
+        # and send the whole file (RFC 9110 13.1.5)
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = byte_range or (0, size - 1)
+    length = max(end - start + 1, 0)
+    response = StreamingHttpResponse(read_file(full_path, start, length), content_type=content_type)
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,115 @@
+# backend/donation/middleware.py
+"""
+Opt-in per-request profiling
+
+A request is profiled with cProfile when it carries the X-Profile header with
+PROFILING_HEADER_TOKEN, or by random sampling at PROFILING_SAMPLE_RATE. Dumps
+are written to PROFILING_DIR, which is kept as a ring of at most
+PROFILING_MAX_DUMPS files. With neither option set the middleware removes
+itself at startup, so it costs nothing.
+
+cProfile only records the thread it is enabled on, and match scoring runs on
+the ml_dispatcher thread. The dispatcher batches a profiled request's queries
+were scored in are profiled there and saved next to the request's dump as
+<name>_dispatcher.prof (X-Profile-Dispatcher-Id). Their time shows up in the
+request profile only as the wait in Future.result. Where a second profiler
+cannot be enabled (Python 3.12+, whose cProfile hooks every thread) there is
+no separate dump, and the batch appears in the request profile.
+"""
+import cProfile
+import hmac
+import os
+import pstats
+import random
+import re
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from ml_dispatcher import match_dispatcher
+
+
+def profile_dir():
+    return str(getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles')))
+
+
+def list_dumps():
+    """Profile dumps in the ring directory, newest first"""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if name.endswith('.prof')), reverse=True)
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = float(getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0))
+        self.header_token = getattr(settings, 'PROFILING_HEADER_TOKEN', '')
+        self.max_dumps = getattr(settings, 'PROFILING_MAX_DUMPS', 200)
+        self.paths = tuple(getattr(settings, 'PROFILING_PATHS', ()))
+        if not self.sample_rate and not self.header_token:
+            raise MiddlewareNotUsed()
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active on this thread
+            return self.get_response(request)
+        started = time.perf_counter()
+        with match_dispatcher.collect_profiles() as batch_profiles:
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        elapsed = time.perf_counter() - started
+
+        try:
+            name = self.store(profiler, request, elapsed)
+            response['X-Profile-Id'] = name
+            if batch_profiles:
+                response['X-Profile-Dispatcher-Id'] = self.store_batches(batch_profiles, name)
+        except Exception as e:
+            print(f"Error storing profile: {e}")
+        return response
+
+    def should_profile(self, request):
+        if self.paths and not request.path.startswith(self.paths):
+            return False
+        token = request.META.get('HTTP_X_PROFILE')
+        if token and self.header_token and hmac.compare_digest(token, self.header_token):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def store(self, profiler, request, elapsed):
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-') or 'root'
+        name = '{}_{}_{}_{}_{}ms.prof'.format(
+            time.strftime('%Y%m%dT%H%M%S'), f'{time.time() % 1:.6f}'[2:], request.method,
+            slug[:60], int(elapsed * 1000),
+        )
+        self.write(profiler, name)
+        return name
+
+    def store_batches(self, profiles, request_dump):
+        """Save the dispatcher batches of one request, merged, beside its dump"""
+        name = request_dump[:-len('.prof')] + '_dispatcher.prof'
+        self.write(pstats.Stats(*profiles), name)
+        return name
+
+    def write(self, stats, name):
+        directory = profile_dir()
+        path = os.path.join(directory, name)
+        stats.dump_stats(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        for old in list_dumps()[self.max_dumps:]:
+            try:
+                os.remove(os.path.join(directory, old))
+            except OSError:
+                pass
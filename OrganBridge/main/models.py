@@ -2,8 +2,8 @@ from django.db import models
 from django.contrib.auth.models import User
 
 class Organ(models.Model):
-    blood_group = models.CharField(max_length=3)
-    organ = models.CharField(max_length=50)
+    blood_group = models.CharField(max_length=3, db_index=True)
+    organ = models.CharField(max_length=50, db_index=True)
     organ_date_time = models.DateTimeField()
     smoke = models.BooleanField()
     alcohol = models.BooleanField()
@@ -11,13 +11,15 @@ class Organ(models.Model):
     avg_sleep = models.PositiveIntegerField()
     daily_exercise = models.PositiveIntegerField()
     donor = models.OneToOneField('userauth.Donor', on_delete=models.CASCADE)
+    expired = models.BooleanField(default=False, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.organ
 
 
 class Post(models.Model):
-    title = models.CharField(max_length=50)
+    title = models.CharField(max_length=50, db_index=True)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -25,10 +27,121 @@ class Post(models.Model):
     image = models.ImageField(upload_to='images/', blank=True, null=True)
     image2 = models.ImageField(upload_to='images/', blank=True, null=True)
     image3 = models.ImageField(upload_to='images/', blank=True, null=True)
+    # Resized copies of each image field, filled in by main.media after save
+    derivatives = models.JSONField(default=dict, blank=True)
     done = models.BooleanField(default=False)
 
     def __str__(self):
         return self.title
+
+
+class ProfileVector(models.Model):
+    """Persisted L2-normalized TF-IDF vector of a donor or recipient profile"""
+    kind = models.CharField(max_length=10)
+    object_id = models.PositiveBigIntegerField()
+    model_version = models.CharField(max_length=40)
+    profile = models.TextField()
+    indices = models.JSONField()
+    weights = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('kind', 'object_id', 'model_version')
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id} ({self.model_version})'
+
+
+class RecipientMatch(models.Model):
+    """One of a recipient's current top-k donor organs, kept up to date by signals"""
+    recipient = models.ForeignKey('userauth.Recipient', on_delete=models.CASCADE, related_name='matches')
+    organ = models.ForeignKey(Organ, on_delete=models.CASCADE, related_name='recipient_matches')
+    score = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('recipient', 'organ')
+        indexes = [models.Index(fields=['recipient', '-score'])]
+
+    def __str__(self):
+        return f'{self.recipient_id} -> {self.organ_id} ({self.score:.3f})'
+
+
+class StatCounter(models.Model):
+    """
+    Waiting recipients or available organs for one (organ, blood group, city),
+    kept current by main.stats from model signals
+    """
+    METRIC_CHOICES = [
+        ('waiting', 'Waiting recipients'),
+        ('available', 'Available organs'),
+    ]
+
+    metric = models.CharField(max_length=10, choices=METRIC_CHOICES)
+    organ = models.CharField(max_length=50)
+    blood_group = models.CharField(max_length=3)
+    city = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('metric', 'organ', 'blood_group', 'city')
+
+    def __str__(self):
+        return f'{self.metric} {self.organ}/{self.blood_group}/{self.city}: {self.count}'
+
+
+class MatchJob(models.Model):
+    """A queued match, re-match, compatibility or match rebuild job run by the local worker pool"""
+    KIND_CHOICES = [
+        ('match', 'Match'),
+        ('rematch', 'Waitlist re-match'),
+        ('compatibility', 'Compatibility'),
+        ('rebuild_recipients', 'Rebuild recipient matches'),
+        ('rebuild_organs', 'Rebuild organ matches'),
+    ]
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='match_jobs')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    params = models.JSONField(default=dict)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    progress = models.FloatField(default=0.0)
+    result_count = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    cancel_requested = models.BooleanField(default=False)
+    # Bumped on every claim; a worker only writes while its attempt is current
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', '-priority', 'created_at'])]
+
+    def __str__(self):
+        return f'{self.kind} #{self.id} ({self.status})'
+
+
+class MatchJobResult(models.Model):
+    """A slice of a job's result rows [start, end), so a poll reads only the page it asks for"""
+    job = models.ForeignKey(MatchJob, on_delete=models.CASCADE, related_name='result_chunks')
+    attempt = models.PositiveIntegerField()
+    start = models.PositiveIntegerField()
+    end = models.PositiveIntegerField()
+    items = models.JSONField(default=list)
+
+    class Meta:
+        unique_together = ('job', 'attempt', 'start')
     
 
 
@@ -41,10 +154,11 @@ class Donor(models.Model):
     phone_number = models.CharField(max_length=15)
     birthday = models.DateField()
     address = models.CharField(max_length=100, null=True, blank=True)
-    city = models.CharField(max_length=50)
+    city = models.CharField(max_length=50, db_index=True)
     state = models.CharField(max_length=50)
     zipcode = models.CharField(max_length=10)
-    health_card_number = models.CharField(max_length=12)
+    health_card_number = models.CharField(max_length=12, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.user.username
@@ -53,13 +167,14 @@ class Recipient(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='recipient')
     phone_number = models.CharField(max_length=15)
     address = models.CharField(max_length=100)
-    city = models.CharField(max_length=50)
+    city = models.CharField(max_length=50, db_index=True)
     zipcode = models.CharField(max_length=10)
     state = models.CharField(max_length=50)
-    health_card_number = models.CharField(max_length=12)
+    health_card_number = models.CharField(max_length=12, db_index=True)
     birthday = models.DateField()
-    blood_group = models.CharField(max_length=3)
-    organ = models.CharField(max_length=50)
+    blood_group = models.CharField(max_length=3, db_index=True)
+    organ = models.CharField(max_length=50, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     
 
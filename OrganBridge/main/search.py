@@ -0,0 +1,191 @@
+# backend/donation/search.py
+"""
+Full-text search over Post.title and Post.content
+
+On SQLite the posts are indexed by an FTS5 table that uses main_post as its
+external content table; triggers keep it in sync with every insert, update
+and delete, including bulk queryset writes. On PostgreSQL an expression GIN
+index over to_tsvector(title || content) serves the same queries. Both are
+created after migrate (see MainConfig.ready) and can be rebuilt with the
+`rebuild_post_search` management command. Results are ranked (bm25 /
+ts_rank_cd), paginated with LIMIT/OFFSET and carry highlighted snippets.
+"""
+import html
+import re
+from django.db import connections, router
+from . import models
+
+FTS_SUFFIX = '_fts'
+PG_INDEX_SUFFIX = '_search_idx'
+PG_CONFIG = 'english'
+# Title matches weigh more than content matches
+TITLE_WEIGHT = 10.0
+CONTENT_WEIGHT = 1.0
+# Control characters mark highlights so user text can be escaped safely
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+def post_table():
+    return models.Post._meta.db_table
+
+
+def fts_table():
+    return post_table() + FTS_SUFFIX
+
+
+def sqlite_statements():
+    posts, fts = post_table(), fts_table()
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+        f"title, content, content='{posts}', content_rowid='id', tokenize='porter unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {posts} BEGIN "
+        f"INSERT INTO {fts}(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {posts} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF title, content ON {posts} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); "
+        f"INSERT INTO {fts}(rowid, title, content) VALUES (new.id, new.title, new.content); END",
+        f"INSERT INTO {fts}({fts}, rank) VALUES ('rank', 'bm25({TITLE_WEIGHT}, {CONTENT_WEIGHT})')",
+    ]
+
+
+def pg_document():
+    return f"to_tsvector('{PG_CONFIG}', coalesce(title, '') || ' ' || coalesce(content, ''))"
+
+
+def ensure_index(using='default', rebuild=False):
+    """Create the search index and its triggers if missing; optionally re-index every post"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            fts = fts_table()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [fts])
+            created = cursor.fetchone() is None
+            for statement in sqlite_statements():
+                cursor.execute(statement)
+            if created or rebuild:
+                cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        elif connection.vendor == 'postgresql':
+            index = post_table() + PG_INDEX_SUFFIX
+            if rebuild:
+                cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {post_table()} USING GIN (({pg_document()}))")
+        else:
+            return False
+    return True
+
+
+def create_search_index(sender, using='default', **kwargs):
+    """post_migrate handler"""
+    if router.allow_migrate_model(using, models.Post):
+        try:
+            ensure_index(using)
+        except Exception as e:
+            print(f"Error creating post search index: {e}")
+
+
+def fts_query(text):
+    """Quote every word so user input can't use FTS5 syntax; the last word matches as a prefix"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return ''
+    quoted = ['"{}"'.format(w.replace('"', '""')) for w in words]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def highlight(text):
+    """Escape a snippet and turn the highlight markers into <mark> tags"""
+    return html.escape(text or '').replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_posts(query, offset=0, limit=20):
+    """
+    Ranked full-text search over posts
+
+    Args:
+        query (str): Words to search for
+        offset (int): Number of results to skip
+        limit (int): Page size
+
+    Returns:
+        tuple: (total number of matches, list of result dicts best first)
+    """
+    connection = connections[router.db_for_read(models.Post)]
+    posts = post_table()
+    if connection.vendor == 'sqlite':
+        match = fts_query(query)
+        if not match:
+            return 0, []
+        fts = fts_table()
+        count_sql = f"SELECT count(*) FROM {fts} WHERE {fts} MATCH %s"
+        page_sql = (
+            f"SELECT p.id, p.author_id, p.created_at, p.done, -{fts}.rank, "
+            f"highlight({fts}, 0, %s, %s), snippet({fts}, 1, %s, %s, '…', 24) "
+            f"FROM {fts} JOIN {posts} p ON p.id = {fts}.rowid "
+            f"WHERE {fts} MATCH %s ORDER BY {fts}.rank LIMIT %s OFFSET %s"
+        )
+        count_params = [match]
+        page_params = [MARK_START, MARK_END, MARK_START, MARK_END, match, limit, offset]
+    elif connection.vendor == 'postgresql':
+        if not query.strip():
+            return 0, []
+        options = f'StartSel={MARK_START}, StopSel={MARK_END}, MaxWords=35, MinWords=15'
+        tsquery = f"websearch_to_tsquery('{PG_CONFIG}', %s)"
+        count_sql = f"SELECT count(*) FROM {posts} WHERE {pg_document()} @@ {tsquery}"
+        # Rank and paginate first so headlines are only built for one page
+        page_sql = (
+            f"SELECT id, author_id, created_at, done, rank, "
+            f"ts_headline('{PG_CONFIG}', title, q, %s), ts_headline('{PG_CONFIG}', content, q, %s) "
+            f"FROM (SELECT p.*, q, ts_rank_cd(setweight(to_tsvector('{PG_CONFIG}', coalesce(title, '')), 'A') || "
+            f"setweight(to_tsvector('{PG_CONFIG}', coalesce(content, '')), 'D'), q) AS rank "
+            f"FROM {posts} p, {tsquery} q WHERE {pg_document()} @@ q "
+            f"ORDER BY rank DESC, p.id LIMIT %s OFFSET %s) page ORDER BY rank DESC, id"
+        )
+        count_params = [query]
+        page_params = [options, options, query, limit, offset]
+    else:
+        return search_posts_orm(query, offset, limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(count_sql, count_params)
+        total = cursor.fetchone()[0]
+        cursor.execute(page_sql, page_params)
+        rows = cursor.fetchall()
+    return total, [
+        {
+            'id': post_id,
+            'author': author_id,
+            'created_at': created_at,
+            'done': bool(done),
+            'score': float(score),
+            'title': highlight(title),
+            'snippet': highlight(snippet),
+        }
+        for post_id, author_id, created_at, done, score, title, snippet in rows
+    ]
+
+
+def search_posts_orm(query, offset=0, limit=20):
+    """Unranked substring search for databases without a full-text index"""
+    from django.db.models import Q
+
+    words = re.findall(r'\w+', query)
+    if not words:
+        return 0, []
+    posts = models.Post.objects.all()
+    for word in words:
+        posts = posts.filter(Q(title__icontains=word) | Q(content__icontains=word))
+    total = posts.count()
+    return total, [
+        {
+            'id': post.id,
+            'author': post.author_id,
+            'created_at': post.created_at,
+            'done': post.done,
+            'score': 0.0,
+            'title': html.escape(post.title),
+            'snippet': html.escape(post.content[:200]),
+        }
+        for post in posts.order_by('-created_at')[offset:offset + limit]
+    ]
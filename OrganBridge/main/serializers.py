@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from . import models
+from .media import thumbnails
 from .serializers import serializers as userauth_serializers
 from .serializers import serializers as userauth_serializers
 from django.contrib.auth.models import User
@@ -15,10 +16,14 @@ class OrganSerializer(serializers.ModelSerializer):
 
 
 class PostSerializer(serializers.ModelSerializer):
+    thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = models.Post
-        fields = "__all__"
+        exclude = ('derivatives',)
+
+    def get_thumbnails(self, post):
+        return thumbnails(post, self.context.get('request'))
 
     
 
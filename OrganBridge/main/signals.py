@@ -0,0 +1,93 @@
+# backend/donation/signals.py
+"""
+Keep the RecipientMatch table and waitlist statistics in sync with Organ,
+Recipient and Donor changes, and Post image derivatives in sync with their
+uploads
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from userauth import models as userauth_models
+from . import matching, models, stats
+from .expiry import expiry_scheduler
+from .media import delete_files, needs_derivatives, schedule_derivatives
+
+
+def run_after_commit(func, *args):
+    """Queue a re-scoring step for the background worker once the write has committed"""
+    transaction.on_commit(lambda: matching.match_updates.submit(func, *args))
+
+
+@receiver(pre_save, sender=models.Organ)
+def organ_saving(sender, instance, **kwargs):
+    # Statistics deltas need the values the row had before this save
+    instance._stats_key = stats.stored_organ_key(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=models.Organ)
+def organ_saved(sender, instance, **kwargs):
+    stats.move('available', getattr(instance, '_stats_key', None), stats.organ_key(instance))
+    run_after_commit(matching.organ_saved, instance)
+    if expiry_scheduler.running and not instance.expired:
+        expiry_scheduler.schedule(instance)
+
+
+@receiver(pre_delete, sender=models.Organ)
+def organ_deleting(sender, instance, **kwargs):
+    # Cascades remove the match rows, so remember who held the organ first
+    instance._match_holders = list(
+        models.RecipientMatch.objects.filter(organ=instance).values_list('recipient_id', flat=True)
+    )
+    instance._stats_key = stats.stored_organ_key(instance.pk)
+
+
+@receiver(post_delete, sender=models.Organ)
+def organ_deleted(sender, instance, **kwargs):
+    stats.move('available', getattr(instance, '_stats_key', None), None)
+    expiry_scheduler.cancel(instance.id)
+    run_after_commit(matching.organ_removed, instance.id, getattr(instance, '_match_holders', []))
+
+
+@receiver(pre_save, sender=userauth_models.Recipient)
+def recipient_saving(sender, instance, **kwargs):
+    instance._stats_key = stats.stored_recipient_key(instance.pk) if instance.pk else None
+
+
+@receiver(post_save, sender=userauth_models.Recipient)
+def recipient_saved(sender, instance, **kwargs):
+    stats.move('waiting', getattr(instance, '_stats_key', None), stats.recipient_key(instance))
+    run_after_commit(matching.recipient_saved, instance)
+
+
+@receiver(post_delete, sender=userauth_models.Recipient)
+def recipient_deleted(sender, instance, **kwargs):
+    stats.move('waiting', stats.recipient_key(instance), None)
+    run_after_commit(matching.recipient_removed, instance.id)
+
+
+@receiver(pre_save, sender=userauth_models.Donor)
+def donor_saving(sender, instance, **kwargs):
+    # Available organs are counted under their donor's city
+    instance._stats_city = (userauth_models.Donor.objects.filter(pk=instance.pk)
+                            .values_list('city', flat=True).first()) if instance.pk else None
+
+
+@receiver(post_save, sender=userauth_models.Donor)
+def donor_saved(sender, instance, **kwargs):
+    old_city = getattr(instance, '_stats_city', None)
+    if old_city is None or stats.normalize_key('', '', old_city) == stats.normalize_key('', '', instance.city):
+        return
+    organ = models.Organ.objects.filter(donor=instance, expired=False).first()
+    if organ is not None:
+        stats.move('available', stats.organ_key(organ, old_city), stats.organ_key(organ, instance.city))
+
+
+@receiver(post_save, sender=models.Post)
+def post_saved(sender, instance, **kwargs):
+    if needs_derivatives(instance):
+        schedule_derivatives(instance.id)
+
+
+@receiver(post_delete, sender=models.Post)
+def post_deleted(sender, instance, **kwargs):
+    transaction.on_commit(lambda: delete_files((instance.derivatives or {}).values()))
@@ -0,0 +1,200 @@
+# backend/donation/stats.py
+"""
+Waitlist and supply statistics
+
+StatCounter holds one count per (metric, organ, blood group, city): waiting
+recipients and available (unexpired) organs. Signals turn every Recipient,
+Organ and Donor write into +1/-1 deltas applied in the writing transaction,
+so the counters commit or roll back with the row they describe. Bulk paths
+that bypass signals (expire_organs) apply their deltas explicitly, and
+reconcile() recomputes everything from the base tables to repair any drift.
+Reading the statistics touches only the counter table, whose size depends on
+the number of distinct keys and not on the number of donors or recipients.
+"""
+from collections import Counter
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+from userauth import models as userauth_models
+from . import models
+
+
+def normalize_key(organ, blood_group, city):
+    return (
+        str(organ or '').strip().lower(),
+        str(blood_group or '').strip().upper(),
+        str(city or '').strip().lower(),
+    )
+
+
+def recipient_key(recipient):
+    return normalize_key(recipient.organ, recipient.blood_group, recipient.city)
+
+
+def organ_key(organ, city=None):
+    """Key an organ is counted under, or None once it has expired"""
+    if organ.expired:
+        return None
+    if city is None:
+        city = organ.donor.city if organ.donor_id else ''
+    return normalize_key(organ.organ, organ.blood_group, city)
+
+
+def stored_recipient_key(pk):
+    row = userauth_models.Recipient.objects.filter(pk=pk).values_list('organ', 'blood_group', 'city').first()
+    return normalize_key(*row) if row else None
+
+
+def stored_organ_key(pk):
+    row = models.Organ.objects.filter(pk=pk).values_list(
+        'organ', 'blood_group', 'donor__city', 'expired'
+    ).first()
+    return normalize_key(*row[:3]) if row and not row[3] else None
+
+
+def apply_deltas(metric, deltas):
+    """
+    Add signed deltas to counters, creating missing ones
+
+    Args:
+        metric (str): 'waiting' or 'available'
+        deltas (dict): (organ, blood_group, city) -> change in count
+    """
+    with transaction.atomic():
+        for (organ, blood_group, city), delta in sorted(deltas.items()):
+            if not delta:
+                continue
+            counters = models.StatCounter.objects.filter(
+                metric=metric, organ=organ, blood_group=blood_group, city=city
+            )
+            if counters.update(count=F('count') + delta, updated_at=timezone.now()):
+                continue
+            try:
+                with transaction.atomic():
+                    models.StatCounter.objects.create(
+                        metric=metric, organ=organ, blood_group=blood_group, city=city, count=delta
+                    )
+            except IntegrityError:
+                # Another writer created the counter first
+                counters.update(count=F('count') + delta, updated_at=timezone.now())
+
+
+def move(metric, old_key, new_key):
+    """Count a row under new_key instead of old_key; either may be None"""
+    if old_key == new_key:
+        return
+    deltas = Counter()
+    if old_key is not None:
+        deltas[old_key] -= 1
+    if new_key is not None:
+        deltas[new_key] += 1
+    apply_deltas(metric, deltas)
+
+
+def organs_expired(keys):
+    """Drop a batch of organs that were marked expired with a bulk update"""
+    apply_deltas('available', Counter({key: -n for key, n in Counter(keys).items()}))
+
+
+def current_counts():
+    """Recompute every counter from the base tables"""
+    counts = {'waiting': Counter(), 'available': Counter()}
+    for row in userauth_models.Recipient.objects.values('organ', 'blood_group', 'city').annotate(n=Count('id')):
+        counts['waiting'][normalize_key(row['organ'], row['blood_group'], row['city'])] += row['n']
+    organs = models.Organ.objects.filter(expired=False).values('organ', 'blood_group', 'donor__city')
+    for row in organs.annotate(n=Count('id')):
+        counts['available'][normalize_key(row['organ'], row['blood_group'], row['donor__city'])] += row['n']
+    return counts
+
+
+def reconcile():
+    """
+    Rewrite the counters from a full recount of the base tables
+
+    Existing counters are locked for the duration, so deltas from concurrent
+    writes wait and apply on top of the recount instead of being overwritten.
+
+    Returns:
+        dict: Per metric, how many counters were corrected, added and removed
+    """
+    report = {}
+    with transaction.atomic():
+        stored = {
+            (c.metric, c.organ, c.blood_group, c.city): c
+            for c in models.StatCounter.objects.select_for_update()
+        }
+        for metric, counts in current_counts().items():
+            corrected = added = removed = 0
+            for key, n in counts.items():
+                counter = stored.pop((metric,) + key, None)
+                if counter is None:
+                    models.StatCounter.objects.create(
+                        metric=metric, organ=key[0], blood_group=key[1], city=key[2], count=n
+                    )
+                    added += 1
+                elif counter.count != n:
+                    counter.count = n
+                    counter.save(update_fields=['count', 'updated_at'])
+                    corrected += 1
+            stale = [c.pk for k, c in stored.items() if k[0] == metric]
+            if stale:
+                removed = models.StatCounter.objects.filter(pk__in=stale).delete()[0]
+            report[metric] = {'corrected': corrected, 'added': added, 'removed': removed}
+    return report
+
+
+def ratio(supply, demand):
+    return round(supply / demand, 4) if demand else None
+
+
+def summary(organ=None):
+    """
+    Waiting recipients by organ and blood group, available organs by organ and
+    city, and supply/demand ratios, read from the counter table only
+
+    Args:
+        organ (str): Restrict to one organ type
+
+    Returns:
+        dict: The statistics payload served by the stats endpoint
+    """
+    counters = models.StatCounter.objects.exclude(count=0)
+    if organ:
+        counters = counters.filter(organ=normalize_key(organ, '', '')[0])
+
+    waiting, available, by_group = {}, {}, {}
+    totals = {'waiting': 0, 'available': 0}
+    updated_at = None
+    for c in counters.values_list('metric', 'organ', 'blood_group', 'city', 'count', 'updated_at'):
+        metric, organ_type, blood_group, city, count, changed = c
+        totals[metric] += count
+        updated_at = max(updated_at, changed) if updated_at else changed
+        group = by_group.setdefault((organ_type, blood_group), {'waiting': 0, 'available': 0})
+        group[metric] += count
+        if metric == 'waiting':
+            per_group = waiting.setdefault(organ_type, {})
+            per_group[blood_group] = per_group.get(blood_group, 0) + count
+        else:
+            per_city = available.setdefault(organ_type, {})
+            per_city[city] = per_city.get(city, 0) + count
+
+    organs = {}
+    for organ_type in sorted(set(waiting) | set(available)):
+        demand = sum(waiting.get(organ_type, {}).values())
+        supply = sum(available.get(organ_type, {}).values())
+        organs[organ_type] = {
+            'waiting': demand,
+            'available': supply,
+            'supply_demand_ratio': ratio(supply, demand),
+            'waiting_by_blood_group': dict(sorted(waiting.get(organ_type, {}).items())),
+            'available_by_city': dict(sorted(available.get(organ_type, {}).items())),
+            'supply_demand_by_blood_group': {
+                blood_group: ratio(group['available'], group['waiting'])
+                for (o, blood_group), group in sorted(by_group.items()) if o == organ_type
+            },
+        }
+    return {
+        'totals': dict(totals, supply_demand_ratio=ratio(totals['available'], totals['waiting'])),
+        'organs': organs,
+        'updated_at': updated_at,
+    }
@@ -1,3 +1,1183 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import pandas as pd
+from django.contrib.auth.models import User
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import ml_registry
+from ml_admission import AdmissionController, AdmissionRejected
+from ml_ann import IVFIndex, to_unit_rows
+from ml_dispatcher import MatchDispatcher
+from ml_encoder import SEPARATOR, ProfileEncoder
+from ml_memory import deep_sizeof, sparse_nbytes
+from ml_quantized import QuantizedStore
+from ml_querylog import QueryLog, read_log, replay
+from ml_services import OrganMatchingService, parse_match_count
+from ml_sharding import ShardedIndex, data_regions, normalize_region
+from userauth import models as userauth_models
+from . import db, expiry, export, jobs, matching, media, models, search, stats, views
+
+CITIES = ['Seattle', 'Detroit', 'Phoenix', 'Houston']
+BLOOD_TYPES = ['A', 'B', 'O', 'AB']
+
+
+def make_donor_data(n=40):
+    """Small donor dataset in the training CSV layout, with its category column"""
+    data = pd.DataFrame({
+        'City': [CITIES[i % len(CITIES)] for i in range(n)],
+        'Gender': ['Male' if i % 2 else 'Female' for i in range(n)],
+        'Race': ['White' if i % 3 else 'Asian' for i in range(n)],
+        'Age': [str(20 + i) for i in range(n)],
+        'Blood Type': [BLOOD_TYPES[(i // len(CITIES)) % len(BLOOD_TYPES)] for i in range(n)],
+        'PosNeg': ['Positive' if i % 5 else 'Negative' for i in range(n)],
+        'Smoke': ['STrue' if i % 4 == 0 else 'SFalse' for i in range(n)],
+        'Drug': ['DFalse'] * n,
+        'Alcohol': ['ATrue' if i % 6 == 0 else 'AFalse' for i in range(n)],
+        'AvgSleep': [str(5 + i % 4) for i in range(n)],
+        'Delta': list(range(n)),
+    })
+    data['category'] = data['City'].str.cat(
+        data[['Gender', 'Race', 'Age', 'Blood Type', 'PosNeg', 'Smoke', 'Drug', 'Alcohol', 'AvgSleep']],
+        sep=',',
+    )
+    return data
+
+
+def make_service(backend='exact', **vectorizer_options):
+    """Matching service fitted on make_donor_data, like train_model.py but small"""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    data = make_donor_data()
+    tf_model = TfidfVectorizer(stop_words='english', **vectorizer_options)
+    tf_matrix = tf_model.fit_transform(data['category'])
+    return OrganMatchingService.from_components(tf_model, tf_matrix, data.drop(columns=['category']),
+                                                backend=backend)
+
+
+def make_donor(name, city):
+    user = User.objects.create_user(name, password='secret')
+    return userauth_models.Donor.objects.create(
+        user=user, phone_number='5550000', birthday=date(1980, 1, 1), city=city,
+        state='WA', zipcode='98101', health_card_number=name[:12],
+    )
+
+
+def make_organ(donor, blood_group='O', organ='kidney', **fields):
+    return models.Organ.objects.create(
+        donor=donor, blood_group=blood_group, organ=organ, organ_date_time=timezone.now(),
+        smoke=False, alcohol=False, drug=False, avg_sleep=7, daily_exercise=1, **fields,
+    )
+
+
+def make_recipient(name, city, blood_group='O', organ='kidney'):
+    user = User.objects.create_user(name, password='secret')
+    return userauth_models.Recipient.objects.create(
+        user=user, phone_number='5550000', address='1 Main St', city=city, zipcode='98101',
+        state='WA', health_card_number=name[:12], birthday=date(1980, 1, 1),
+        blood_group=blood_group, organ=organ,
+    )
+
+
+class ParseMatchCountTests(SimpleTestCase):
+    def test_clamps_to_range(self):
+        self.assertEqual(parse_match_count('5'), 5)
+        self.assertEqual(parse_match_count(0), 1)
+        self.assertEqual(parse_match_count(-3), 1)
+        self.assertEqual(parse_match_count(10 ** 6, limit=50), 50)
+
+    def test_rejects_non_integers(self):
+        for value in ('abc', None, 2.5, [], True):
+            with self.assertRaises(ValueError):
+                parse_match_count(value)
+
+
+class FindMatchesBatchTests(SimpleTestCase):
+    def test_bad_count_only_fails_its_own_request(self):
+        service = make_service()
+        profile = {'city': 'Seattle', 'blood_group': 'A', 'organ': 'kidney'}
+        results = service.find_matches_batch([profile, profile, profile], [3, 'abc', 0])
+        self.assertEqual(len(results[0]), 3)
+        self.assertEqual(results[1], [])
+        self.assertEqual(len(results[2]), 1)
+
+    def test_batch_matches_single_queries(self):
+        service = make_service()
+        profiles = [{'city': city, 'blood_group': 'O', 'organ': 'kidney'} for city in CITIES]
+        batched = service.find_matches_batch(profiles, [5] * len(profiles))
+        for profile, matches in zip(profiles, batched):
+            self.assertEqual(matches, service.find_matches(profile, 5))
+
+
+class FakeBatchService:
+    """find_matches_batch that records its batches and can be held or made to fail"""
+
+    def __init__(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+        self.scoring = threading.Event()
+        self.error = None
+
+    def find_matches_batch(self, profiles, counts):
+        self.batches.append([p['city'] for p in profiles])
+        self.scoring.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return [[{'city': p['city'], 'n': n}] for p, n in zip(profiles, counts)]
+
+
+class MatchDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.service = FakeBatchService()
+
+    def submit(self, dispatcher, cities):
+        """Call find_matches from one thread per city; returns the threads' outcomes"""
+        outcomes = [None] * len(cities)
+
+        def call(i):
+            try:
+                outcomes[i] = dispatcher.find_matches({'city': cities[i]}, 3)
+            except Exception as e:
+                outcomes[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(len(cities))]
+        for t in threads:
+            t.start()
+        return threads, outcomes
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def hold_worker(self, dispatcher):
+        """Keep the worker busy on one batch so later queries queue up behind it"""
+        self.service.release.clear()
+        threads, _ = self.submit(dispatcher, ['Boise'])
+        self.assertTrue(self.service.scoring.wait(5))
+        return threads
+
+    def finish(self, *thread_lists):
+        self.service.release.set()
+        for threads in thread_lists:
+            for t in threads:
+                t.join(5)
+
+    def test_identical_queries_share_one_computation(self):
+        dispatcher = MatchDispatcher(self.service, window_ms=1)
+        held = self.hold_worker(dispatcher)
+        threads, outcomes = self.submit(dispatcher, ['Seattle'] * 5)
+        self.wait_for(lambda: dispatcher.stats()['requests'] == 6)
+        self.finish(held, threads)
+        self.assertEqual(self.service.batches, [['Boise'], ['Seattle']])
+        self.assertEqual(outcomes, [[{'city': 'Seattle', 'n': 3}]] * 5)
+        self.assertEqual(dispatcher.stats()['coalesced'], 4)
+
+    def test_batches_flush_at_max_batch_or_after_the_window(self):
+        dispatcher = MatchDispatcher(self.service, window_ms=5, max_batch=2)
+        held = self.hold_worker(dispatcher)
+        threads, outcomes = self.submit(dispatcher, CITIES + ['Boston'])
+        self.wait_for(lambda: dispatcher.stats()['pending'] == 5)
+        self.finish(held, threads)
+        self.assertEqual([len(b) for b in self.service.batches], [1, 2, 2, 1])
+        self.assertEqual([o[0]['city'] for o in outcomes], CITIES + ['Boston'])
+
+        # A lone query is not held for a full batch, only for the window
+        started = time.perf_counter()
+        self.assertEqual(dispatcher.find_matches({'city': 'Atlanta'}, 1), [{'city': 'Atlanta', 'n': 1}])
+        self.assertGreaterEqual(time.perf_counter() - started, 0.005)
+        self.assertEqual(self.service.batches[-1], ['Atlanta'])
+
+    def test_batch_error_reaches_every_waiting_caller(self):
+        dispatcher = MatchDispatcher(self.service, window_ms=1, max_batch=8)
+        held = self.hold_worker(dispatcher)
+        self.service.error = RuntimeError('index unavailable')
+        threads, outcomes = self.submit(dispatcher, ['Seattle', 'Seattle', 'Detroit'])
+        self.wait_for(lambda: dispatcher.stats()['requests'] == 4)
+        self.finish(held, threads)
+        self.assertEqual(len(self.service.batches), 2)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, RuntimeError)
+
+        # The failed keys were retired, so the same query runs again
+        self.service.error = None
+        self.assertEqual(dispatcher.find_matches({'city': 'Seattle'}, 3), [{'city': 'Seattle', 'n': 3}])
+
+
+class ProfileVectorCacheTests(TestCase):
+    def test_batch_lookup_reads_the_database_once(self):
+        from ml_vectors import ProfileVectorCache
+
+        writer = ProfileVectorCache(persist=True)
+        writer.put_many('donor', 'v1', [(i, f'profile {i}', ([i], [1.0])) for i in range(20)])
+        reader = ProfileVectorCache(persist=True)
+        with self.assertNumQueries(1):
+            found = reader.get_many('donor', 'v1', [(i, f'profile {i}') for i in range(25)])
+        self.assertEqual(found[:20], [([i], [1.0]) for i in range(20)])
+        self.assertEqual(found[20:], [None] * 5)
+        self.assertEqual(reader.counters['db_hits'], 20)
+
+    def test_changed_profile_is_a_miss_and_is_overwritten(self):
+        from main.models import ProfileVector
+        from ml_vectors import ProfileVectorCache
+
+        cache = ProfileVectorCache(persist=True)
+        cache.put('donor', 1, 'v1', 'seattle', ([1], [1.0]))
+        self.assertIsNone(ProfileVectorCache(persist=True).get('donor', 1, 'v1', 'detroit'))
+        cache.put('donor', 1, 'v1', 'detroit', ([2], [1.0]))
+        row = ProfileVector.objects.get(kind='donor', object_id=1, model_version='v1')
+        self.assertEqual((row.profile, row.indices), ('detroit', [2]))
+
+    def test_prune_keeps_only_deployed_versions(self):
+        from main.models import ProfileVector
+        from ml_vectors import ProfileVectorCache, prune_profile_vectors
+
+        cache = ProfileVectorCache(persist=True)
+        cache.put('donor', 1, 'old', 'seattle', ([1], [1.0]))
+        cache.put('donor', 1, 'new', 'seattle', ([1], [1.0]))
+        self.assertEqual(prune_profile_vectors({'new'}), 1)
+        self.assertEqual(list(ProfileVector.objects.values_list('model_version', flat=True)), ['new'])
+
+
+@override_settings(MATCH_UPDATES_ASYNC=False, RECIPIENT_MATCH_TOP_K=2, PROFILE_VECTOR_CACHE_PERSIST=False)
+class RecipientMatchTests(TestCase):
+    """Single-letter blood groups are not TF-IDF tokens, so only city and AB score"""
+
+    def setUp(self):
+        for target, value in (('organ_matching_service', make_service()),
+                              ('match_index', matching.MatchIndex())):
+            patcher = mock.patch.object(matching, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def matches(self, recipient):
+        return list(models.RecipientMatch.objects.filter(recipient=recipient)
+                    .order_by('-score', 'organ_id').values_list('organ_id', flat=True))
+
+    def test_recipient_gets_top_k_matching_organs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_organ(make_donor('d1', 'Seattle'))
+            second = make_organ(make_donor('d2', 'Seattle'))
+            make_organ(make_donor('d3', 'Detroit'))
+            recipient = make_recipient('r1', 'Seattle', blood_group='AB')
+        self.assertEqual(self.matches(recipient), [first.id, second.id])
+
+    def test_better_organ_is_merged_and_backfilled_on_delete(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_organ(make_donor('d1', 'Seattle'))
+            second = make_organ(make_donor('d2', 'Seattle'))
+            recipient = make_recipient('r1', 'Seattle', blood_group='AB')
+        with self.captureOnCommitCallbacks(execute=True):
+            best = make_organ(make_donor('d3', 'Seattle'), blood_group='AB')
+        matches = self.matches(recipient)
+        self.assertEqual(len(matches), 2)
+        self.assertEqual(matches[0], best.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            best.delete()
+        self.assertEqual(self.matches(recipient), [first.id, second.id])
+
+    def test_recipient_change_rescores(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            seattle = make_organ(make_donor('d1', 'Seattle'))
+            detroit = make_organ(make_donor('d2', 'Detroit'))
+            recipient = make_recipient('r1', 'Seattle')
+        self.assertEqual(self.matches(recipient), [seattle.id])
+        with self.captureOnCommitCallbacks(execute=True):
+            recipient.city = 'Detroit'
+            recipient.save()
+        self.assertEqual(self.matches(recipient), [detroit.id])
+
+    def test_changes_during_a_load_survive_the_swap(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            organ = make_organ(make_donor('d1', 'Seattle'))
+            make_recipient('r1', 'Seattle')
+        index = matching.match_index
+        real_vectors = matching.recipient_vectors
+
+        def update_mid_load(recipients):
+            # Runs after the organ rows were read, before the swap
+            index.update('organ', organ.id, None)
+            return real_vectors(recipients)
+
+        with mock.patch.object(matching, 'recipient_vectors', update_mid_load):
+            index.load()
+        self.assertNotIn(organ.id, index.organs)
+
+    def test_expired_organs_are_dropped_and_backfilled(self):
+        from .expiry import expire_organs
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_organ(make_donor('d1', 'Seattle'))
+            second = make_organ(make_donor('d2', 'Seattle'))
+            third = make_organ(make_donor('d3', 'Seattle'))
+            recipient = make_recipient('r1', 'Seattle')
+        self.assertEqual(self.matches(recipient), [first.id, second.id])
+        expire_organs([first.id])
+        self.assertEqual(self.matches(recipient), [second.id, third.id])
+
+    def test_equal_scores_keep_the_older_organs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            recipient = make_recipient('r1', 'Seattle')
+        with self.captureOnCommitCallbacks(execute=True):
+            oldest = make_organ(make_donor('d1', 'Seattle'))
+            older = make_organ(make_donor('d2', 'Seattle'))
+            make_organ(make_donor('d3', 'Seattle'))
+        # Merged one at a time, the newest organ does not displace an equal score
+        self.assertEqual(self.matches(recipient), [oldest.id, older.id])
+        # and a full re-score breaks the tie the same way
+        with self.captureOnCommitCallbacks(execute=True):
+            recipient.save()
+        self.assertEqual(self.matches(recipient), [oldest.id, older.id])
+
+    def test_organ_expired_by_another_process_is_not_matched(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_organ(make_donor('d1', 'Seattle'))
+            second = make_organ(make_donor('d2', 'Seattle'))
+            recipient = make_recipient('r1', 'Seattle')
+        # The expiry process updates the row; this process's index still holds it
+        models.Organ.objects.filter(pk=first.pk).update(expired=True)
+        with mock.patch.object(matching.match_index, 'drop_expired'), \
+                self.captureOnCommitCallbacks(execute=True):
+            recipient.save()
+        self.assertEqual(self.matches(recipient), [second.id])
+        self.assertNotIn(first.id, matching.match_index.organs)
+
+    def test_index_drops_organs_expired_elsewhere(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            organ = make_organ(make_donor('d1', 'Seattle'))
+        models.Organ.objects.filter(pk=organ.pk).update(expired=True, updated_at=timezone.now())
+        matching.match_index.ensure_loaded()
+        self.assertNotIn(organ.id, matching.match_index.organs)
+
+    def test_view_hides_expired_organs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            organ = make_organ(make_donor('d1', 'Seattle'))
+            recipient = make_recipient('r1', 'Seattle')
+        models.Organ.objects.filter(pk=organ.pk).update(expired=True)
+        request = APIRequestFactory().get('/recipient-matches/')
+        force_authenticate(request, user=recipient.user)
+        response = views.RecipientMatchesView.as_view()(request)
+        self.assertEqual(response.data['matches'], [])
+
+
+class OrganModelRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, 'heart'))
+        with open(os.path.join(self.root, 'heart', 'tf_model.pkl'), 'wb') as f:
+            f.write(b'not a pickle')
+
+    def test_failed_load_is_not_retried_on_every_request(self):
+        default = make_service()
+        registry = ml_registry.OrganModelRegistry(default, model_root=self.root, retry_after=300)
+        self.assertIs(registry.get('heart'), default)
+        self.assertIs(registry.get('heart'), default)
+        stats = registry.stats()
+        self.assertEqual(stats['load_errors'], 1)
+        self.assertEqual(stats['failed'], ['heart'])
+
+    def test_evicted_services_are_closed(self):
+        registry = ml_registry.OrganModelRegistry(make_service(), model_root=self.root, memory_budget=0)
+        first, second = make_service(), make_service()
+        for service in (first, second):
+            service.shard_index = mock.Mock()
+        registry._models['liver'] = (first, 1)
+        registry._models['lung'] = (second, 1)
+        registry.evict('liver')
+        first.shard_index.close.assert_called_once_with()
+        second.shard_index.close.assert_not_called()
+        self.assertEqual(list(registry._models), ['lung'])
+
+
+@override_settings(MATCH_JOB_LEASE_SECONDS=60, MATCH_JOB_MAX_ATTEMPTS=2, MATCH_JOB_CHUNK_SIZE=3)
+class MatchJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('staff', password='secret', is_staff=True)
+
+    def run_rows(self, n):
+        def handler(params, context):
+            context.emit([{'row': i} for i in range(n)])
+        return mock.patch.dict(jobs.HANDLERS, {'match': handler})
+
+    def poll(self, job, **params):
+        request = APIRequestFactory().get(f'/jobs/{job.pk}/', params)
+        force_authenticate(request, user=self.user)
+        return views.MatchJobDetailView.as_view()(request, pk=job.pk)
+
+    def test_results_are_stored_and_paged_in_chunks(self):
+        jobs.submit(self.user, 'match', {})
+        job = jobs.claim_next()
+        with self.run_rows(8):
+            jobs.run_job(job)
+        self.assertEqual(models.MatchJobResult.objects.filter(job=job).count(), 3)
+        response = self.poll(job, offset=2, limit=4)
+        self.assertEqual([r['row'] for r in response.data['results']], [2, 3, 4, 5])
+        self.assertEqual(response.data['next_offset'], 6)
+        self.assertIsNone(self.poll(job, offset=6, limit=4).data['next_offset'])
+
+    def test_bad_offset_is_a_client_error(self):
+        job = jobs.submit(self.user, 'match', {})
+        with self.run_rows(1):
+            jobs.run_job(jobs.claim_next())
+        self.assertEqual(self.poll(job, offset='x').status_code, 400)
+
+    def test_bad_priority_is_a_client_error(self):
+        for priority in ('high', None, []):
+            request = APIRequestFactory().post('/jobs/', {'kind': 'rematch', 'priority': priority}, format='json')
+            force_authenticate(request, user=self.user)
+            self.assertEqual(views.MatchJobsView.as_view()(request).status_code, 400, priority)
+        self.assertFalse(models.MatchJob.objects.exists())
+
+    def test_job_of_a_dead_worker_is_reclaimed(self):
+        job = jobs.submit(self.user, 'match', {})
+        lost = jobs.claim_next()
+        models.MatchJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(seconds=120))
+        retried = jobs.claim_next()
+        self.assertEqual((retried.pk, retried.attempts), (job.pk, 2))
+
+        # The first worker comes back: it may not overwrite the retry
+        with self.run_rows(2):
+            jobs.run_job(lost)
+        self.assertEqual(models.MatchJob.objects.get(pk=job.pk).status, 'running')
+
+        models.MatchJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(jobs.reclaim_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(db, '_replica_cycle', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = db.ReadReplicaRouter()
+
+    def test_one_replica_per_block(self):
+        with db.use_replica():
+            first = {self.router.db_for_read(models.Organ) for _ in range(5)}
+            with db.use_replica():
+                self.assertEqual(self.router.db_for_read(userauth_models.Recipient), 'replica1')
+        with db.use_replica():
+            second = self.router.db_for_read(models.Organ)
+        self.assertEqual(first, {'replica1'})
+        self.assertEqual(second, 'replica2')
+        self.assertIsNone(self.router.db_for_read(models.Organ))
+        with db.use_replica():
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_missing_row_falls_back_to_the_primary(self):
+        routed = []
+
+        def first():
+            # The row exists only on the primary
+            routed.append(db.current_replica())
+            return None if routed[-1] else 'row'
+
+        queryset = mock.Mock()
+        queryset.first.side_effect = first
+        with db.use_replica():
+            self.assertEqual(db.first_or_primary(queryset), 'row')
+            self.assertIsNone(self.router.db_for_read(models.Organ))
+        self.assertEqual(routed, ['replica1', None])
+
+
+class MediaServingTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with open(os.path.join(root, 'photo.jpg'), 'wb') as f:
+            f.write(b'0123456789')
+        settings = override_settings(MEDIA_ROOT=root, MEDIA_SENDFILE_HEADER=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, **headers):
+        response = media.serve_media(RequestFactory().get('/media/photo.jpg', **headers), 'photo.jpg')
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_whole_file(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_ranges(self):
+        response, body = self.get(HTTP_RANGE='bytes=2-5')
+        self.assertEqual((response.status_code, body), (206, b'2345'))
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        response, body = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual((response.status_code, body), (206, b'789'))
+        response, _ = self.get(HTTP_RANGE='bytes=10-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+        # An If-Range that does not match wins over an unsatisfiable range
+        response, body = self.get(HTTP_RANGE='bytes=10-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+        etag = self.get()[0]['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=etag)[0].status_code, 416)
+
+    def test_conditional_requests(self):
+        etag = self.get()[0]['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag)[0].status_code, 304)
+        # A stale If-Range gets the whole current file
+        response, body = self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"stale"')
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+        self.assertEqual(self.get(HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE=etag)[0].status_code, 206)
+
+    def test_empty_images_need_no_derivatives(self):
+        post = SimpleNamespace(derivatives=None, **{f: SimpleNamespace(name=None) for f in media.IMAGE_FIELDS})
+        self.assertFalse(media.needs_derivatives(post))
+        post.image.name = 'posts/a.jpg'
+        self.assertTrue(media.needs_derivatives(post))
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def controller(self, capacity, max_wait=5.0):
+        return AdmissionController(capacity=capacity, classes={
+            'urgent': {'priority': 0, 'concurrency': 1, 'queue': 4, 'max_wait': max_wait},
+            'batch': {'priority': 2, 'concurrency': 2, 'queue': 1, 'max_wait': max_wait},
+        })
+
+    def start_waiter(self, controller, class_name, admitted):
+        """Queue one acquire on a thread; it records its class once admitted, then releases"""
+        def wait():
+            ticket = controller.acquire(class_name)
+            admitted.append(class_name)
+            controller.release(ticket)
+
+        queued = len(controller.classes[class_name].waiters)
+        thread = threading.Thread(target=wait)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        deadline = time.monotonic() + 5
+        while len(controller.classes[class_name].waiters) == queued and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return thread
+
+    def test_freed_slot_goes_to_the_highest_priority_waiter(self):
+        controller = self.controller(capacity=1)
+        held = controller.acquire('batch')
+        admitted = []
+        threads = [self.start_waiter(controller, 'batch', admitted),
+                   self.start_waiter(controller, 'urgent', admitted)]
+        controller.release(held)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(admitted, ['urgent', 'batch'])
+
+    def test_class_at_its_limit_does_not_block_lower_classes(self):
+        controller = self.controller(capacity=4)
+        held = controller.acquire('urgent')
+        admitted = []
+        thread = self.start_waiter(controller, 'urgent', admitted)
+        # Urgent has a waiter but no room of its own; batch may use the free capacity
+        ticket = controller.acquire('batch')
+        self.assertTrue(ticket.granted)
+        controller.release(ticket)
+        controller.release(held)
+        thread.join(5)
+        self.assertEqual(admitted, ['urgent'])
+
+    def test_sheds_when_queue_is_full_or_wait_too_long(self):
+        controller = self.controller(capacity=1)
+        held = controller.acquire('batch')
+        self.start_waiter(controller, 'batch', [])
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire('batch')
+        self.assertEqual(rejected.exception.reason, 'queue full')
+
+        controller.service_time = 60.0
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire('urgent')
+        self.assertEqual(rejected.exception.reason, 'overloaded')
+        self.assertGreaterEqual(rejected.exception.retry_after, 60)
+        controller.service_time = 0.0
+        controller.release(held)
+
+    def test_waiter_times_out(self):
+        controller = self.controller(capacity=1, max_wait=0.05)
+        held = controller.acquire('batch')
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire('urgent')
+        self.assertEqual(rejected.exception.reason, 'timed out waiting')
+        self.assertEqual(controller.classes['urgent'].counters['timed_out'], 1)
+        self.assertFalse(controller.classes['urgent'].waiters)
+        controller.release(held)
+
+
+class ExportEncoderTests(SimpleTestCase):
+    columns = ['id', 'city', 'smoke', 'born', 'updated_at']
+    types = ['int', 'str', 'bool', 'date', 'datetime']
+    rows = [
+        (1, 'Seattle', True, date(1980, 1, 2), datetime(2024, 5, 1, 12, 0, tzinfo=dt_timezone.utc)),
+        (2, 'New York, NY', False, None, None),
+    ]
+
+    def test_csv(self):
+        text = b''.join(export.encode('csv', self.columns, self.types, iter(self.rows))).decode()
+        parsed = list(csv.reader(io.StringIO(text)))
+        self.assertEqual(parsed[0], self.columns)
+        self.assertEqual(parsed[1], ['1', 'Seattle', 'True', '1980-01-02', '2024-05-01 12:00:00+00:00'])
+        self.assertEqual(parsed[2], ['2', 'New York, NY', 'False', '', ''])
+
+    def test_ndjson(self):
+        lines = b''.join(export.encode('ndjson', self.columns, self.types, iter(self.rows))).splitlines()
+        self.assertEqual(json.loads(lines[0]), {
+            'id': 1, 'city': 'Seattle', 'smoke': True, 'born': '1980-01-02', 'updated_at': '2024-05-01T12:00:00+00:00',
+        })
+        self.assertEqual(json.loads(lines[1])['born'], None)
+
+    def test_chunks_stream_every_row(self):
+        rows = ((i, 'Seattle', False, None, None) for i in range(export.CHUNK_SIZE * 2 + 1))
+        pieces = list(export.encode('ndjson', self.columns, self.types, rows))
+        self.assertEqual(len(pieces), 3)
+        self.assertEqual(sum(piece.count(b'\n') for piece in pieces), export.CHUNK_SIZE * 2 + 1)
+
+    def test_gzip_stream(self):
+        pieces = export.encode('csv', self.columns, self.types, iter(self.rows))
+        plain = b''.join(export.encode('csv', self.columns, self.types, iter(self.rows)))
+        self.assertEqual(gzip.decompress(b''.join(export.gzip_stream(pieces))), plain)
+
+    def test_training_row(self):
+        row = export.training_row((7, False, datetime(2024, 1, 1), date(1980, 6, 1), 'ab-', True, False, True, 8, 'Seattle'))
+        self.assertEqual(row, (7, 'alive', 43, 'AB', 'Neg', 'STrue', 'DFalse', 'ATrue', 8, 'Seattle'))
+
+
+@override_settings(EXPORT_WATERMARK_OVERLAP_SECONDS=60)
+class ExportWatermarkTests(TestCase):
+    def test_watermark_is_the_newest_row_and_next_run_overlaps(self):
+        self.assertIsNone(export.new_watermark('donors'))
+        donor = make_donor('d1', 'Seattle')
+        watermark = export.new_watermark('donors')
+        self.assertEqual(watermark, userauth_models.Donor.objects.get(pk=donor.pk).updated_at)
+
+        # A row stamped just before the watermark but committed after it is still exported
+        userauth_models.Donor.objects.filter(pk=donor.pk).update(updated_at=watermark - timedelta(seconds=30))
+        _, _, rows = export.export_rows('donors', since=watermark)
+        self.assertEqual([r[0] for r in rows], [donor.pk])
+        _, _, rows = export.export_rows('donors', since=watermark + timedelta(seconds=61))
+        self.assertEqual(list(rows), [])
+
+
+class MemoryAccountingTests(SimpleTestCase):
+    def test_sparse_values_count_their_arrays(self):
+        from scipy import sparse
+
+        matrix = sparse.random(200, 500, density=0.05, format='csr', random_state=0)
+        self.assertEqual(sparse_nbytes(matrix), matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)
+        self.assertGreaterEqual(deep_sizeof({'matrix': matrix}), sparse_nbytes(matrix))
+        coo = matrix.tocoo()
+        self.assertEqual(sparse_nbytes(coo), coo.data.nbytes + coo.row.nbytes + coo.col.nbytes)
+
+    def test_bad_parameters_are_client_errors(self):
+        factory = APIRequestFactory()
+        staff = User(username='staff', is_staff=True)
+        request = factory.get('/memory/', {'top': 'many'})
+        force_authenticate(request, user=staff)
+        self.assertEqual(views.MemoryView.as_view()(request).status_code, 400)
+        request = factory.post('/memory/', {'action': 'start', 'frames': 'x'}, format='json')
+        force_authenticate(request, user=staff)
+        self.assertEqual(views.MemoryView.as_view()(request).status_code, 400)
+
+
+class QuantizedStoreTests(SimpleTestCase):
+    def setUp(self):
+        from scipy import sparse
+
+        self.matrix = sparse.random(3000, 60, density=0.1, format='csr', random_state=1)
+        self.queries = sparse.random(6, 60, density=0.3, format='csr', random_state=2)
+
+    def exact_top_scores(self, k):
+        import numpy as np
+
+        rows = self.matrix.toarray()
+        rows /= np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+        queries = self.queries.toarray()
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        scores = queries @ rows.T
+        return scores, np.sort(scores, axis=1)[:, -k]
+
+    def test_sparse_codes_are_smaller_than_csr(self):
+        for dtype in ('int8', 'float16'):
+            store = QuantizedStore(dtype=dtype, block_rows=500).fit(self.matrix)
+            self.assertEqual(len(store), self.matrix.shape[0])
+            self.assertEqual(len(store.codes), self.matrix.nnz)
+            self.assertLess(store.nbytes, sparse_nbytes(self.matrix) / 2)
+
+    def test_search_finds_exact_top_k(self):
+        scores, kth = self.exact_top_scores(5)
+        for rerank in (False, True):
+            store = QuantizedStore(block_rows=500, rerank=rerank).fit(self.matrix)
+            if rerank:
+                store.attach_exact(self.matrix)
+            _, found = store.search(self.queries, 5)
+            for i, rows in enumerate(found):
+                self.assertTrue((scores[i, rows] >= kth[i] - 1e-2).all())
+
+    def test_save_and_load(self):
+        store = QuantizedStore(block_rows=500).fit(self.matrix)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store.save(directory)
+        self.assertTrue(QuantizedStore.exists(directory))
+        loaded = QuantizedStore.load(directory, block_rows=500)
+        self.assertEqual(loaded.search(self.queries, 5)[1].tolist(), store.search(self.queries, 5)[1].tolist())
+
+
+@override_settings(PROFILE_VECTOR_CACHE_PERSIST=False)
+class StatCounterTests(TestCase):
+    def setUp(self):
+        for target, value in (('organ_matching_service', make_service()),
+                              ('match_index', matching.MatchIndex())):
+            patcher = mock.patch.object(matching, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def counts(self, metric):
+        return {
+            (c.organ, c.blood_group, c.city): c.count
+            for c in models.StatCounter.objects.filter(metric=metric).exclude(count=0)
+        }
+
+    def test_saves_move_counts_between_keys(self):
+        recipient = make_recipient('r1', 'Seattle')
+        donor = make_donor('d1', 'Seattle')
+        organ = make_organ(donor, blood_group='a')
+        self.assertEqual(self.counts('waiting'), {('kidney', 'O', 'seattle'): 1})
+        self.assertEqual(self.counts('available'), {('kidney', 'A', 'seattle'): 1})
+
+        recipient.city = 'Detroit'
+        recipient.save()
+        organ.blood_group = 'B'
+        organ.save()
+        self.assertEqual(self.counts('waiting'), {('kidney', 'O', 'detroit'): 1})
+        self.assertEqual(self.counts('available'), {('kidney', 'B', 'seattle'): 1})
+
+        # Organs are counted under their donor's city
+        donor.city = 'Phoenix'
+        donor.save()
+        self.assertEqual(self.counts('available'), {('kidney', 'B', 'phoenix'): 1})
+
+    def test_deletes_drop_counts(self):
+        recipient = make_recipient('r1', 'Seattle')
+        organ = make_organ(make_donor('d1', 'Seattle'))
+        make_organ(make_donor('d2', 'Seattle'))
+        recipient.delete()
+        organ.delete()
+        self.assertEqual(self.counts('waiting'), {})
+        self.assertEqual(self.counts('available'), {('kidney', 'O', 'seattle'): 1})
+
+    def test_expiry_drops_each_organ_once(self):
+        make_recipient('r1', 'Seattle')
+        organ = make_organ(make_donor('d1', 'Seattle'))
+        make_organ(make_donor('d2', 'Seattle'))
+        expiry.expire_organs([organ.id])
+        expiry.expire_organs([organ.id])
+        self.assertEqual(self.counts('available'), {('kidney', 'O', 'seattle'): 1})
+        summary = stats.summary()
+        self.assertEqual(summary['totals']['available'], 1)
+        self.assertEqual(summary['organs']['kidney']['supply_demand_ratio'], 1.0)
+        self.assertEqual(stats.reconcile()['available'], {'corrected': 0, 'added': 0, 'removed': 0})
+
+    def test_reconcile_repairs_drift(self):
+        make_recipient('r1', 'Seattle')
+        models.StatCounter.objects.filter(metric='waiting').update(count=5)
+        stats.apply_deltas('available', {('heart', 'O', 'seattle'): 2})
+        report = stats.reconcile()
+        self.assertEqual(report['waiting']['corrected'], 1)
+        self.assertEqual(report['available']['removed'], 1)
+        self.assertEqual(self.counts('waiting'), {('kidney', 'O', 'seattle'): 1})
+        self.assertEqual(self.counts('available'), {})
+
+
+class ProfileEncoderTests(SimpleTestCase):
+    FIELDS = [
+        ['Seattle', 'Male', 'White', '34', 'AB', 'Positive', 'SFalse', 'DFalse', 'ATrue', '7'],
+        ['Seattle', 'seattle', 'SEATTLE'],
+        ['the', 'and', 'of'],
+        ['Atlantis', '', 'Unknown value'],
+        [],
+        ['New York', 'Female', 'Asian', '29', 'O', 'Negative'],
+    ]
+
+    def fit(self, **options):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        categories = make_donor_data()['category'].tolist() + ['New York, Female, Asian']
+        return TfidfVectorizer(stop_words='english', **options).fit(categories)
+
+    def assert_same_rows(self, tf_model, field_lists):
+        expected = tf_model.transform([SEPARATOR.join(fields) for fields in field_lists]).tocsr()
+        expected.sort_indices()
+        actual = ProfileEncoder(tf_model).transform(field_lists)
+        self.assertEqual(actual.shape, expected.shape)
+        self.assertEqual(actual.indptr.tolist(), expected.indptr.tolist())
+        self.assertEqual(actual.indices.tolist(), expected.indices.tolist())
+        # Bit for bit, not approximately
+        self.assertEqual(actual.data.tobytes(), expected.data.tobytes())
+
+    def test_matches_transform(self):
+        field_lists = self.FIELDS + [c.split(',') for c in make_donor_data()['category']]
+        for options in ({}, {'norm': 'l1'}, {'norm': None}, {'use_idf': False}, {'binary': True},
+                        {'lowercase': False}):
+            tf_model = self.fit(**options)
+            self.assertTrue(ProfileEncoder.supports(tf_model), options)
+            self.assert_same_rows(tf_model, field_lists)
+            self.assertTrue(ProfileEncoder(tf_model).matches_transform(tf_model, field_lists))
+
+    def test_unsupported_configurations(self):
+        for options in ({'ngram_range': (1, 2)}, {'analyzer': 'char'}, {'sublinear_tf': True},
+                        {'token_pattern': r'[^ ]+'}):
+            self.assertFalse(ProfileEncoder.supports(self.fit(**options)), options)
+
+    def test_cache_is_bounded(self):
+        encoder = ProfileEncoder(self.fit(), cache_size=3)
+        encoder.transform(self.FIELDS)
+        self.assertEqual(len(encoder), 3)
+        self.assertEqual(encoder.columns('Seattle'), encoder.columns('seattle'))
+
+
+class AdminSearchTests(TestCase):
+    def search(self, model, term):
+        from django.contrib import admin
+
+        model_admin = admin.site._registry[model]
+        queryset, may_have_duplicates = model_admin.get_search_results(None, model.objects.all(), term)
+        self.assertFalse(may_have_duplicates)
+        return queryset
+
+    def test_terms_use_indexes(self):
+        queryset = self.search(models.Organ, '42 ali')
+        where = str(queryset.query).split('WHERE', 1)[1]
+        self.assertIn('"main_organ"."id" = 42', where)
+        self.assertNotIn('LIKE', where)
+        self.assertNotIn('"main_organ"."id" =', str(self.search(models.Organ, 'alice').query))
+        for model, term in ((models.Organ, '42 ali'), (models.Post, 'kid'),
+                            (userauth_models.Recipient, 'Seattle'), (models.Donor, 'ali')):
+            # SQLite reports a full table read as SCAN; index lookups are SEARCH
+            self.assertNotIn('SCAN', self.search(model, term).explain(), (model, term))
+
+    def test_matches_id_username_prefix_and_city(self):
+        organ = make_organ(make_donor('alice', 'Seattle'))
+        make_organ(make_donor('bob', 'Detroit'))
+        for term in (str(organ.id), 'ali', 'alice', '"alice"', 'Seattle', 'ali Seattle'):
+            self.assertEqual(list(self.search(models.Organ, term)), [organ], term)
+        for term in ('lice', 'seattle', 'alice Detroit'):
+            self.assertEqual(list(self.search(models.Organ, term)), [], term)
+
+
+class PostSearchTests(TestCase):
+    def setUp(self):
+        search.ensure_index()
+        self.authors = 0
+
+    def make_post(self, title, content=''):
+        self.authors += 1
+        author = make_recipient(f'author{self.authors}', 'Seattle')
+        return models.Post.objects.create(title=title, content=content, author=author)
+
+    def found(self, query, **page):
+        return [r['id'] for r in search.search_posts(query, **page)[1]]
+
+    def test_index_follows_inserts_updates_and_deletes(self):
+        post = self.make_post('Kidney donors wanted', 'Looking for a match in Seattle')
+        self.assertEqual(self.found('kidney'), [post.id])
+        self.assertEqual(self.found('donor'), [post.id])  # porter stemming
+        self.assertEqual(self.found('seat'), [post.id])   # the last word is a prefix
+
+        post.title = 'Liver donors wanted'
+        post.save()
+        self.assertEqual(self.found('kidney'), [])
+        self.assertEqual(self.found('liver'), [post.id])
+
+        # Bulk writes bypass signals; the triggers still see them
+        models.Post.objects.filter(pk=post.pk).update(content='Heart transplant')
+        self.assertEqual(self.found('seattle'), [])
+        self.assertEqual(self.found('heart'), [post.id])
+
+        post.delete()
+        self.assertEqual(self.found('liver'), [])
+
+    def test_ranking_and_paging(self):
+        in_content = self.make_post('Update', 'kidney kidney news')
+        in_title = self.make_post('Kidney news', 'weekly update')
+        others = [self.make_post(f'Note {i}', 'a kidney appointment') for i in range(3)]
+        total, results = search.search_posts('kidney')
+        self.assertEqual(total, 5)
+        ranked = [r['id'] for r in results]
+        self.assertEqual(ranked[0], in_title.id)
+        self.assertEqual(set(ranked), {in_content.id, in_title.id, *(p.id for p in others)})
+        self.assertEqual([r['score'] for r in results], sorted((r['score'] for r in results), reverse=True))
+
+        pages = [self.found('kidney', offset=offset, limit=2) for offset in (0, 2, 4)]
+        self.assertEqual([len(p) for p in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), ranked)
+        self.assertEqual(search.search_posts('kidney', offset=4, limit=2)[0], 5)
+
+    def test_query_syntax_is_not_interpreted(self):
+        post = self.make_post('Kidney OR liver', 'title:heart NEAR(a b) "quoted"')
+        for query in ('kidney OR', 'NOT kidney', '"unbalanced', 'title:heart', 'NEAR(a b)',
+                      'kidney*', '-kidney', '^kidney', 'a"b', '{title}: kidney', 'AND'):
+            search.search_posts(query)
+        self.assertEqual(self.found('kidney OR liver'), [post.id])
+        self.assertEqual(self.found('title:heart'), [post.id])
+        self.assertEqual(search.search_posts('"*- ()'), (0, []))
+        self.assertEqual(search.fts_query('say "hi" AND'), '"say" "hi" "AND"*')
+
+    def test_highlights_are_escaped(self):
+        self.make_post('<b>Kidney</b> & co', 'Read <script>alert(1)</script> about kidney care')
+        result = search.search_posts('kidney')[1][0]
+        self.assertEqual(result['title'], '&lt;b&gt;<mark>Kidney</mark>&lt;/b&gt; &amp; co')
+        self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', result['snippet'])
+        self.assertIn('<mark>kidney</mark>', result['snippet'])
+        self.assertNotIn('<script>', result['snippet'])
+
+    def test_orm_fallback(self):
+        post = self.make_post('Kidney <news>', 'for Seattle')
+        self.make_post('Liver', 'for Seattle')
+        total, results = search.search_posts_orm('kidney seattle')
+        self.assertEqual((total, [r['id'] for r in results]), (1, [post.id]))
+        self.assertEqual(results[0]['title'], 'Kidney &lt;news&gt;')
+        self.assertEqual(search.search_posts_orm('""'), (0, []))
+
+
+class IVFIndexTests(SimpleTestCase):
+    def setUp(self):
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(40, 16))
+        self.vectors = centers[rng.integers(0, 40, 3000)] + 0.5 * rng.normal(size=(3000, 16))
+        self.queries = centers[rng.integers(0, 40, 50)] + 0.5 * rng.normal(size=(50, 16))
+
+    def brute_force(self, k):
+        import numpy as np
+
+        scores = to_unit_rows(self.queries) @ to_unit_rows(self.vectors).T
+        return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+    def test_probing_every_list_is_exact(self):
+        import numpy as np
+        from sklearn.neighbors import NearestNeighbors
+
+        index = IVFIndex(seed=0).fit(self.vectors)
+        distances, indices = index.search(self.queries, 10, n_probe=index.n_lists)
+        self.assertEqual(indices.tolist(), self.brute_force(10).tolist())
+        expected, _ = NearestNeighbors(n_neighbors=10).fit(to_unit_rows(self.vectors)).kneighbors(
+            to_unit_rows(self.queries))
+        np.testing.assert_allclose(distances, expected, atol=1e-4)
+
+    def test_recall_at_default_n_probe(self):
+        index = IVFIndex(seed=0).fit(self.vectors)
+        self.assertLess(index.n_probe, index.n_lists)
+        _, indices = index.search(self.queries, 10)
+        hits = sum(len(set(found) & set(exact)) for found, exact in zip(indices, self.brute_force(10)))
+        self.assertGreaterEqual(hits / indices.size, 0.9)
+
+    def test_save_and_load(self):
+        index = IVFIndex(n_probe=4, seed=0).fit(self.vectors)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'ann_index.npz')
+        index.save(path)
+        loaded = IVFIndex.load(path)
+        self.assertEqual((loaded.n_lists, loaded.n_probe), (index.n_lists, 4))
+        for a, b in zip(loaded.search(self.queries, 10), index.search(self.queries, 10)):
+            self.assertEqual(a.tolist(), b.tolist())
+        self.assertEqual(IVFIndex.load(path, n_probe=2).n_probe, 2)
+
+
+class ShardedIndexTests(SimpleTestCase):
+    def setUp(self):
+        import numpy as np
+
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(400, 12))
+        self.regions = ['Washington' if i % 3 else 'TX' for i in range(400)]
+        self.queries = rng.normal(size=(6, 12))
+        self.index = ShardedIndex(self.vectors, self.regions, n_processes=2)
+        self.addCleanup(self.index.close)
+
+    def exact(self, k, region=None):
+        """Unsharded brute-force search, optionally over one region's rows"""
+        import numpy as np
+
+        scores = to_unit_rows(self.queries) @ to_unit_rows(self.vectors).T
+        if region is not None:
+            scores[:, [normalize_region(r) != region for r in self.regions]] = -np.inf
+        return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+    def test_normalize_region(self):
+        for value in ('WA', 'wa', 'Washington', ' washington  state ', 'W.A.'):
+            self.assertEqual(normalize_region(value), 'wa', value)
+        self.assertEqual(normalize_region('New  York'), 'ny')
+        self.assertEqual(normalize_region('D.C.'), 'dc')
+        self.assertEqual(normalize_region(None), '')
+        data = pd.DataFrame({'City': ['Seattle', 'Gotham']})
+        self.assertEqual(data_regions(data), ['wa', 'other'])
+        self.assertEqual(data_regions(data.assign(State=['Texas', 'N.Y.'])), ['tx', 'ny'])
+
+    def test_regions_resolve_to_their_shards(self):
+        self.assertEqual(set(self.index.shards), {'wa', 'tx'})
+        self.assertEqual(set(self.index.placement.values()), {0, 1})
+        self.assertEqual(self.index._resolve('Texas'), {'tx'})
+        self.assertEqual(self.index._resolve(['W.A.', 'nowhere']), {'wa'})
+        # Unknown regions search everything rather than nothing
+        self.assertIsNone(self.index._resolve('nowhere'))
+        self.assertIsNone(self.index._resolve(None))
+
+    def test_merged_results_match_exact_search(self):
+        import numpy as np
+
+        distances, indices = self.index.search(self.queries, 5)
+        self.assertEqual(indices.tolist(), self.exact(5).tolist())
+        scores = (to_unit_rows(self.queries) * to_unit_rows(self.vectors)[indices].transpose(1, 0, 2)).sum(-1).T
+        np.testing.assert_allclose(distances, np.sqrt(np.maximum(2 - 2 * scores, 0)), atol=1e-5)
+
+        _, indices = self.index.search(self.queries, 5, regions=['Texas'] * 6)
+        self.assertEqual(indices.tolist(), self.exact(5, 'tx').tolist())
+        _, indices = self.index.search(self.queries, 5, regions=[['wa', 'tx']] * 3 + ['nowhere'] * 3)
+        self.assertEqual(indices.tolist(), self.exact(5).tolist())
+
+    def test_failed_gather_resets_the_workers(self):
+        self.index.search(self.queries, 5)
+        process, _ = self.index._workers[0]
+        process.terminate()
+        process.join(5)
+        with self.assertRaises((EOFError, OSError)):
+            self.index.search(self.queries, 5)
+        self.assertEqual((self.index._workers, self.index._pid), ([], None))
+        # The next search starts fresh workers instead of reading stale replies
+        self.assertEqual(self.index.search(self.queries, 5)[1].tolist(), self.exact(5).tolist())
+
+
+class TrainingPipelineTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.data_path = os.path.join(self.root, 'KidneyData.csv')
+        make_donor_data().drop(columns=['category']).to_csv(self.data_path, index=False)
+        self.cache_dir = os.path.join(self.root, 'cache')
+
+    def run_pipeline(self, params=None):
+        import train_model
+
+        pipeline = train_model.Pipeline(self.data_path, params, cache_dir=self.cache_dir)
+        with mock.patch('builtins.print'):
+            pipeline.run()
+        return {name: timing['cached'] for name, timing in pipeline.timings.items()}
+
+    def test_second_run_loads_every_stage_from_the_cache(self):
+        import train_model
+
+        self.assertEqual(self.run_pipeline(), dict.fromkeys(train_model.STAGES, False))
+        self.assertEqual(self.run_pipeline(), dict.fromkeys(train_model.STAGES, True))
+
+    def test_changed_parameter_recomputes_only_its_stage_and_downstream(self):
+        self.run_pipeline()
+        cached = self.run_pipeline({'tfidf': {'max_features': 20}})
+        self.assertEqual(cached, {'load': True, 'tfidf': False, 'nn': False, 'ann': False,
+                                  'quant': False, 'cosine': False})
+        cached = self.run_pipeline({'tfidf': {'max_features': 20}, 'ann': {'n_probe': 2}})
+        self.assertEqual([name for name, hit in cached.items() if not hit], ['ann'])
+
+    def test_changed_dataset_invalidates_load(self):
+        import train_model
+
+        self.run_pipeline()
+        with open(self.data_path, 'a') as f:
+            f.write('Seattle,Male,White,50,O,Positive,SFalse,DFalse,AFalse,6,40\n')
+        self.assertEqual(self.run_pipeline(), dict.fromkeys(train_model.STAGES, False))
+
+    def test_sweep_points_never_overwrite_the_served_model(self):
+        import train_model
+
+        with mock.patch.object(train_model, 'MODEL_ROOT', os.path.join(self.root, 'ml_models')), \
+                mock.patch.object(train_model, 'SWEEP_ROOT', os.path.join(self.root, 'ml_models', 'sweeps')):
+            served = [t['output_dir'] for t in train_model.build_tasks(['liver'])]
+            sweep = train_model.build_tasks(['liver'], sweep=['tfidf.max_features=10,20', 'ann.n_probe=2'])
+            default_sweep = train_model.build_tasks(None, sweep=['tfidf.max_features=10,20'])
+        self.assertEqual(served, [os.path.join(self.root, 'ml_models', 'liver')])
+        self.assertEqual([t['params'] for t in sweep], [
+            {'tfidf': {'max_features': 10}, 'ann': {'n_probe': 2}},
+            {'tfidf': {'max_features': 20}, 'ann': {'n_probe': 2}},
+        ])
+        for task in sweep + default_sweep:
+            self.assertEqual(os.path.commonpath([task['output_dir'], os.path.join(self.root, 'ml_models', 'sweeps')]),
+                             os.path.join(self.root, 'ml_models', 'sweeps'))
+        self.assertEqual(len({t['output_dir'] for t in sweep + default_sweep}), 4)
+        with self.assertRaises(ValueError):
+            train_model.parse_sweep(['unknown.max_features=1'])
+
+
+class QueryLogTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'queries.ndjson')
+
+    def make_log(self, **options):
+        # Writes happen through flush() so the tests don't race the writer thread
+        log = QueryLog(self.path, **options)
+        patcher = mock.patch.object(log, '_ensure_worker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return log
+
+    def test_flush_writes_normalized_ndjson(self):
+        log = self.make_log()
+        profile = {'city': ' Seattle ', 'blood_group': 'O', 'organ': 'kidney', 'state': '', 'notes': 'x'}
+        log.record(profile, 3, 'v1', 'exact', [4, 7, -1], {'search_ms': 1.5})
+        log.flush()
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        entry = json.loads(lines[0])
+        self.assertEqual(entry['profile'], {'city': 'Seattle', 'blood_group': 'O', 'organ': 'kidney'})
+        self.assertEqual((entry['n'], entry['model_version'], entry['backend']), (3, 'v1', 'exact'))
+        self.assertEqual(entry['indices'], [4, 7])
+        self.assertEqual(entry['timings'], {'search_ms': 1.5})
+        self.assertEqual(list(read_log(self.path)), [entry])
+        self.assertEqual(log.counters['written'], 1)
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        log = self.make_log(max_queue=2)
+        for i in range(5):
+            log.record({'city': 'Seattle'}, 1, 'v1', 'exact', [i], {})
+        self.assertEqual(log.counters['recorded'], 2)
+        self.assertEqual(log.counters['dropped'], 3)
+        log.flush()
+        self.assertEqual([e['indices'] for e in read_log(self.path)], [[0], [1]])
+
+    def test_replay_against_the_serving_model_matches_exactly(self):
+        service = make_service()
+        service.query_log = self.make_log()
+        profiles = [{'city': city, 'blood_group': group, 'organ': 'kidney'}
+                    for city in CITIES for group in BLOOD_TYPES[:2]]
+        service.find_matches_batch(profiles, [5] * len(profiles))
+        service.query_log.flush()
+        service.query_log = None
+
+        report = replay(read_log(self.path), service, batch_size=3)
+        self.assertEqual(report['queries'], len(profiles))
+        self.assertEqual(report['overlap']['mean'], 1.0)
+        self.assertEqual(report['overlap']['identical_fraction'], 1.0)
+        self.assertEqual(report['overlap']['model_version_mismatches'], 0)
+        self.assertEqual(replay(read_log(self.path), service, organ='liver')['queries'], 0)
@@ -6,8 +6,19 @@ from . import views
 urlpatterns = [
     path('organ/', views.OrganDonorView.as_view()),
     path('find-matches/', views.FindOrganMatchesView.as_view()),
+    path('recipient-matches/', views.RecipientMatchesView.as_view()),
+    path('matching-stats/', views.MatchingStatsView.as_view()),
+    path('memory/', views.MemoryView.as_view()),
+    path('metrics/', views.MetricsView.as_view()),
+    path('jobs/', views.MatchJobsView.as_view()),
+    path('jobs/<int:pk>/', views.MatchJobDetailView.as_view()),
+    path('profiles/', views.ProfileDumpListView.as_view()),
+    path('profiles/<str:name>/', views.ProfileDumpDetailView.as_view()),
+    path('export/<str:dataset>/', views.RegistryExportView.as_view()),
     path('compatibility/', views.CompatibilityCheckView.as_view()),
     path('available-donors/', views.AvailableDonorsView.as_view()),
+    path('stats/', views.WaitlistStatsView.as_view()),
+    path('search/', views.PostSearchView.as_view()),
     path('author/', views.PostAuthor.as_view()),
     path('', views.PostEveryone.as_view()),
     path('signup/donor/', views.DonorSignUp.as_view()),
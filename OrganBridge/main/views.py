@@ -1,11 +1,32 @@
 # backend/donation/views.py
 from rest_framework.views import APIView
 from rest_framework.response import Response
+import hmac
+import io
+import os
+import pstats
+from django.conf import settings
+from django.db import router
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
 from . import models, serializers
-from rest_framework.permissions import IsAuthenticated
+from . import jobs
+from .admission import AdmissionControlMixin, classify_request
+from .db import ReplicaReadMixin, first_or_primary, use_replica
+from . import export
+from . import stats
+from .middleware import list_dumps, profile_dir
+from .matching import donor_profile, match_index, recipient_profile
+from .search import search_posts
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
 from userauth import models as userauth_models
-from ml_services import organ_matching_service
+from ml_services import organ_matching_service, parse_match_count
+from ml_dispatcher import match_dispatcher
+from ml_querylog import match_query_log
+from ml_admission import admission_controller
+from ml_memory import component_sizes, rss_bytes, tracemalloc_profiler
+from ml_registry import organ_model_registry
 
 class OrganDonorView(APIView):
     authentication_classes = (SessionAuthentication, BasicAuthentication)
@@ -54,39 +75,318 @@ class OrganDonorView(APIView):
         except Exception as e:
             return Response({'message': f'Error: {str(e)}'}, status=500)
 
-class FindOrganMatchesView(APIView):
+class FindOrganMatchesView(AdmissionControlMixin, ReplicaReadMixin, APIView):
     authentication_classes = (SessionAuthentication, BasicAuthentication)
     permission_classes = [IsAuthenticated]
+    admission_class = 'interactive'
     
     def post(self, request):
         """Find organ matches for a recipient"""
         try:
-            recipient = userauth_models.Recipient.objects.filter(user=request.user).first()
+            try:
+                n_matches = parse_match_count(request.data.get('n_matches', 10))
+            except ValueError as e:
+                return Response({'message': str(e)}, status=400)
+            recipient = first_or_primary(userauth_models.Recipient.objects.filter(user=request.user))
             if not recipient:
                 return Response({'message': 'Recipient profile not found'}, status=404)
             recipient_profile = {
                 'city': recipient.city,
                 'blood_group': recipient.blood_group,
                 'organ': recipient.organ,
+                'state': recipient.state,
                 'age': request.data.get('age', ''),
                 'gender': request.data.get('gender', ''),
                 'race': request.data.get('race', ''),
             }
-            matches = organ_matching_service.find_matches(
-                recipient_profile, 
-                n_matches=request.data.get('n_matches', 10)
-            )
+            matches = match_dispatcher.find_matches(recipient_profile, n_matches=n_matches)
+            return Response({'matches': matches, 'total_found': len(matches)})
+        except Exception as e:
+            return Response({'message': f'Error: {str(e)}'}, status=500)
+
+class RecipientMatchesView(ReplicaReadMixin, APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request):
+        """Get the recipient's current top-k organ matches from the RecipientMatch table"""
+        try:
+            recipient = first_or_primary(userauth_models.Recipient.objects.filter(user=request.user))
+            if not recipient:
+                return Response({'message': 'Recipient profile not found'}, status=404)
+            rows = models.RecipientMatch.objects.filter(recipient=recipient, organ__expired=False).select_related(
+                'organ__donor__user'
+            ).order_by('-score')
+            matches = [{
+                'organ_id': row.organ_id,
+                'donor_id': row.organ.donor_id,
+                'name': row.organ.donor.user.username,
+                'city': row.organ.donor.city,
+                'blood_group': row.organ.blood_group,
+                'organ': row.organ.organ,
+                'organ_date': row.organ.organ_date_time,
+                'similarity_score': row.score,
+            } for row in rows]
             return Response({'matches': matches, 'total_found': len(matches)})
         except Exception as e:
             return Response({'message': f'Error: {str(e)}'}, status=500)
 
-class CompatibilityCheckView(APIView):
+class MatchingStatsView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        """Model registry, dispatcher, query log and admission counters for staff"""
+        return Response({
+            'registry': organ_model_registry.stats(),
+            'available_organs': organ_model_registry.available_organs(),
+            'dispatcher': match_dispatcher.stats(),
+            'query_log': match_query_log.stats(),
+            'admission': admission_controller.stats(),
+        })
+
+def memory_report():
+    return {
+        'pid': os.getpid(),
+        'rss_bytes': rss_bytes(),
+        'models': component_sizes(organ_model_registry),
+        'match_index': {
+            'organs': match_index.organs.nbytes(),
+            'recipients': match_index.recipients.nbytes(),
+        },
+        'query_log_queued': match_query_log.stats()['queued'],
+    }
+
+class MemoryView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        """Memory by component, RSS, and tracemalloc top sites (?top=N) when tracing"""
+        try:
+            limit = min(max(int(request.query_params.get('top', 25)), 1), 200)
+        except (TypeError, ValueError):
+            return Response({'message': 'top must be an integer'}, status=400)
+        data = memory_report()
+        data['tracemalloc'] = tracemalloc_profiler.status()
+        if tracemalloc_profiler.tracing:
+            data['top'] = tracemalloc_profiler.top(limit)
+        return Response(data)
+    
+    def post(self, request):
+        """tracemalloc control: action=start|diff|stop, with optional frames, top and rebase"""
+        action = request.data.get('action')
+        try:
+            limit = min(max(int(request.data.get('top', 25)), 1), 200)
+            frames = min(max(int(request.data.get('frames', 1)), 1), 25)
+        except (TypeError, ValueError):
+            return Response({'message': 'top and frames must be integers'}, status=400)
+        key_type = 'traceback' if frames > 1 else 'lineno'
+        if action == 'start':
+            tracemalloc_profiler.start(frames=frames)
+            return Response({'message': 'Tracing started; baseline snapshot taken',
+                             'tracemalloc': tracemalloc_profiler.status()})
+        if action == 'diff':
+            if not tracemalloc_profiler.tracing:
+                return Response({'message': 'Tracing is not running'}, status=400)
+            diff = tracemalloc_profiler.diff(limit, key_type, rebase=bool(request.data.get('rebase')))
+            return Response({'diff': diff, 'rss_bytes': rss_bytes(), 'tracemalloc': tracemalloc_profiler.status()})
+        if action == 'stop':
+            tracemalloc_profiler.stop()
+            return Response({'message': 'Tracing stopped'})
+        return Response({'message': 'action must be start, diff or stop'}, status=400)
+
+class MetricsView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = []
+    
+    def get(self, request):
+        """Prometheus text exposition of this worker's memory and matching gauges"""
+        token = getattr(settings, 'METRICS_TOKEN', '')
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        if token:
+            if not hmac.compare_digest(header, f'Bearer {token}'):
+                return HttpResponse(status=401)
+        elif not request.user.is_staff:
+            return HttpResponse(status=403)
+        
+        report = memory_report()
+        pid = report['pid']
+        lines = [
+            '# HELP organbridge_process_resident_memory_bytes Resident set size of the worker',
+            '# TYPE organbridge_process_resident_memory_bytes gauge',
+            f'organbridge_process_resident_memory_bytes{{pid="{pid}"}} {report["rss_bytes"]}',
+            '# HELP organbridge_model_component_bytes Approximate bytes per matching model component',
+            '# TYPE organbridge_model_component_bytes gauge',
+        ]
+        for organ, sizes in report['models'].items():
+            for component, nbytes in sizes.items():
+                lines.append(f'organbridge_model_component_bytes{{pid="{pid}",organ="{organ}",component="{component}"}} {nbytes}')
+        lines += [
+            '# HELP organbridge_match_index_bytes Approximate bytes of the in-memory RecipientMatch vectors',
+            '# TYPE organbridge_match_index_bytes gauge',
+        ]
+        for kind, nbytes in report['match_index'].items():
+            lines.append(f'organbridge_match_index_bytes{{pid="{pid}",kind="{kind}"}} {nbytes}')
+        registry = organ_model_registry.stats()
+        admission = admission_controller.stats()
+        lines += [
+            '# TYPE organbridge_registry_resident_bytes gauge',
+            f'organbridge_registry_resident_bytes{{pid="{pid}"}} {registry["resident_bytes"]}',
+            '# TYPE organbridge_admission_queued gauge',
+        ]
+        lines += [f'organbridge_admission_queued{{pid="{pid}",class="{name}"}} {c["queued"]}'
+                  for name, c in admission['classes'].items()]
+        lines.append('# TYPE organbridge_admission_rejected_total counter')
+        lines += [f'organbridge_admission_rejected_total{{pid="{pid}",class="{name}"}} {c["rejected"]}'
+                  for name, c in admission['classes'].items()]
+        return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
+class MatchJobsView(APIView):
     authentication_classes = (SessionAuthentication, BasicAuthentication)
     permission_classes = [IsAuthenticated]
     
+    def post(self, request):
+        """Submit a match, rematch or compatibility job and return its id immediately"""
+        try:
+            kind = request.data.get('kind', 'match')
+            if kind not in jobs.API_KINDS:
+                return Response({'message': f'Unknown job kind: {kind}'}, status=400)
+            try:
+                params = {'n_matches': parse_match_count(request.data.get('n_matches', 10))}
+            except ValueError as e:
+                return Response({'message': str(e)}, status=400)
+            if kind == 'match':
+                recipient = userauth_models.Recipient.objects.filter(user=request.user).first()
+                if not recipient:
+                    return Response({'message': 'Recipient profile not found'}, status=404)
+                params['recipient_profile'] = dict(recipient_profile(recipient), state=recipient.state)
+            elif kind == 'rematch':
+                if not request.user.is_staff:
+                    return Response({'message': 'Only staff can re-match the waitlist'}, status=403)
+                params['recipient_ids'] = request.data.get('recipient_ids') or []
+            else:
+                params['donor_ids'] = request.data.get('donor_ids') or []
+                params['recipient_ids'] = request.data.get('recipient_ids') or []
+                params['donor_blood_group'] = request.data.get('donor_blood_group', '')
+                params['organ'] = request.data.get('organ', '')
+                if not params['donor_ids'] or not params['recipient_ids']:
+                    return Response({'message': 'donor_ids and recipient_ids are required'}, status=400)
+            try:
+                priority = int(request.data.get('priority', 0))
+            except (TypeError, ValueError):
+                return Response({'message': 'priority must be an integer'}, status=400)
+            # Only staff may jump the queue
+            if not request.user.is_staff:
+                priority = min(priority, 0)
+            job = jobs.submit(request.user, kind, params, priority)
+            return Response({'job_id': job.id, 'status': job.status}, status=202)
+        except Exception as e:
+            return Response({'message': f'Error: {str(e)}'}, status=500)
+    
+    def get(self, request):
+        """List the caller's jobs"""
+        rows = models.MatchJob.objects.filter(owner=request.user).order_by('-created_at').values(
+            'id', 'kind', 'status', 'priority', 'progress', 'result_count', 'created_at', 'finished_at'
+        )[:100]
+        return Response({'jobs': list(rows)})
+
+class MatchJobDetailView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAuthenticated]
+    
+    def get_job(self, request, pk):
+        jobs_qs = models.MatchJob.objects.all()
+        if not request.user.is_staff:
+            jobs_qs = jobs_qs.filter(owner=request.user)
+        return jobs_qs.filter(pk=pk).first()
+    
+    def get(self, request, pk):
+        """Poll a job; finished results are returned in chunks via offset/limit"""
+        job = self.get_job(request, pk)
+        if not job:
+            return Response({'message': 'Job not found'}, status=404)
+        data = {
+            'job_id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'progress': job.progress,
+            'error': job.error,
+            'result_count': job.result_count,
+            'expires_at': job.expires_at,
+        }
+        if job.status == 'done':
+            try:
+                offset = max(int(request.query_params.get('offset', 0)), 0)
+                limit = min(max(int(request.query_params.get('limit', 100)), 1), 1000)
+            except ValueError:
+                return Response({'message': 'offset and limit must be integers'}, status=400)
+            # Only the chunks overlapping the requested page are loaded
+            chunks = job.result_chunks.filter(
+                attempt=job.attempts, start__lt=offset + limit, end__gt=offset
+            ).order_by('start').values_list('start', 'items')
+            results = []
+            for start, items in chunks:
+                results.extend(items[max(offset - start, 0):offset + limit - start])
+            data['results'] = results
+            data['next_offset'] = offset + limit if offset + limit < job.result_count else None
+        return Response(data)
+    
+    def delete(self, request, pk):
+        """Cancel a queued or running job"""
+        job = self.get_job(request, pk)
+        if not job:
+            return Response({'message': 'Job not found'}, status=404)
+        if not jobs.cancel(job):
+            return Response({'message': f'Job is already {job.status}'}, status=409)
+        return Response({'message': 'Cancellation requested'})
+
+class ProfileDumpListView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request):
+        """List captured request profiles, newest first"""
+        directory = profile_dir()
+        dumps = []
+        for name in list_dumps():
+            stat = os.stat(os.path.join(directory, name))
+            dumps.append({'name': name, 'size': stat.st_size, 'modified': stat.st_mtime})
+        return Response({'profiles': dumps, 'total_count': len(dumps)})
+
+class ProfileDumpDetailView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAdminUser]
+    
+    def get(self, request, name):
+        """Download a profile (.prof for snakeviz/pstats) or ?format=txt for a call summary"""
+        if name not in list_dumps():
+            return Response({'message': 'Profile not found'}, status=404)
+        path = os.path.join(profile_dir(), name)
+        if request.query_params.get('format') == 'txt':
+            stream = io.StringIO()
+            stats = pstats.Stats(path, stream=stream).sort_stats('cumulative')
+            stats.print_stats(60)
+            stats.print_callers(30)
+            return HttpResponse(stream.getvalue(), content_type='text/plain')
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
+
+class CompatibilityCheckView(AdmissionControlMixin, APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAuthenticated]
+    admission_class = 'interactive'
+    
+    def get_admission_class(self, request):
+        # Many-pair scoring is bulk work
+        if 'donor_ids' in request.data or 'recipient_ids' in request.data:
+            return classify_request(request, 'batch')
+        return super().get_admission_class(request)
+    
     def post(self, request):
         """Check compatibility between donor and recipient"""
         try:
+            if 'donor_ids' in request.data or 'recipient_ids' in request.data:
+                return self.post_batch(request)
             donor_id = request.data.get('donor_id')
             recipient_id = request.data.get('recipient_id')
             if not donor_id or not recipient_id:
@@ -95,18 +395,11 @@ class CompatibilityCheckView(APIView):
             recipient = userauth_models.Recipient.objects.filter(id=recipient_id).first()
             if not donor or not recipient:
                 return Response({'message': 'Donor or recipient not found'}, status=404)
-            donor_profile = {
-                'city': donor.city,
-                'blood_group': request.data.get('donor_blood_group', ''),
-                'organ': request.data.get('organ', ''),
-            }
-            recipient_profile = {
-                'city': recipient.city,
-                'blood_group': recipient.blood_group,
-                'organ': recipient.organ,
-            }
+            # Same rule as post_batch and compatibility jobs: the registered organ wins
+            organ = models.Organ.objects.filter(donor=donor).first()
             compatibility_score = organ_matching_service.get_compatibility_score(
-                donor_profile, recipient_profile
+                donor_profile(donor, organ, request.data), recipient_profile(recipient),
+                donor_id=donor.id, recipient_id=recipient.id,
             )
             return Response({
                 'compatibility_score': compatibility_score,
@@ -115,15 +408,39 @@ class CompatibilityCheckView(APIView):
             })
         except Exception as e:
             return Response({'message': f'Error: {str(e)}'}, status=500)
+    
+    def post_batch(self, request):
+        """Score one or many donors against one or many recipients with a single sparse product"""
+        donor_ids = request.data.get('donor_ids') or [request.data.get('donor_id')]
+        recipient_ids = request.data.get('recipient_ids') or [request.data.get('recipient_id')]
+        if not all(donor_ids) or not all(recipient_ids):
+            return Response({'message': 'donor_id(s) and recipient_id(s) are required'}, status=400)
+        if len(donor_ids) * len(recipient_ids) > getattr(settings, 'COMPATIBILITY_MAX_PAIRS', 100000):
+            return Response({'message': 'Too many donor/recipient pairs requested'}, status=400)
+        donors = list(userauth_models.Donor.objects.filter(id__in=donor_ids))
+        recipients = list(userauth_models.Recipient.objects.filter(id__in=recipient_ids))
+        if not donors or not recipients:
+            return Response({'message': 'Donor or recipient not found'}, status=404)
+        organs = {o.donor_id: o for o in models.Organ.objects.filter(donor__in=donors)}
+        scores = organ_matching_service.get_compatibility_scores(
+            [(d.id, donor_profile(d, organs.get(d.id), request.data)) for d in donors],
+            [(r.id, recipient_profile(r)) for r in recipients],
+        )
+        results = [
+            {'donor_id': d.id, 'recipient_id': r.id, 'compatibility_score': float(scores[i][j])}
+            for i, d in enumerate(donors) for j, r in enumerate(recipients)
+        ]
+        results.sort(key=lambda item: item['compatibility_score'], reverse=True)
+        return Response({'scores': results, 'total_count': len(results)})
 
-class AvailableDonorsView(APIView):
+class AvailableDonorsView(ReplicaReadMixin, APIView):
     authentication_classes = (SessionAuthentication, BasicAuthentication)
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         """Get list of available donors with their organ information"""
         try:
-            organs = models.Organ.objects.select_related('donor__user').all()
+            organs = models.Organ.objects.select_related('donor__user').filter(expired=False)
             donors_data = []
             for organ in organs:
                 donor_info = {
@@ -153,7 +470,7 @@ class PostAuthor(APIView):
     def get(self, request):
         author = userauth_models.Recipient.objects.filter(user=request.user).first()
         posts = models.Post.objects.filter(author=author)
-        serializer = serializers.PostSerializer(posts, many=True)
+        serializer = serializers.PostSerializer(posts, many=True, context={'request': request})
         return Response(serializer.data)
     
     def post(self, request):
@@ -188,15 +505,84 @@ class PostAuthor(APIView):
             return Response({'message': 'You do not have a post'})
         return Response({'message': 'Invalid request'})
 
-class PostEveryone(APIView):
+class PostEveryone(ReplicaReadMixin, APIView):
     authentication_classes = (SessionAuthentication, BasicAuthentication)
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         posts = models.Post.objects.all()
-        serializer = serializers.PostSerializer(posts, many=True)
+        serializer = serializers.PostSerializer(posts, many=True, context={'request': request})
         return Response(serializer.data)
 
+class PostSearchView(ReplicaReadMixin, APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Ranked full-text search over post titles and content: ?q=...&offset=&limit="""
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'message': 'q is required'}, status=400)
+        try:
+            offset = max(int(request.query_params.get('offset', 0)), 0)
+            limit = min(max(int(request.query_params.get('limit', 20)), 1), 100)
+            total, results = search_posts(query, offset, limit)
+            return Response({
+                'results': results,
+                'total_count': total,
+                'next_offset': offset + limit if offset + limit < total else None,
+            })
+        except Exception as e:
+            return Response({'message': f'Error: {str(e)}'}, status=500)
+
+class RegistryExportView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, dataset):
+        """Stream organs, donors, recipients or training rows: ?format=csv|ndjson|parquet&since=<ISO time>&organ="""
+        fmt = request.query_params.get('format', 'csv')
+        if fmt not in export.FORMATS:
+            return Response({'message': f'Unknown format: {fmt}'}, status=400)
+        since = request.query_params.get('since')
+        if since:
+            since = parse_datetime(since)
+            if since is None:
+                return Response({'message': 'since must be an ISO 8601 datetime'}, status=400)
+        try:
+            with use_replica():
+                using = router.db_for_read(models.Organ)
+            # Taken from the copy being read, before reading it
+            watermark = export.new_watermark(dataset, using, since)
+            columns, types, rows = export.export_rows(
+                dataset, since=since, using=using, organ=request.query_params.get('organ')
+            )
+            pieces = export.encode(fmt, columns, types, rows)
+        except ValueError as e:
+            return Response({'message': str(e)}, status=400)
+
+        content_type, extension = export.FORMATS[fmt]
+        compress = fmt != 'parquet' and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        response = StreamingHttpResponse(export.gzip_stream(pieces) if compress else pieces, content_type=content_type)
+        if compress:
+            response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+        response['Content-Disposition'] = f'attachment; filename="{dataset}.{extension}"'
+        if watermark:
+            response['X-Export-Watermark'] = watermark.isoformat()
+        return response
+
+class WaitlistStatsView(APIView):
+    authentication_classes = (SessionAuthentication, BasicAuthentication)
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Waiting recipients, available organs and supply/demand ratios: ?organ="""
+        try:
+            return Response(stats.summary(organ=request.query_params.get('organ')))
+        except Exception as e:
+            return Response({'message': f'Error: {str(e)}'}, status=500)
+
 class DonorSignUp(APIView):
     permission_classes = []
     def post(self, request):
@@ -217,7 +603,7 @@ class RecipientSignUp(APIView):
         else:
             return Response(serializer.errors)
 
-class GETRecipient(APIView):
+class GETRecipient(ReplicaReadMixin, APIView):
     permission_classes = []
     def get(self, request):
         req = userauth_models.Recipient.objects.all()
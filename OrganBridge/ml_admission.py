@@ -0,0 +1,198 @@
+# backend/ml_admission.py
+"""
+Priority-aware admission control for matching work
+
+Every matching call takes a slot from a shared pool of MATCH_ADMISSION_CAPACITY
+slots. Each priority class (urgent, interactive, batch, background) also has
+its own concurrency limit, a bounded wait queue and a maximum wait. Freed
+slots go to the highest-priority class that has waiters and room. Work is
+shed as soon as it arrives when its class queue is full or when its expected
+wait already exceeds the class's max_wait, so low-priority requests fail fast
+with a retry hint instead of slowing everyone down.
+"""
+import math
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from ml_metrics import LatencyRecorder
+
+DEFAULT_CLASSES = {
+    'urgent': {'priority': 0, 'concurrency': 16, 'queue': 64, 'max_wait': 10.0},
+    'interactive': {'priority': 1, 'concurrency': 12, 'queue': 32, 'max_wait': 2.0},
+    'batch': {'priority': 2, 'concurrency': 4, 'queue': 16, 'max_wait': 30.0},
+    'background': {'priority': 3, 'concurrency': 2, 'queue': 4, 'max_wait': 0.5},
+}
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, class_name, reason, retry_after):
+        super().__init__(f'{class_name} work rejected: {reason}')
+        self.class_name = class_name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class PriorityClass:
+    def __init__(self, name, priority, concurrency, queue, max_wait):
+        self.name = name
+        self.priority = priority
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.max_wait = max_wait
+        self.waiters = deque()
+        self.running = 0
+        self.wait_time = LatencyRecorder()
+        self.counters = {'admitted': 0, 'rejected': 0, 'timed_out': 0}
+
+
+class Ticket:
+    __slots__ = ('cls', 'granted', 'started')
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.granted = False
+        self.started = None
+
+
+class AdmissionController:
+    def __init__(self, capacity=16, classes=None, enabled=True):
+        self.capacity = max(int(capacity), 1)
+        self.enabled = enabled
+        self.classes = {
+            name: PriorityClass(name, **options) for name, options in (classes or DEFAULT_CLASSES).items()
+        }
+        self._by_priority = sorted(self.classes.values(), key=lambda c: c.priority)
+        self._cond = threading.Condition()
+        self.running = 0
+        # Moving average of how long admitted work holds its slot
+        self.service_time = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        """Build a controller configured from Django settings"""
+        return cls(
+            capacity=getattr(settings, 'MATCH_ADMISSION_CAPACITY', 16),
+            classes=getattr(settings, 'MATCH_ADMISSION_CLASSES', None),
+            enabled=getattr(settings, 'MATCH_ADMISSION_ENABLED', True),
+        )
+
+    def acquire(self, class_name, block=False):
+        """
+        Take a slot for one unit of work, waiting in the class queue if needed
+
+        Args:
+            class_name (str): Priority class of the work
+            block (bool): Wait without queue or wait limits (background workers)
+
+        Returns:
+            Ticket: Pass to release() when the work is done
+
+        Raises:
+            AdmissionRejected: The work was shed; retry_after is in seconds
+        """
+        cls = self.classes[class_name]
+        ticket = Ticket(cls)
+        if not self.enabled:
+            ticket.granted = True
+            ticket.started = time.monotonic()
+            return ticket
+
+        arrived = time.monotonic()
+        with self._cond:
+            if self._has_room(cls) and not self._waiting_ahead(cls):
+                self._grant(ticket)
+            else:
+                if not block:
+                    if len(cls.waiters) >= cls.queue_size:
+                        self._reject(cls, 'queue full')
+                    expected = self.expected_wait(cls)
+                    if expected > cls.max_wait:
+                        self._reject(cls, 'overloaded', expected)
+                cls.waiters.append(ticket)
+                deadline = None if block else arrived + cls.max_wait
+                while not ticket.granted:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        cls.waiters.remove(ticket)
+                        cls.counters['timed_out'] += 1
+                        # Work held back behind this waiter may be able to run now
+                        self._dispatch()
+                        self._reject(cls, 'timed out waiting', self.expected_wait(cls), count=False)
+                    self._cond.wait(remaining)
+        cls.wait_time.record(time.monotonic() - arrived)
+        return ticket
+
+    def release(self, ticket):
+        if not self.enabled or ticket is None:
+            return
+        with self._cond:
+            held = time.monotonic() - ticket.started
+            self.service_time = held if not self.service_time else 0.9 * self.service_time + 0.1 * held
+            ticket.cls.running -= 1
+            self.running -= 1
+            self._dispatch()
+
+    def run(self, class_name, func, *args, **kwargs):
+        """Call func inside an admission slot"""
+        ticket = self.acquire(class_name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(ticket)
+
+    def expected_wait(self, cls):
+        """Rough wait for a new arrival: work queued at its priority or above, drained by its slots"""
+        ahead = sum(len(c.waiters) for c in self._by_priority if c.priority <= cls.priority)
+        slots = max(min(self.capacity, cls.concurrency), 1)
+        return (ahead + 1) * self.service_time / slots
+
+    def stats(self):
+        with self._cond:
+            classes = {
+                c.name: dict(c.counters, running=c.running, queued=len(c.waiters),
+                             concurrency=c.concurrency, queue_size=c.queue_size,
+                             expected_wait_ms=round(1000 * self.expected_wait(c), 3))
+                for c in self._by_priority
+            }
+            totals = {'capacity': self.capacity, 'running': self.running,
+                      'service_time_ms': round(1000 * self.service_time, 3), 'enabled': self.enabled}
+        for c in self._by_priority:
+            classes[c.name]['wait'] = c.wait_time.summary()
+        return dict(totals, classes=classes)
+
+    def _has_room(self, cls):
+        return self.running < self.capacity and cls.running < cls.concurrency
+
+    def _waiting_ahead(self, cls):
+        # Arrivals never overtake queued work of the same or higher priority
+        # that could take a slot now; a class at its own limit holds no one back
+        return any(c.waiters and c.running < c.concurrency for c in self._by_priority if c.priority <= cls.priority)
+
+    def _grant(self, ticket):
+        ticket.granted = True
+        ticket.started = time.monotonic()
+        ticket.cls.running += 1
+        ticket.cls.counters['admitted'] += 1
+        self.running += 1
+
+    def _dispatch(self):
+        # Called with the lock held: hand free slots to the best waiting classes
+        granted = False
+        while self.running < self.capacity:
+            cls = next((c for c in self._by_priority if c.waiters and c.running < c.concurrency), None)
+            if cls is None:
+                break
+            self._grant(cls.waiters.popleft())
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _reject(self, cls, reason, expected=0.0, count=True):
+        if count:
+            cls.counters['rejected'] += 1
+        raise AdmissionRejected(cls.name, reason, max(1, math.ceil(expected)))
+
+
+# Initialize the controller
+admission_controller = AdmissionController.from_settings()
@@ -0,0 +1,132 @@
+# backend/ml_ann.py
+"""
+Approximate nearest-neighbor search for OrganMatchingService
+
+IVFIndex is an inverted-file index written in NumPy: a spherical k-means
+coarse quantizer splits the L2-normalized donor vectors into `n_lists`
+cells, and a query is scored exactly against the donors of its `n_probe`
+closest cells only. Raising n_probe trades speed for recall; n_probe equal
+to n_lists is exact search.
+"""
+import numpy as np
+
+
+def to_unit_rows(vectors):
+    """Dense float32 copy of (sparse or dense) vectors with L2-normalized rows"""
+    if hasattr(vectors, 'toarray'):
+        vectors = vectors.toarray()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def scores_to_distances(scores):
+    """Euclidean distance between unit vectors, matching NearestNeighbors output"""
+    return np.sqrt(np.maximum(2.0 - 2.0 * scores, 0.0))
+
+
+class IVFIndex:
+    def __init__(self, n_lists=None, n_probe=8, n_iter=15, sample_size=100000, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None   # donor vectors grouped by cell
+        self.ids = None       # original row of each grouped vector
+        self.offsets = None   # cell c holds vectors[offsets[c]:offsets[c + 1]]
+
+    def fit(self, vectors):
+        """Train the coarse quantizer and bucket every vector into its cell"""
+        data = to_unit_rows(vectors)
+        self.centroids = self._train_centroids(data)
+        self.n_lists = len(self.centroids)
+        labels = self._assign(data, self.centroids)
+        order = np.argsort(labels, kind='stable')
+        self.vectors = np.ascontiguousarray(data[order])
+        self.ids = order.astype(np.int64)
+        self.offsets = np.searchsorted(labels[order], np.arange(len(self.centroids) + 1))
+        return self
+
+    def search(self, queries, n_neighbors=10, n_probe=None):
+        """
+        Approximate kNN in the same (distances, indices) shape as NearestNeighbors.kneighbors
+
+        Args:
+            queries: Sparse or dense query vectors
+            n_neighbors (int): Number of neighbors per query
+            n_probe (int): Cells to scan per query, defaults to self.n_probe
+
+        Returns:
+            tuple: (distances, indices) arrays, one row per query
+        """
+        queries = to_unit_rows(queries)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        n_neighbors = min(n_neighbors, len(self.ids))
+        cell_scores = queries @ self.centroids.T
+        probes = np.argpartition(-cell_scores, n_probe - 1, axis=1)[:, :n_probe]
+
+        distances = np.full((len(queries), n_neighbors), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), n_neighbors), -1, dtype=np.int64)
+        for row, query in enumerate(queries):
+            spans = [(self.offsets[c], self.offsets[c + 1]) for c in probes[row]]
+            scores = np.concatenate([self.vectors[s:e] @ query for s, e in spans])
+            rows = np.concatenate([self.ids[s:e] for s, e in spans])
+            k = min(n_neighbors, len(scores))
+            if k == 0:
+                continue
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            distances[row, :k] = scores_to_distances(scores[top])
+            indices[row, :k] = rows[top]
+        return distances, indices
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.centroids, self.vectors, self.ids, self.offsets) if a is not None)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, vectors=self.vectors, ids=self.ids,
+                 offsets=self.offsets, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path, n_probe=None):
+        stored = np.load(path)
+        index = cls(n_lists=len(stored['centroids']), n_probe=n_probe or int(stored['n_probe']))
+        index.centroids = stored['centroids']
+        index.vectors = stored['vectors']
+        index.ids = stored['ids']
+        index.offsets = stored['offsets']
+        return index
+
+    def _train_centroids(self, data):
+        rng = np.random.default_rng(self.seed)
+        if len(data) > self.sample_size:
+            data = data[rng.choice(len(data), self.sample_size, replace=False)]
+        # About sqrt(n) cells keeps both the centroid scan and each cell small
+        n_lists = min(self.n_lists or max(1, int(round(np.sqrt(len(data))))), len(data))
+        centroids = data[rng.choice(len(data), n_lists, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = self._assign(data, centroids)
+            counts = np.bincount(labels, minlength=n_lists)
+            nonempty = counts > 0
+            order = np.argsort(labels, kind='stable')
+            starts = (np.cumsum(counts) - counts)[nonempty]
+            sums = np.zeros_like(centroids)
+            sums[nonempty] = np.add.reduceat(data[order], starts, axis=0)
+            # Re-seed empty cells from random points so no list stays unused
+            empty = np.flatnonzero(~nonempty)
+            sums[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+        return centroids
+
+    @staticmethod
+    def _assign(data, centroids, block=65536):
+        labels = np.empty(len(data), dtype=np.int64)
+        for start in range(0, len(data), block):
+            labels[start:start + block] = np.argmax(data[start:start + block] @ centroids.T, axis=1)
+        return labels
@@ -0,0 +1,183 @@
+# backend/ml_dispatcher.py
+"""
+Request coalescing and micro-batching in front of OrganMatchingService.find_matches
+
+Concurrent callers asking for the same profile share one in-flight computation
+(single-flight). Distinct queries that arrive within a short window are scored
+together with one transform/kneighbors call and the results are fanned back out.
+
+Scoring runs on the dispatcher thread, which a request-thread cProfile does not
+see. Callers inside collect_profiles() get a cProfile of every batch their
+queries were scored in (used by the profiling middleware).
+"""
+import cProfile
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from django.conf import settings
+from ml_metrics import LatencyRecorder
+from ml_registry import organ_model_registry
+from ml_services import parse_match_count
+
+
+class MatchDispatcher:
+    def __init__(self, service, window_ms=2, max_batch=32, timeout=5.0, enabled=True):
+        self.service = service
+        # Keep the collection window inside 1-5 ms so it never dominates latency
+        self.window = min(max(float(window_ms), 1.0), 5.0) / 1000.0
+        self.max_batch = max(int(max_batch), 1)
+        self.timeout = timeout
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = {}   # key -> (profile, n_matches, future), arrival order
+        self._inflight = {}  # key -> future, until its result is published
+        self._profiled = {}  # pending key -> profile lists of callers collecting profiles
+        self._profile_local = threading.local()
+        self._worker = None
+        self._worker_pid = None
+        self.latency = LatencyRecorder()
+        self.counters = {'requests': 0, 'coalesced': 0, 'batches': 0, 'batched_queries': 0}
+
+    @classmethod
+    def from_settings(cls, service):
+        """Build a dispatcher configured from Django settings"""
+        return cls(
+            service,
+            window_ms=getattr(settings, 'MATCH_BATCH_WINDOW_MS', 2),
+            max_batch=getattr(settings, 'MATCH_BATCH_MAX_SIZE', 32),
+            timeout=getattr(settings, 'MATCH_BATCH_TIMEOUT', 5.0),
+            enabled=getattr(settings, 'MATCH_BATCHING_ENABLED', True),
+        )
+
+    @staticmethod
+    def make_key(recipient_profile, n_matches):
+        """Identity of a query: identical profiles and sizes share one result"""
+        profile = tuple(sorted((k, str(v)) for k, v in recipient_profile.items()))
+        return profile, str(n_matches)
+
+    @contextmanager
+    def collect_profiles(self):
+        """Collect a cProfile.Profile of each batch this thread's queries are scored in"""
+        previous = getattr(self._profile_local, 'profiles', None)
+        profiles = self._profile_local.profiles = []
+        try:
+            yield profiles
+        finally:
+            self._profile_local.profiles = previous
+
+    def find_matches(self, recipient_profile, n_matches=5):
+        """
+        Find organ matches, coalescing with other concurrent callers
+
+        Args:
+            recipient_profile (dict): Recipient's profile information
+            n_matches (int): Number of matches to return
+
+        Returns:
+            list: List of matched donor profiles
+        
+        Raises:
+            ValueError: If n_matches is not an integer; raised before the query
+                joins a batch, so it never affects other callers
+        """
+        n_matches = parse_match_count(n_matches)
+        if not self.enabled:
+            return self.service.find_matches(recipient_profile, n_matches)
+
+        started = time.perf_counter()
+        key = self.make_key(recipient_profile, n_matches)
+        profiles = getattr(self._profile_local, 'profiles', None)
+        with self._lock:
+            self.counters['requests'] += 1
+            future = self._inflight.get(key)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                self._pending[key] = (recipient_profile, n_matches, future)
+                self._ensure_worker()
+                self._wakeup.notify()
+            else:
+                self.counters['coalesced'] += 1
+            # A query already being scored is not profiled for a late joiner
+            if profiles is not None and key in self._pending:
+                self._profiled.setdefault(key, []).append(profiles)
+
+        try:
+            return future.result(timeout=self.timeout)
+        finally:
+            self.latency.record(time.perf_counter() - started)
+
+    def stats(self):
+        """Counters and recent caller-observed latency percentiles"""
+        with self._lock:
+            counters = dict(self.counters)
+            counters['pending'] = len(self._pending)
+        counters['latency'] = self.latency.summary()
+        return counters
+
+    def _ensure_worker(self):
+        # Called with the lock held; restarts the worker after a fork
+        if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+            self._worker = threading.Thread(target=self._run, name='match-dispatcher', daemon=True)
+            self._worker_pid = os.getpid()
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wakeup.wait()
+                # The window opens with the first pending query and closes
+                # early once a full batch has been collected
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.wait(remaining)
+                keys = list(self._pending)[:self.max_batch]
+                batch = [(key, self._pending.pop(key)) for key in keys]
+                collectors = [c for key in keys for c in self._profiled.pop(key, ())]
+                self.counters['batches'] += 1
+                self.counters['batched_queries'] += len(batch)
+            self._score(batch, collectors)
+
+    def _score(self, batch, collectors=()):
+        profiles = [item[0] for _, item in batch]
+        counts = [item[1] for _, item in batch]
+        profiler = cProfile.Profile() if collectors else None
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Python 3.12+: one profiler at a time, and it hooks every thread
+                profiler = None
+        try:
+            results = self.service.find_matches_batch(profiles, counts)
+            error = None
+        except Exception as e:
+            results, error = None, e
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                # Published before the futures, so callers find it once woken
+                for collected in collectors:
+                    collected.append(profiler)
+
+        # Retire the keys before publishing so later callers start a fresh query
+        with self._lock:
+            for key, _ in batch:
+                self._inflight.pop(key, None)
+
+        for i, (_, (_, _, future)) in enumerate(batch):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(results[i])
+
+
+# Initialize the dispatcher
+match_dispatcher = MatchDispatcher.from_settings(organ_model_registry)
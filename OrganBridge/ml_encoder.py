@@ -0,0 +1,147 @@
+# backend/ml_encoder.py
+"""
+Precompiled TF-IDF encoder for profile queries
+
+A profile is a handful of short, mostly categorical fields joined with ', '.
+Rather than running every query through TfidfVectorizer.transform (regex
+tokenization, stop-word filtering, a count matrix and a normalize pass),
+each distinct field value is analyzed once and cached as its vocabulary
+columns. Encoding a profile is then dict lookups, a count, idf weighting
+and normalization in the same order scikit-learn uses, so the output is
+identical to tf_model.transform on the joined string. Used by
+OrganMatchingService when MATCH_FAST_ENCODER is enabled.
+"""
+import itertools
+import math
+
+import numpy as np
+from scipy import sparse
+
+from ml_memory import sampled_sizeof
+
+SEPARATOR = ', '
+
+
+class ProfileEncoder:
+    def __init__(self, tf_model, cache_size=65536):
+        self.analyzer = tf_model.build_analyzer()
+        self.vocabulary = tf_model.vocabulary_
+        self.idf = np.asarray(tf_model.idf_, dtype=np.float64).tolist() if tf_model.use_idf else None
+        self.binary = tf_model.binary
+        self.norm = tf_model.norm
+        self.n_features = len(self.vocabulary)
+        self.cache_size = cache_size
+        self._columns = {}  # field value -> vocabulary columns of its tokens
+
+    def __len__(self):
+        return len(self._columns)
+
+    def nbytes(self):
+        """Approximate memory held by the field cache, estimated from a sample"""
+        count = len(self._columns)
+        sample = list(itertools.islice(self._columns.items(), 200))
+        return sampled_sizeof(sample, count)
+
+    @staticmethod
+    def supports(tf_model):
+        """
+        Whether per-field encoding reproduces transform for this model
+
+        Fields can be analyzed separately only when no token or n-gram spans
+        the separator, which holds for word unigrams whose analyzer drops
+        the separator itself.
+        """
+        try:
+            return (
+                tf_model.input == 'content'
+                and tf_model.analyzer == 'word'
+                and tuple(tf_model.ngram_range) == (1, 1)
+                and not tf_model.sublinear_tf
+                and tf_model.norm in ('l2', 'l1', None)
+                and np.dtype(tf_model.dtype) == np.float64
+                and (not tf_model.use_idf or hasattr(tf_model, 'idf_'))
+                and not tf_model.build_analyzer()(SEPARATOR)
+            )
+        except AttributeError:
+            return False
+
+    def columns(self, value):
+        """Vocabulary columns of one field value's tokens, with repeats"""
+        columns = self._columns.get(value)
+        if columns is None:
+            vocabulary = self.vocabulary
+            columns = tuple(vocabulary[t] for t in self.analyzer(str(value)) if t in vocabulary)
+            # Field values are drawn from small domains; stop caching past the bound
+            if len(self._columns) < self.cache_size:
+                self._columns[value] = columns
+        return columns
+
+    def encode_fields(self, fields):
+        """
+        Encode one profile
+
+        Args:
+            fields (list): The profile's field values, in query string order
+
+        Returns:
+            tuple: (indices, weights) in ascending column order
+        """
+        counts = {}
+        for value in fields:
+            for column in self.columns(value):
+                counts[column] = counts.get(column, 0) + 1
+        indices = sorted(counts)
+        if self.binary:
+            weights = [1.0] * len(indices)
+        else:
+            weights = [float(counts[j]) for j in indices]
+        if self.idf is not None:
+            idf = self.idf
+            weights = [w * idf[j] for w, j in zip(weights, indices)]
+
+        # Accumulate left to right like sklearn's row normalization; sum() on
+        # floats is compensated on newer Pythons and could differ in the last bit
+        total = 0.0
+        if self.norm == 'l2':
+            for w in weights:
+                total += w * w
+            total = math.sqrt(total)
+        elif self.norm == 'l1':
+            for w in weights:
+                total += abs(w)
+        if total:
+            weights = [w / total for w in weights]
+        return indices, weights
+
+    def matches_transform(self, tf_model, field_lists):
+        """Check bit-for-bit agreement with tf_model.transform on sample profiles"""
+        expected = tf_model.transform([SEPARATOR.join(fields) for fields in field_lists]).tocsr()
+        expected.sort_indices()
+        actual = self.transform(field_lists)
+        return (np.array_equal(expected.indptr, actual.indptr)
+                and np.array_equal(expected.indices, actual.indices)
+                and np.array_equal(expected.data, actual.data))
+
+    def transform(self, field_lists):
+        """
+        Encode several profiles into a CSR matrix, like tf_model.transform
+
+        Args:
+            field_lists (list): One list of field values per profile
+
+        Returns:
+            scipy.sparse.csr_matrix: float64 rows with sorted indices
+        """
+        indptr = [0]
+        indices = []
+        data = []
+        for fields in field_lists:
+            columns, weights = self.encode_fields(fields)
+            indices.extend(columns)
+            data.extend(weights)
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.asarray(data, dtype=np.float64), np.asarray(indices, dtype=np.int32),
+             np.asarray(indptr, dtype=np.int32)),
+            shape=(len(field_lists), self.n_features),
+        )
@@ -0,0 +1,171 @@
+# backend/ml_memory.py
+"""
+Memory accounting for the matching service
+
+component_sizes() breaks a worker's matching memory down by model and
+component (TF-IDF matrix and vocabulary, dataset, search indexes, vector
+cache); rss_bytes() reads the process's resident set size. TracemallocProfiler
+takes tracemalloc snapshots and diffs them against a baseline to find where
+memory grows. All sizes are approximate: arrays report nbytes, DataFrames
+their deep usage, and Python containers a sampled estimate.
+"""
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import sparse
+
+
+def rss_bytes():
+    """Current resident set size of this process (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return 0
+
+
+def sparse_nbytes(matrix):
+    if matrix is None:
+        return 0
+    # CSR/CSC/BSR keep indices and indptr, COO row and col, DIA offsets
+    names = ('data', 'indices', 'indptr', 'row', 'col', 'offsets')
+    return sum(getattr(matrix, name).nbytes for name in names if isinstance(getattr(matrix, name, None), np.ndarray))
+
+
+def deep_sizeof(value):
+    """Size of a value and the lists, tuples, dicts, strings and arrays it holds"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_sizeof(v) for v in value)
+    elif isinstance(value, np.ndarray):
+        size += value.nbytes
+    elif sparse.issparse(value):
+        size += sparse_nbytes(value)
+    return size
+
+
+def sampled_sizeof(items, count, sample=200):
+    """Estimate the total size of `count` items from a random sample of them"""
+    if not count:
+        return 0
+    items = list(items) if len(items) <= sample else random.sample(list(items), sample)
+    return int(sum(deep_sizeof(item) for item in items) / len(items) * count)
+
+
+def tf_model_nbytes(tf_model):
+    if tf_model is None:
+        return 0
+    vocabulary = getattr(tf_model, 'vocabulary_', {})
+    size = sampled_sizeof(list(vocabulary.items()), len(vocabulary)) + sys.getsizeof(vocabulary)
+    idf = getattr(tf_model, 'idf_', None)
+    return size + (idf.nbytes if isinstance(idf, np.ndarray) else 0)
+
+
+def service_sizes(service):
+    """Bytes per component of one OrganMatchingService"""
+    sizes = dict(service.memory_usage())
+    sizes['tf_model'] = tf_model_nbytes(service.tf_model)
+    sizes['vector_cache'] = service.vector_cache.nbytes()
+    if service.encoder is not None:
+        sizes['encoder'] = service.encoder.nbytes()
+    return sizes
+
+
+def component_sizes(registry):
+    """
+    Memory of every resident matching model, by organ and component
+
+    Returns:
+        dict: organ -> {component: bytes}
+    """
+    return {organ: service_sizes(service) for organ, service in registry.services()}
+
+
+class TracemallocProfiler:
+    """Start tracing, keep a baseline snapshot and report the top growing allocation sites"""
+
+    def __init__(self):
+        self.baseline = None
+        self.baseline_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=1):
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+            self.baseline = self.take()
+            self.baseline_at = time.time()
+
+    def stop(self):
+        with self._lock:
+            tracemalloc.stop()
+            self.baseline = None
+            self.baseline_at = None
+
+    @staticmethod
+    def take():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+
+    def top(self, limit=25, key_type='lineno'):
+        """Largest live allocation sites now"""
+        if not self.tracing:
+            return []
+        stats = self.take().statistics(key_type)[:limit]
+        return [{'site': self.site(s.traceback), 'size': s.size, 'count': s.count} for s in stats]
+
+    def diff(self, limit=25, key_type='lineno', rebase=False):
+        """Allocation sites that grew most since the baseline snapshot"""
+        with self._lock:
+            if not self.tracing or self.baseline is None:
+                return []
+            current = self.take()
+            stats = current.compare_to(self.baseline, key_type)[:limit]
+            if rebase:
+                self.baseline = current
+                self.baseline_at = time.time()
+        return [{
+            'site': self.site(s.traceback),
+            'size': s.size,
+            'size_diff': s.size_diff,
+            'count': s.count,
+            'count_diff': s.count_diff,
+        } for s in stats]
+
+    def status(self):
+        traced, peak = tracemalloc.get_traced_memory() if self.tracing else (0, 0)
+        return {
+            'tracing': self.tracing,
+            'frames': tracemalloc.get_traceback_limit() if self.tracing else 0,
+            'traced_bytes': traced,
+            'traced_peak_bytes': peak,
+            'baseline_at': self.baseline_at,
+        }
+
+    @staticmethod
+    def site(traceback):
+        return [f'{frame.filename}:{frame.lineno}' for frame in traceback]
+
+
+# Initialize the profiler (tracing starts only on request)
+tracemalloc_profiler = TracemallocProfiler()
@@ -0,0 +1,53 @@
+# backend/ml_metrics.py
+"""
+Small latency bookkeeping helpers shared by the matching service,
+its dispatcher and the benchmark scripts
+"""
+import threading
+from collections import deque
+
+
+def percentile(sorted_samples, q):
+    """Nearest-rank percentile of an already sorted list (q in 0-100)"""
+    if not sorted_samples:
+        return 0.0
+    rank = int(round(q / 100.0 * (len(sorted_samples) - 1)))
+    return sorted_samples[max(0, min(rank, len(sorted_samples) - 1))]
+
+
+def summarize_latencies(samples):
+    """
+    Summarize latency samples given in seconds
+
+    Returns:
+        dict: count, mean and p50/p95/p99/max in milliseconds
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0,
+                'p99_ms': 0.0, 'max_ms': 0.0}
+    return {
+        'count': len(ordered),
+        'mean_ms': round(1000 * sum(ordered) / len(ordered), 3),
+        'p50_ms': round(1000 * percentile(ordered, 50), 3),
+        'p95_ms': round(1000 * percentile(ordered, 95), 3),
+        'p99_ms': round(1000 * percentile(ordered, 99), 3),
+        'max_ms': round(1000 * ordered[-1], 3),
+    }
+
+
+class LatencyRecorder:
+    """Thread-safe bounded window of the most recent latency samples"""
+
+    def __init__(self, size=2048):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            samples = list(self._samples)
+        return summarize_latencies(samples)
@@ -0,0 +1,241 @@
+# backend/ml_quantized.py
+"""
+Quantized donor vector store for OrganMatchingService
+
+TF-IDF donor rows have only a handful of non-zero terms, so the store keeps
+them sparse: for each non-zero entry of the unit-length row, an int8 code
+(x ~= code * row scale, one float32 scale per row) or a float16 value, plus
+its column in the smallest unsigned type that holds the vocabulary (uint8
+up to 256 terms, uint16 up to 65536). That is 2-3 bytes per entry against
+12 for the float64/int32 CSR matrix. The arrays are saved as .npy files and
+can be memory-mapped back. Queries are scored block by block: each block is
+widened to a float32 CSR matrix and multiplied with the dense float32
+queries, and only scores above a query's current k-th best are merged into
+its running top-k. When re-ranking is on, the top candidates are re-scored
+against the full-precision TF-IDF rows, which then have to stay in memory
+as well.
+Used when MATCH_INDEX_BACKEND is 'quantized'.
+"""
+import os
+
+import numpy as np
+from scipy import sparse
+
+from ml_ann import scores_to_distances, to_unit_rows
+
+DTYPES = ('int8', 'float16')
+FILES = {'codes': 'quantized.npy', 'indices': 'quantized_indices.npy',
+         'indptr': 'quantized_indptr.npy', 'scales': 'quantized_scales.npy'}
+
+
+def index_dtype(n_features):
+    """Smallest integer type that holds every column number"""
+    if n_features <= 1 << 8:
+        return np.uint8
+    if n_features <= 1 << 16:
+        return np.uint16
+    return np.int32
+
+
+def select_top_k(best_scores, best_rows, scores, offset):
+    """
+    Merge one block of scores into running per-query top-k lists, in place
+
+    Args:
+        best_scores (ndarray): (queries, k) best scores so far, -inf when empty
+        best_rows (ndarray): (queries, k) their row numbers
+        scores (ndarray): (block rows, queries) scores of the block
+        offset (int): Row number of the block's first row
+    """
+    n_queries, k = best_scores.shape
+    # Only entries beating a query's current k-th best can enter its list;
+    # once the lists fill up that is a small fraction of the block
+    rows, columns = np.nonzero(scores > best_scores.min(axis=1))
+    if len(rows) > scores.size // 4:
+        by_query = np.ascontiguousarray(scores.T)
+        kk = min(k, by_query.shape[1])
+        top = np.argpartition(-by_query, kk - 1, axis=1)[:, :kk]
+        merged_scores = np.concatenate([best_scores, np.take_along_axis(by_query, top, axis=1)], axis=1)
+        merged_rows = np.concatenate([best_rows, top + offset], axis=1)
+        keep = np.argpartition(-merged_scores, k - 1, axis=1)[:, :k]
+        best_scores[:] = np.take_along_axis(merged_scores, keep, axis=1)
+        best_rows[:] = np.take_along_axis(merged_rows, keep, axis=1)
+        return
+    order = np.argsort(columns, kind='stable')
+    rows, columns = rows[order], columns[order]
+    bounds = np.searchsorted(columns, np.arange(n_queries + 1))
+    for q in np.flatnonzero(np.diff(bounds)):
+        hits = rows[bounds[q]:bounds[q + 1]]
+        merged_scores = np.concatenate([best_scores[q], scores[hits, q]])
+        merged_rows = np.concatenate([best_rows[q], hits + offset])
+        keep = np.argpartition(-merged_scores, k - 1)[:k]
+        best_scores[q] = merged_scores[keep]
+        best_rows[q] = merged_rows[keep]
+
+
+class QuantizedStore:
+    def __init__(self, dtype='int8', block_rows=65536, rerank=False, rerank_factor=4):
+        if dtype not in DTYPES:
+            raise ValueError(f'Unsupported quantized dtype: {dtype}')
+        self.dtype = dtype
+        self.block_rows = block_rows
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        self.codes = None    # (nnz,) int8 or float16 value of each non-zero entry
+        self.indices = None  # (nnz,) column of each entry
+        self.indptr = None   # (n + 1,) row offsets into codes and indices
+        self.scales = None   # (n,) float32 per-row scale, int8 only
+        self.exact = None    # full-precision CSR rows for re-ranking
+        self.exact_norms = None
+
+    def fit(self, vectors):
+        """Quantize the non-zero entries of (sparse or dense) vectors, block by block"""
+        vectors = vectors.tocsr() if sparse.issparse(vectors) else sparse.csr_matrix(vectors)
+        n, d = vectors.shape
+        codes, indices = [], []
+        self.indptr = np.zeros(n + 1, dtype=np.int64 if vectors.nnz >= 2 ** 31 else np.int32)
+        self.scales = np.empty(n, dtype=np.float32) if self.dtype == 'int8' else None
+        nnz = 0
+        for start in range(0, n, self.block_rows):
+            block = vectors[start:start + self.block_rows].astype(np.float64)
+            block.sum_duplicates()
+            lengths = np.diff(block.indptr)
+            norms = np.sqrt(np.asarray(block.multiply(block).sum(axis=1)).ravel())
+            norms[norms == 0] = 1.0
+            values = block.data / np.repeat(norms, lengths)
+            if self.dtype == 'int8':
+                block_codes, scales = self.quantize(values, lengths)
+                self.scales[start:start + len(lengths)] = scales
+            else:
+                block_codes = values.astype(np.float16)
+            codes.append(block_codes)
+            indices.append(block.indices.astype(index_dtype(d)))
+            self.indptr[start + 1:start + 1 + len(lengths)] = nnz + block.indptr[1:]
+            nnz += block.nnz
+        self.codes = np.concatenate(codes) if codes else np.empty(0, dtype=self.dtype)
+        self.indices = np.concatenate(indices) if indices else np.empty(0, dtype=index_dtype(d))
+        return self
+
+    @staticmethod
+    def quantize(values, lengths):
+        """Symmetric per-row int8 quantization of the non-zero values of consecutive rows"""
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        peaks = np.zeros(len(lengths))
+        filled = lengths > 0
+        if values.size:
+            peaks[filled] = np.maximum.reduceat(np.abs(values), starts[filled])
+        scales = peaks / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(values / np.repeat(scales, lengths)).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def attach_exact(self, matrix):
+        """Keep a reference to the full-precision rows used for re-ranking"""
+        self.exact = matrix.tocsr() if hasattr(matrix, 'tocsr') else np.asarray(matrix)
+        if hasattr(self.exact, 'multiply'):
+            norms = np.sqrt(np.asarray(self.exact.multiply(self.exact).sum(axis=1)).ravel())
+        else:
+            norms = np.linalg.norm(self.exact, axis=1)
+        norms[norms == 0] = 1.0
+        self.exact_norms = norms
+        return self
+
+    @property
+    def nbytes(self):
+        # The re-ranking rows are the service's tf_matrix and counted there
+        return sum(a.nbytes for a in (self.codes, self.indices, self.indptr, self.scales) if a is not None)
+
+    def __len__(self):
+        return 0 if self.indptr is None else len(self.indptr) - 1
+
+    def scan(self, queries, k):
+        """Approximate top-k (scores, rows) per query from a blocked scan"""
+        n_queries, n_features = queries.shape
+        query_block = np.ascontiguousarray(queries.T, dtype=np.float32)
+
+        best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+        best_rows = np.full((n_queries, k), -1, dtype=np.int64)
+        for start in range(0, len(self), self.block_rows):
+            end = min(start + self.block_rows, len(self))
+            first, last = int(self.indptr[start]), int(self.indptr[end])
+            block = sparse.csr_matrix(
+                (self.codes[first:last].astype(np.float32), self.indices[first:last].astype(np.int32),
+                 (self.indptr[start:end + 1] - first).astype(np.int32)),
+                shape=(end - start, n_features),
+            )
+            scores = np.asarray(block @ query_block)
+            if self.scales is not None:
+                scores *= self.scales[start:end, None]
+            select_top_k(best_scores, best_rows, scores, start)
+        return best_scores, best_rows
+
+    def search(self, queries, n_neighbors=10, rerank=None):
+        """
+        Nearest donors in the same (distances, indices) shape as NearestNeighbors.kneighbors
+
+        Args:
+            queries: Sparse or dense query vectors
+            n_neighbors (int): Number of neighbors per query
+            rerank (bool): Re-score the candidates at full precision, defaults to self.rerank
+
+        Returns:
+            tuple: (distances, indices) sorted nearest first, padded with -1
+        """
+        rerank = self.rerank if rerank is None else rerank
+        rerank = rerank and self.exact is not None
+        sparse_queries = queries
+        queries = to_unit_rows(queries)
+        n_neighbors = min(n_neighbors, len(self))
+        n_candidates = min(n_neighbors * self.rerank_factor if rerank else n_neighbors, len(self))
+        scores, rows = self.scan(queries, n_candidates)
+
+        distances = np.full((len(queries), n_neighbors), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), n_neighbors), -1, dtype=np.int64)
+        for i in range(len(queries)):
+            candidate_rows, candidate_scores = rows[i], scores[i]
+            if rerank:
+                candidate_scores = self.exact_scores(candidate_rows, sparse_queries, i)
+            order = np.argsort(-candidate_scores, kind='stable')[:n_neighbors]
+            distances[i, :len(order)] = scores_to_distances(candidate_scores[order])
+            indices[i, :len(order)] = candidate_rows[order]
+        return distances, indices
+
+    def exact_scores(self, rows, queries, i):
+        query = queries[i]
+        if hasattr(query, 'toarray'):
+            query = query.toarray()
+        query = np.asarray(query, dtype=np.float64).ravel()
+        norm = np.linalg.norm(query) or 1.0
+        return np.asarray(self.exact[rows] @ (query / norm)).ravel() / self.exact_norms[rows]
+
+    def save(self, directory):
+        """Write the store's arrays as .npy files for memory-mapped loading"""
+        for name, filename in FILES.items():
+            path = os.path.join(directory, filename)
+            array = getattr(self, name)
+            if array is not None:
+                np.save(path, array)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def load(cls, directory, mmap=True, **options):
+        """Open a saved store; with mmap the arrays stay in the page cache, shared between workers"""
+        mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(os.path.join(directory, filename), mmap_mode=mode)
+            for name, filename in FILES.items() if os.path.exists(os.path.join(directory, filename))
+        }
+        store = cls(dtype=str(arrays['codes'].dtype), **options)
+        for name, array in arrays.items():
+            setattr(store, name, array)
+        if store.dtype != 'int8':
+            store.scales = None
+        return store
+
+    @staticmethod
+    def exists(directory):
+        # Stores saved before the sparse layout have no indptr and are rebuilt
+        return bool(directory) and all(
+            os.path.exists(os.path.join(directory, FILES[name])) for name in ('codes', 'indices', 'indptr')
+        )
@@ -0,0 +1,226 @@
+# backend/ml_querylog.py
+"""
+Match query log and offline replay
+
+QueryLog appends one NDJSON line per served match query: the normalized
+recipient profile, n_matches, model version, backend, the returned donor
+indices and the batch's stage timings. Records are queued in memory and
+written by a background thread, so serving never waits on disk; when the
+queue is full records are dropped and counted. replay() feeds a captured log
+through any OrganMatchingService and compares latency and results with what
+was originally served.
+"""
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+from django.conf import settings
+from ml_metrics import summarize_latencies
+
+PROFILE_FIELDS = ('city', 'blood_group', 'organ', 'state')
+
+
+def normalize_profile(profile):
+    """The profile fields that influence matching, as stripped strings"""
+    return {k: str(profile[k]).strip() for k in PROFILE_FIELDS if profile.get(k) not in (None, '')}
+
+
+class QueryLog:
+    def __init__(self, path=None, sample_rate=1.0, max_queue=10000, max_bytes=100 * 1024 * 1024,
+                 flush_interval=1.0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._worker = None
+        self._worker_pid = None
+        self._lock = threading.Lock()
+        self.counters = {'recorded': 0, 'written': 0, 'dropped': 0, 'write_errors': 0}
+
+    @classmethod
+    def from_settings(cls):
+        """Build a query log configured from Django settings; disabled without MATCH_QUERY_LOG"""
+        return cls(
+            path=getattr(settings, 'MATCH_QUERY_LOG', None),
+            sample_rate=getattr(settings, 'MATCH_QUERY_LOG_SAMPLE_RATE', 1.0),
+            max_bytes=int(getattr(settings, 'MATCH_QUERY_LOG_MAX_MB', 100) * 1024 * 1024),
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.sample_rate > 0
+
+    def record(self, profile, n_matches, model_version, backend, indices, timings):
+        """Queue one served query; never blocks"""
+        if not self.enabled or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return
+        entry = {
+            'ts': round(time.time(), 3),
+            'profile': normalize_profile(profile),
+            'n': int(n_matches),
+            'model_version': model_version,
+            'backend': backend,
+            'indices': [int(i) for i in indices if i >= 0],
+            'timings': timings,
+        }
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(entry)
+            self.counters['recorded'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def stats(self):
+        return dict(self.counters, queued=self._queue.qsize(), path=self.path)
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive() and self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            # Restart after a fork: the parent's writer thread does not exist here
+            if self._worker is None or not self._worker.is_alive() or self._worker_pid != os.getpid():
+                self._worker = threading.Thread(target=self._run, name='match-query-log', daemon=True)
+                self._worker_pid = os.getpid()
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < 1000:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in batch))
+            self.counters['written'] += len(batch)
+        except Exception as e:
+            self.counters['write_errors'] += 1
+            print(f"Error writing match query log: {e}")
+
+    def flush(self):
+        """Write everything queued so far from the calling thread"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch and self.path:
+            self._write(batch)
+
+
+def read_log(path, limit=None):
+    """Entries of a captured NDJSON log, skipping malformed lines"""
+    with open(path, encoding='utf-8') as f:
+        for count, line in enumerate(f):
+            if limit is not None and count >= limit:
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def overlap(served, replayed):
+    """Fraction of the originally served indices that the replay also returned"""
+    if not served:
+        return 1.0
+    return len(set(served) & set(replayed)) / len(served)
+
+
+def replay(entries, service, batch_size=1, organ=None):
+    """
+    Replay captured queries through a matching service
+
+    Args:
+        entries (iterable): Query log entries
+        service (OrganMatchingService): Service (any backend) to replay against
+        batch_size (int): Queries per find_matches_batch call; 1 replays one by one
+        organ (str): Only replay queries for this organ
+
+    Returns:
+        dict: Latency distribution, stage timings and overlap with the served results.
+            'latency' is what each query waited, i.e. its whole batch's time;
+            'batch_latency' has one sample per find_matches_batch call, and
+            'throughput_qps' is queries over the total replay time.
+    """
+    latencies, batch_latencies, overlaps, same_version_overlaps = [], [], [], []
+    stages = {'encode_ms': [], 'search_ms': [], 'format_ms': []}
+    identical = 0
+    version_mismatches = 0
+
+    def run(batch):
+        nonlocal identical, version_mismatches
+        timings = {}
+        started = time.perf_counter()
+        results = service.find_matches_batch([e['profile'] for e in batch], [e['n'] for e in batch], timings)
+        elapsed = time.perf_counter() - started
+        for name, samples in stages.items():
+            if name in timings:
+                samples.append(timings[name] / 1000.0)
+        batch_latencies.append(elapsed)
+        for entry, matches in zip(batch, results):
+            # A query's answer is ready only when its whole batch is
+            latencies.append(elapsed)
+            replayed = [m['index'] for m in matches]
+            score = overlap(entry['indices'], replayed)
+            overlaps.append(score)
+            identical += replayed == entry['indices']
+            if entry.get('model_version') == service.model_version:
+                same_version_overlaps.append(score)
+            else:
+                version_mismatches += 1
+
+    batch = []
+    for entry in entries:
+        if organ and entry['profile'].get('organ', '').lower() != organ.lower():
+            continue
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+
+    def mean(values):
+        return round(sum(values) / len(values), 4) if values else None
+
+    return {
+        'queries': len(latencies),
+        'backend': service.backend,
+        'model_version': service.model_version,
+        'batch_size': batch_size,
+        'latency': summarize_latencies(latencies),
+        'batch_latency': summarize_latencies(batch_latencies),
+        'throughput_qps': round(len(latencies) / sum(batch_latencies), 2) if sum(batch_latencies) else None,
+        'stages': {name: summarize_latencies(samples) for name, samples in stages.items()},
+        'overlap': {
+            'mean': mean(overlaps),
+            'mean_same_model_version': mean(same_version_overlaps),
+            'min': round(min(overlaps), 4) if overlaps else None,
+            'identical_fraction': round(identical / len(overlaps), 4) if overlaps else None,
+            'model_version_mismatches': version_mismatches,
+        },
+    }
+
+
+# Initialize the query log
+match_query_log = QueryLog.from_settings()
+atexit.register(match_query_log.flush)
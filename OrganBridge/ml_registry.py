@@ -0,0 +1,207 @@
+# backend/ml_registry.py
+"""
+Registry of per-organ matching models
+
+Each organ type has its own TF-IDF model, matrix and index under
+ml_models/<organ>/, built by train_model.py from that organ's dataset.
+Models are loaded on first use and the least recently used ones are evicted
+once their combined size exceeds MATCH_MODEL_MEMORY_BUDGET_MB. The default
+organ (the original kidney model in ml_models/) is always resident and
+serves organs that have no model of their own.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from ml_services import OrganMatchingService, organ_matching_service
+
+
+def normalize_organ(organ):
+    return str(organ or '').strip().lower()
+
+
+def close_service(service):
+    """Release resources an evicted service holds outside this process"""
+    if service.shard_index is not None:
+        service.shard_index.close()
+
+
+class OrganModelRegistry:
+    def __init__(self, default_service, default_organ='kidney', model_root=None,
+                 memory_budget=512 * 1024 * 1024, backend=None, retry_after=300):
+        self.default_service = default_service
+        self.default_organ = default_organ
+        self.model_root = model_root
+        self.memory_budget = memory_budget
+        self.backend = backend
+        self.retry_after = retry_after
+        self._models = OrderedDict()  # organ -> (service, nbytes), least recently used first
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._failed = {}  # organ -> monotonic time of its last failed load
+        self.counters = {'hits': 0, 'loads': 0, 'evictions': 0, 'fallbacks': 0, 'load_errors': 0}
+
+    @classmethod
+    def from_settings(cls, default_service):
+        """Build a registry configured from Django settings"""
+        return cls(
+            default_service,
+            default_organ=getattr(settings, 'MATCH_DEFAULT_ORGAN', 'kidney'),
+            model_root=os.path.join(settings.BASE_DIR, 'ml_models'),
+            memory_budget=int(getattr(settings, 'MATCH_MODEL_MEMORY_BUDGET_MB', 512) * 1024 * 1024),
+            retry_after=getattr(settings, 'MATCH_MODEL_RETRY_SECONDS', 300),
+        )
+
+    def model_dir(self, organ):
+        return os.path.join(self.model_root, organ) if self.model_root else None
+
+    def has_model(self, organ):
+        model_dir = self.model_dir(organ)
+        return bool(model_dir) and os.path.exists(os.path.join(model_dir, 'tf_model.pkl'))
+
+    def available_organs(self):
+        organs = {self.default_organ}
+        if self.model_root and os.path.isdir(self.model_root):
+            organs.update(name for name in os.listdir(self.model_root) if self.has_model(name))
+        return sorted(organs)
+
+    def get(self, organ):
+        """
+        Matching service for an organ type, loading it on first use
+
+        Returns:
+            OrganMatchingService: The organ's model, or the default model
+        """
+        organ = normalize_organ(organ)
+        if not organ or organ == self.default_organ or not self.has_model(organ):
+            if organ and organ != self.default_organ:
+                self._count('fallbacks')
+            return self.default_service
+
+        with self._lock:
+            entry = self._models.get(organ)
+            if entry is not None:
+                self._models.move_to_end(organ)
+                self.counters['hits'] += 1
+                return entry[0]
+            if self._recently_failed(organ):
+                self.counters['fallbacks'] += 1
+                return self.default_service
+            load_lock = self._load_locks.setdefault(organ, threading.Lock())
+
+        # Only one thread loads a given organ; others wait for it
+        with load_lock:
+            with self._lock:
+                entry = self._models.get(organ)
+                if entry is not None:
+                    self._models.move_to_end(organ)
+                    self.counters['hits'] += 1
+                    return entry[0]
+                if self._recently_failed(organ):
+                    self.counters['fallbacks'] += 1
+                    return self.default_service
+            service = OrganMatchingService(
+                backend=self.backend, model_dir=self.model_dir(organ), data_file='data.csv',
+                query_log=self.default_service.query_log,
+            )
+            if not service.loaded:
+                # Don't retry a missing or broken model on every request
+                with self._lock:
+                    self._failed[organ] = time.monotonic()
+                    self.counters['load_errors'] += 1
+                close_service(service)
+                return self.default_service
+            with self._lock:
+                self._failed.pop(organ, None)
+                self._models[organ] = (service, sum(service.memory_usage().values()))
+                self.counters['loads'] += 1
+                evicted = self._evict(keep=organ)
+            for old in evicted:
+                close_service(old)
+            return service
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _recently_failed(self, organ):
+        # Called with the lock held
+        failed_at = self._failed.get(organ)
+        return failed_at is not None and time.monotonic() - failed_at < self.retry_after
+
+    def evict(self, organ):
+        """Drop one organ's model from memory"""
+        with self._lock:
+            entry = self._models.pop(normalize_organ(organ), None)
+            if entry is not None:
+                self.counters['evictions'] += 1
+        if entry is not None:
+            close_service(entry[0])
+
+    def services(self):
+        """(organ, service) for the default model and every resident organ model"""
+        with self._lock:
+            resident = [(organ, service) for organ, (service, _) in self._models.items()]
+        return [(self.default_organ, self.default_service)] + resident
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._models.values())
+
+    def stats(self):
+        with self._lock:
+            resident = {organ: nbytes for organ, (_, nbytes) in self._models.items()}
+            counters = dict(self.counters)
+            failed = sorted(self._failed)
+        return {
+            'default_organ': self.default_organ,
+            'resident': resident,
+            'resident_bytes': sum(resident.values()),
+            'memory_budget': self.memory_budget,
+            'failed': failed,
+            **counters,
+        }
+
+    def _evict(self, keep):
+        """
+        Drop least recently used models until the budget is met
+
+        Called with the lock held; never evicts the model that was just loaded.
+        Returns the evicted services so they can be closed outside the lock.
+        """
+        total = sum(nbytes for _, nbytes in self._models.values())
+        evicted = []
+        for organ in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if organ == keep:
+                continue
+            service, nbytes = self._models.pop(organ)
+            total -= nbytes
+            evicted.append(service)
+            self.counters['evictions'] += 1
+        return evicted
+
+    def find_matches(self, recipient_profile, n_matches=5):
+        """Find organ matches with the model of the organ being requested"""
+        return self.get(recipient_profile.get('organ')).find_matches(recipient_profile, n_matches)
+
+    def find_matches_batch(self, recipient_profiles, n_matches):
+        """Group queries by organ model, run one batch per model and restore the order"""
+        groups = {}
+        for i, profile in enumerate(recipient_profiles):
+            service = self.get(profile.get('organ'))
+            groups.setdefault(id(service), (service, []))[1].append(i)
+        results = [[] for _ in recipient_profiles]
+        for service, rows in groups.values():
+            found = service.find_matches_batch(
+                [recipient_profiles[i] for i in rows], [n_matches[i] for i in rows]
+            )
+            for i, matches in zip(rows, found):
+                results[i] = matches
+        return results
+
+
+# Initialize the registry
+organ_model_registry = OrganModelRegistry.from_settings(organ_matching_service)
@@ -2,44 +2,238 @@
 import pandas as pd
 import numpy as np
 import pickle
-from sklearn.feature_extraction.text import TfidfVectorizer
+import hashlib
+from scipy import sparse
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 import os
+import time
 from django.conf import settings
+from ml_vectors import ProfileVectorCache
+from ml_encoder import ProfileEncoder
+from ml_ann import IVFIndex
+from ml_quantized import QuantizedStore
+from ml_sharding import ShardedIndex, data_regions, normalize_region
+from ml_querylog import match_query_log
+
+def parse_match_count(value, limit=None):
+    """
+    Validate a requested number of matches
+    
+    Args:
+        value: The requested count, as an int or a numeric string
+        limit (int): Upper bound, MATCH_MAX_RESULTS by default
+    
+    Returns:
+        int: The count clamped to [1, limit]
+    
+    Raises:
+        ValueError: If the value is not an integer
+    """
+    if isinstance(value, bool):
+        raise ValueError(f'n_matches must be an integer, got {value!r}')
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'n_matches must be an integer, got {value!r}')
+    if isinstance(value, float) and value != count:
+        raise ValueError(f'n_matches must be an integer, got {value!r}')
+    limit = limit or getattr(settings, 'MATCH_MAX_RESULTS', 100)
+    return min(max(count, 1), limit)
 
 class OrganMatchingService:
-    def __init__(self):
+    def __init__(self, autoload=True, backend=None, model_dir=None, data_file='KidneyData.csv', query_log=None):
         self.tf_model = None
         self.tf_matrix = None
         self.nn_model = None
+        self.ann_index = None
+        self.shard_index = None
+        self.quant_index = None
         self.data = None
-        self.load_models()
+        self.model_dir = model_dir
+        self.data_file = data_file
+        self.loaded = False
+        # 'exact' (NearestNeighbors), 'ivf' (approximate, see ml_ann.py),
+        # 'sharded' (per-region worker processes, see ml_sharding.py)
+        # or 'quantized' (int8/float16 vectors, see ml_quantized.py)
+        self.backend = backend or getattr(settings, 'MATCH_INDEX_BACKEND', 'exact')
+        self.model_version = None
+        # Fast path for tf_model.transform on profiles (see ml_encoder.py)
+        self.encoder = None
+        self.vector_cache = ProfileVectorCache.from_settings()
+        # Served queries are recorded here when set (see ml_querylog.py)
+        self.query_log = query_log
+        if autoload:
+            self.load_models()
+
+    @classmethod
+    def from_components(cls, tf_model, tf_matrix, data, backend=None):
+        """Build a service around already-trained components (benchmarks, scripts)"""
+        service = cls(autoload=False, backend=backend)
+        service.tf_model = tf_model
+        service.tf_matrix = tf_matrix
+        service.data = data
+        service.model_version = service.compute_model_version()
+        service.prepare_data()
+        service.encoder = service.build_encoder()
+        service.build_index()
+        service.loaded = True
+        return service
     
     def load_models(self):
         """Load pre-trained models and data"""
         try:
             # Define paths for model files
-            model_dir = os.path.join(settings.BASE_DIR, 'ml_models')
+            model_dir = self.model_dir or os.path.join(settings.BASE_DIR, 'ml_models')
+            self.model_dir = model_dir
             
             # Load TF-IDF model
             with open(os.path.join(model_dir, 'tf_model.pkl'), 'rb') as f:
                 self.tf_model = pickle.load(f)
+            self.model_version = self.compute_model_version()
             
             # Load TF-IDF matrix
             with open(os.path.join(model_dir, 'tf_matrix.pkl'), 'rb') as f:
                 self.tf_matrix = pickle.load(f)
             
             # Load training data
-            self.data = pd.read_csv(os.path.join(model_dir, 'KidneyData.csv'))
+            self.data = pd.read_csv(os.path.join(model_dir, self.data_file))
             self.prepare_data()
+            self.encoder = self.build_encoder()
             
-            # Initialize and fit NearestNeighbors
-            self.nn_model = NearestNeighbors(n_neighbors=10, algorithm='ball_tree')
-            self.nn_model.fit(self.tf_matrix)
+            self.build_index()
+            self.loaded = True
             
         except Exception as e:
             print(f"Error loading models: {e}")
+
+    def build_encoder(self, n_samples=256):
+        """Precompiled profile encoder, or None to keep using tf_model.transform"""
+        if not getattr(settings, 'MATCH_FAST_ENCODER', True) or not ProfileEncoder.supports(self.tf_model):
+            return None
+        encoder = ProfileEncoder(self.tf_model, cache_size=getattr(settings, 'MATCH_ENCODER_CACHE_SIZE', 65536))
+        # Guard against analyzer or arithmetic differences in this scikit-learn
+        # build; donor categories double as samples and warm the field cache
+        samples = []
+        if self.data is not None and 'category' in self.data.columns:
+            samples = [c.split(',') for c in self.data['category'].head(n_samples)]
+        if samples and not encoder.matches_transform(self.tf_model, samples):
+            print("ProfileEncoder disagrees with tf_model.transform, using transform")
+            return None
+        return encoder
+
+    def build_index(self):
+        """Build the donor search index selected by the backend setting"""
+        if self.backend == 'ivf':
+            self.ann_index = self.load_ann_index()
+            self.nn_model = None
+        elif self.backend == 'sharded':
+            self.shard_index = ShardedIndex(
+                self.tf_matrix,
+                data_regions(self.data, getattr(settings, 'MATCH_CITY_REGIONS', None)),
+                n_processes=getattr(settings, 'MATCH_SHARD_PROCESSES', None),
+            )
+            self.nn_model = None
+        elif self.backend == 'quantized':
+            self.quant_index = self.load_quantized_index()
+            self.nn_model = None
+            if self.quant_index.exact is None:
+                # Without re-ranking the store replaces the float64 rows
+                self.tf_matrix = None
+        else:
+            # Initialize and fit NearestNeighbors
+            self.nn_model = NearestNeighbors(n_neighbors=10, algorithm='ball_tree')
+            self.nn_model.fit(self.tf_matrix)
+            self.ann_index = None
+    
+    def load_ann_index(self):
+        """Load the IVF index built by train_model.py, or build one in memory"""
+        n_probe = getattr(settings, 'MATCH_ANN_NPROBE', 8)
+        path = os.path.join(self.model_dir, 'ann_index.npz') if self.model_dir else None
+        if path and os.path.exists(path):
+            index = IVFIndex.load(path, n_probe=n_probe)
+            if len(index.ids) == self.tf_matrix.shape[0]:
+                return index
+            print("ann_index.npz does not match tf_matrix, rebuilding in memory")
+        return IVFIndex(n_lists=getattr(settings, 'MATCH_ANN_NLISTS', None), n_probe=n_probe).fit(self.tf_matrix)
+    
+    def load_quantized_index(self):
+        """Memory-map the quantized store built by train_model.py, or quantize in memory"""
+        options = {
+            'rerank': getattr(settings, 'MATCH_QUANT_RERANK', False),
+            'rerank_factor': getattr(settings, 'MATCH_QUANT_RERANK_FACTOR', 4),
+            'block_rows': getattr(settings, 'MATCH_QUANT_BLOCK_ROWS', 65536),
+        }
+        dtype = getattr(settings, 'MATCH_QUANT_DTYPE', 'int8')
+        store = None
+        if QuantizedStore.exists(self.model_dir):
+            store = QuantizedStore.load(self.model_dir, mmap=getattr(settings, 'MATCH_QUANT_MMAP', True), **options)
+            if len(store) != self.tf_matrix.shape[0] or store.dtype != dtype:
+                print("quantized.npy does not match tf_matrix or MATCH_QUANT_DTYPE, rebuilding in memory")
+                store = None
+        if store is None:
+            store = QuantizedStore(dtype=dtype, **options).fit(self.tf_matrix)
+        if store.rerank:
+            store.attach_exact(self.tf_matrix)
+        return store
+    
+    def query_regions(self, recipient_profile):
+        """Regions (states) whose shards a query is sent to; None means all shards"""
+        if getattr(settings, 'MATCH_SHARD_FANOUT', 'region') == 'all':
+            return None
+        region = normalize_region(recipient_profile.get('state'))
+        if not region:
+            return None
+        return [region] + list(getattr(settings, 'MATCH_SHARD_NEIGHBORS', {}).get(region, []))
+    
+    def search(self, query_matrix, n_neighbors, regions=None):
+        """
+        Nearest donors for each query row
+        
+        Args:
+            query_matrix: TF-IDF query vectors
+            n_neighbors (int): Number of neighbors per query
+            regions (list): Per query regions to search (sharded backend only)
+        
+        Returns:
+            tuple: (distances, indices) as returned by NearestNeighbors.kneighbors
+        """
+        if self.shard_index is not None:
+            return self.shard_index.search(query_matrix, n_neighbors, regions)
+        if self.ann_index is not None:
+            return self.ann_index.search(query_matrix, n_neighbors)
+        if self.quant_index is not None:
+            return self.quant_index.search(query_matrix, n_neighbors)
+        return self.nn_model.kneighbors(query_matrix.toarray(), n_neighbors=n_neighbors)
+    
+    def memory_usage(self):
+        """Approximate resident bytes of each loaded component"""
+        usage = {'tf_matrix': 0, 'data': 0, 'nn_index': 0, 'ann_index': 0}
+        if self.tf_matrix is not None:
+            usage['tf_matrix'] = sum(
+                getattr(self.tf_matrix, name).nbytes for name in ('data', 'indices', 'indptr')
+            )
+        if self.data is not None:
+            usage['data'] = int(self.data.memory_usage(deep=True).sum())
+        fit_x = getattr(self.nn_model, '_fit_X', None)
+        if isinstance(fit_x, np.ndarray):
+            usage['nn_index'] = fit_x.nbytes
+        if self.ann_index is not None:
+            usage['ann_index'] = self.ann_index.nbytes
+        if self.shard_index is not None:
+            usage['shard_index'] = self.shard_index.nbytes
+        if self.quant_index is not None:
+            # Memory-mapped codes are file-backed pages shared between workers
+            usage['quant_index'] = self.quant_index.nbytes
+        return usage
+    
+    def compute_model_version(self):
+        """Short fingerprint of the fitted TF-IDF vocabulary and idf weights"""
+        digest = hashlib.sha1()
+        for term, column in sorted(self.tf_model.vocabulary_.items()):
+            digest.update(f'{term}:{column};'.encode())
+        digest.update(np.asarray(self.tf_model.idf_, dtype=np.float64).tobytes())
+        return digest.hexdigest()[:12]
     
     def prepare_data(self):
         """Prepare data similar to the notebook"""
@@ -59,6 +253,35 @@ class OrganMatchingService:
             self.data[category_cols], sep=','
         )
     
+    def build_query_fields(self, recipient_profile):
+        """Field values of the TF-IDF search query used by find_matches"""
+        query_parts = []
+        
+        # Add relevant fields to query
+        if 'city' in recipient_profile:
+            query_parts.append(recipient_profile['city'])
+        if 'blood_group' in recipient_profile:
+            query_parts.append(recipient_profile['blood_group'])
+        if 'organ' in recipient_profile:
+            query_parts.append(recipient_profile['organ'])
+        
+        return query_parts
+    
+    def build_query_string(self, recipient_profile):
+        """Create the TF-IDF search query used by find_matches"""
+        return ', '.join(self.build_query_fields(recipient_profile))
+    
+    def encode(self, field_lists):
+        """
+        TF-IDF rows for profiles given as lists of field values
+        
+        Identical to tf_model.transform on the ', '-joined strings; uses the
+        precompiled encoder when one was built for the loaded model.
+        """
+        if self.encoder is not None:
+            return self.encoder.transform(field_lists)
+        return self.tf_model.transform([', '.join(fields) for fields in field_lists])
+    
     def find_matches(self, recipient_profile, n_matches=5):
         """
         Find organ matches for a recipient
@@ -70,81 +293,200 @@ class OrganMatchingService:
         Returns:
             list: List of matched donor profiles
         """
+        return self.find_matches_batch([recipient_profile], [n_matches])[0]
+    
+    def find_matches_batch(self, recipient_profiles, n_matches, timings=None):
+        """
+        Find organ matches for several recipients at once
+        
+        All queries are encoded together and searched
+        with a single kneighbors call, then split back per recipient.
+        
+        Args:
+            recipient_profiles (list): Recipient profile dicts
+            n_matches (list): Number of matches to return for each profile
+            timings (dict): Filled with the batch's encode/search/format times in ms
+        
+        Returns:
+            list: One list of matched donor profiles per recipient
+        """
+        results = [[] for _ in recipient_profiles]
+        # Validate each request on its own so one bad count only fails that request
+        rows, counts = [], []
+        query_fields = [self.build_query_fields(p) for p in recipient_profiles]
+        for i, fields in enumerate(query_fields):
+            if not ', '.join(fields):
+                continue
+            try:
+                counts.append(min(parse_match_count(n_matches[i]), len(self.data)))
+            except ValueError as e:
+                print(f"Error finding matches: {e}")
+                continue
+            rows.append(i)
+        if not rows:
+            return results
+        
         try:
-            # Create search query from recipient profile
-            query_parts = []
-            
-            # Add relevant fields to query
-            if 'city' in recipient_profile:
-                query_parts.append(recipient_profile['city'])
-            if 'blood_group' in recipient_profile:
-                query_parts.append(recipient_profile['blood_group'])
-            if 'organ' in recipient_profile:
-                query_parts.append(recipient_profile['organ'])
-            
-            query_string = ', '.join(query_parts)
-            
-            if not query_string:
-                return []
-            
-            # Transform query using TF-IDF
-            query_vector = self.tf_model.transform([query_string])
-            
-            # Find nearest neighbors
-            distances, indices = self.nn_model.kneighbors(
-                query_vector.todense(), n_neighbors=n_matches
-            )
-            
-            # Get matched profiles
-            matches = []
-            for i, idx in enumerate(indices[0]):
-                if idx < len(self.data):
-                    match_data = self.data.iloc[idx]
-                    matches.append({
-                        'index': int(idx),
-                        'distance': float(distances[0][i]),
-                        'category': match_data['category'],
-                        'delta': match_data['Delta'],
-                        'similarity_score': 1 - (distances[0][i] / 2)  # Convert distance to similarity
-                    })
-            
-            return matches
+            # Encode queries to TF-IDF rows
+            started = time.perf_counter()
+            query_matrix = self.encode([query_fields[i] for i in rows])
+            encoded = time.perf_counter()
             
+            # Find nearest neighbors for the largest request, then slice
+            regions = [self.query_regions(recipient_profiles[i]) for i in rows]
+            distances, indices = self.search(query_matrix, max(counts), regions)
+            searched = time.perf_counter()
         except Exception as e:
-            print(f"Error finding matches: {e}")
-            return []
+            if len(rows) == 1:
+                print(f"Error finding matches: {e}")
+                return results
+            # Retry one query at a time so a failing query doesn't empty the others
+            for i, n in zip(rows, counts):
+                results[i] = self.find_matches_batch([recipient_profiles[i]], [n])[0]
+            return results
+        
+        for row, (i, n) in enumerate(zip(rows, counts)):
+            try:
+                results[i] = self.format_matches(distances[row][:n], indices[row][:n])
+            except Exception as e:
+                print(f"Error formatting matches: {e}")
+        
+        stages = {
+            'encode_ms': round(1000 * (encoded - started), 3),
+            'search_ms': round(1000 * (searched - encoded), 3),
+            'format_ms': round(1000 * (time.perf_counter() - searched), 3),
+            'batch_size': len(rows),
+        }
+        if timings is not None:
+            timings.update(stages)
+        if self.query_log is not None:
+            for row, (i, n) in enumerate(zip(rows, counts)):
+                self.query_log.record(recipient_profiles[i], n, self.model_version, self.backend,
+                                      indices[row][:n], stages)
+        
+        return results
+    
+    def format_matches(self, distances, indices):
+        """Turn one row of kneighbors output into matched donor profiles"""
+        matches = []
+        for distance, idx in zip(distances, indices):
+            if 0 <= idx < len(self.data):
+                match_data = self.data.iloc[idx]
+                matches.append({
+                    'index': int(idx),
+                    'distance': float(distance),
+                    'category': match_data['category'],
+                    'delta': match_data['Delta'],
+                    'similarity_score': 1 - (distance / 2)  # Convert distance to similarity
+                })
+        return matches
     
-    def get_compatibility_score(self, donor_profile, recipient_profile):
+    def get_compatibility_score(self, donor_profile, recipient_profile, donor_id=None, recipient_id=None):
         """
         Calculate compatibility score between donor and recipient
         
         Args:
             donor_profile (dict): Donor's profile
             recipient_profile (dict): Recipient's profile
+            donor_id (int): Donor id, enables the vector cache for the donor
+            recipient_id (int): Recipient id, enables the vector cache for the recipient
         
         Returns:
             float: Compatibility score (0-1)
         """
         try:
-            # Create profiles for comparison
-            donor_query = self.create_profile_string(donor_profile)
-            recipient_query = self.create_profile_string(recipient_profile)
-            
-            # Transform both profiles
-            donor_vector = self.tf_model.transform([donor_query])
-            recipient_vector = self.tf_model.transform([recipient_query])
-            
-            # Calculate cosine similarity
-            similarity = cosine_similarity(donor_vector, recipient_vector)[0][0]
+            donor_vector = self.profile_vectors('donor', [(donor_id, donor_profile)])[0]
+            recipient_vector = self.profile_vectors('recipient', [(recipient_id, recipient_profile)])[0]
             
-            return float(similarity)
+            # Vectors are L2-normalized, so the dot product is the cosine similarity
+            return float(self.dot(donor_vector, recipient_vector))
             
         except Exception as e:
             print(f"Error calculating compatibility: {e}")
             return 0.0
     
-    def create_profile_string(self, profile):
-        """Create a string representation of a profile for TF-IDF"""
+    def get_compatibility_scores(self, donor_entries, recipient_entries):
+        """
+        Calculate compatibility scores between many donors and many recipients
+        
+        Args:
+            donor_entries (list): (donor_id, donor_profile) pairs
+            recipient_entries (list): (recipient_id, recipient_profile) pairs
+        
+        Returns:
+            numpy.ndarray: Scores with one row per donor and one column per recipient
+        """
+        donor_vectors = self.profile_vectors('donor', donor_entries)
+        recipient_vectors = self.profile_vectors('recipient', recipient_entries)
+        return self.score_matrix(donor_vectors, recipient_vectors)
+    
+    def profile_vectors(self, kind, entries):
+        """
+        L2-normalized TF-IDF vectors for (object_id, profile) pairs
+        
+        Vectors of entries with an object id are served from and added to the
+        vector cache, which reads and writes the database in bulk; all misses
+        are encoded together.
+        
+        Returns:
+            list: One (indices, weights) tuple per entry
+        """
+        fields = [self.profile_fields(profile) for _, profile in entries]
+        strings = [', '.join(parts) for parts in fields]
+        vectors = [None] * len(entries)
+        cached = [i for i, (object_id, _) in enumerate(entries) if object_id is not None]
+        if cached:
+            found = self.vector_cache.get_many(
+                kind, self.model_version, [(entries[i][0], strings[i]) for i in cached]
+            )
+            for i, vector in zip(cached, found):
+                vectors[i] = vector
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        
+        if misses:
+            matrix = self.vectorize([fields[i] for i in misses])
+            new_entries = []
+            for row, i in enumerate(misses):
+                start, end = matrix.indptr[row], matrix.indptr[row + 1]
+                vectors[i] = (matrix.indices[start:end].tolist(), matrix.data[start:end].tolist())
+                if entries[i][0] is not None:
+                    new_entries.append((entries[i][0], strings[i], vectors[i]))
+            self.vector_cache.put_many(kind, self.model_version, new_entries)
+        
+        return vectors
+    
+    def vectorize(self, field_lists):
+        """Encode profiles (lists of field values) into an L2-normalized CSR matrix"""
+        matrix = self.encode(field_lists).tocsr()
+        # transform already L2-normalizes rows unless the model uses another norm
+        if self.tf_model.norm != 'l2':
+            matrix = normalize(matrix, norm='l2', copy=False)
+        return matrix
+    
+    def stack_vectors(self, vectors):
+        """Build a CSR matrix from (indices, weights) tuples"""
+        indptr = np.zeros(len(vectors) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(indices) for indices, _ in vectors])
+        indices = np.fromiter((j for v in vectors for j in v[0]), dtype=np.int64, count=indptr[-1])
+        weights = np.fromiter((w for v in vectors for w in v[1]), dtype=np.float64, count=indptr[-1])
+        return sparse.csr_matrix(
+            (weights, indices, indptr), shape=(len(vectors), len(self.tf_model.vocabulary_))
+        )
+    
+    def score_matrix(self, row_vectors, column_vectors):
+        """Cosine scores between two lists of normalized vectors with one sparse product"""
+        rows = self.stack_vectors(row_vectors)
+        columns = self.stack_vectors(column_vectors)
+        return (rows @ columns.T).toarray()
+    
+    @staticmethod
+    def dot(a, b):
+        """Dot product of two (indices, weights) vectors"""
+        weights = dict(zip(*b))
+        return sum(w * weights.get(j, 0.0) for j, w in zip(*a))
+    
+    def profile_fields(self, profile):
+        """Field values of a profile's TF-IDF representation, in order"""
         parts = []
         
         # Add relevant fields
@@ -155,7 +497,11 @@ class OrganMatchingService:
             if field in profile and profile[field]:
                 parts.append(str(profile[field]))
         
-        return ', '.join(parts)
+        return parts
+    
+    def create_profile_string(self, profile):
+        """Create a string representation of a profile for TF-IDF"""
+        return ', '.join(self.profile_fields(profile))
 
 # Initialize the service
-organ_matching_service = OrganMatchingService()
\ No newline at end of file
+organ_matching_service = OrganMatchingService(query_log=match_query_log)
\ No newline at end of file
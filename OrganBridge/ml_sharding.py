@@ -0,0 +1,234 @@
+# backend/ml_sharding.py
+"""
+Region-sharded donor index with scatter-gather top-k merge
+
+Donors are partitioned by region (state). Each shard's unit vectors are
+written once to a temporary .npy file and memory-mapped by the worker
+process that serves it, so the parent keeps no copy and can respawn
+workers (after a fork or a failed request) without rebuilding. A query is
+sent to the processes holding its relevant shards in parallel, every shard
+returns its own top-k, and the lists are merged with a heap. Used by
+OrganMatchingService when MATCH_INDEX_BACKEND is 'sharded'.
+"""
+import atexit
+import heapq
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+
+import numpy as np
+
+from ml_ann import scores_to_distances, to_unit_rows
+
+# Cities in the training data without a State column
+DEFAULT_CITY_REGIONS = {
+    'seattle': 'wa', 'detroit': 'mi', 'phoenix': 'az', 'houston': 'tx',
+    'baltimore': 'md', 'atlanta': 'ga', 'new york': 'ny', 'san fransisco': 'ca',
+    'san francisco': 'ca',
+}
+
+
+US_STATES = {
+    'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar', 'california': 'ca',
+    'colorado': 'co', 'connecticut': 'ct', 'delaware': 'de', 'district of columbia': 'dc',
+    'florida': 'fl', 'georgia': 'ga', 'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il',
+    'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks', 'kentucky': 'ky', 'louisiana': 'la',
+    'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma', 'michigan': 'mi', 'minnesota': 'mn',
+    'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt', 'nebraska': 'ne', 'nevada': 'nv',
+    'new hampshire': 'nh', 'new jersey': 'nj', 'new mexico': 'nm', 'new york': 'ny',
+    'north carolina': 'nc', 'north dakota': 'nd', 'ohio': 'oh', 'oklahoma': 'ok', 'oregon': 'or',
+    'pennsylvania': 'pa', 'rhode island': 'ri', 'south carolina': 'sc', 'south dakota': 'sd',
+    'tennessee': 'tn', 'texas': 'tx', 'utah': 'ut', 'vermont': 'vt', 'virginia': 'va',
+    'washington': 'wa', 'west virginia': 'wv', 'wisconsin': 'wi', 'wyoming': 'wy',
+    'puerto rico': 'pr',
+}
+
+
+def normalize_region(value):
+    """Two-letter code for a state given as a code or a (free-text) name"""
+    # 'N.Y.' -> 'ny', ' New  York ' -> 'new york'
+    region = ' '.join(str(value or '').replace('.', '').split()).lower()
+    if region.endswith(' state'):
+        region = region[:-len(' state')]
+    return US_STATES.get(region, region)
+
+
+def data_regions(data, city_regions=None):
+    """Region of every dataset row: its State column, or the state of its City"""
+    if 'State' in data.columns:
+        return [normalize_region(v) for v in data['State']]
+    city_regions = city_regions or DEFAULT_CITY_REGIONS
+    return [city_regions.get(normalize_region(city), 'other') for city in data['City']]
+
+
+def _search_shards(shards, queries, wanted, k):
+    """Top-k (score, row) lists per query over the shards each query wants"""
+    results = [[] for _ in range(len(queries))]
+    for region, (rows, vectors) in shards.items():
+        targets = [i for i, regions in enumerate(wanted) if regions is None or region in regions]
+        if not targets or not len(rows):
+            continue
+        scores = vectors @ queries[targets].T
+        kk = min(k, len(rows))
+        top = np.argpartition(-scores, kk - 1, axis=0)[:kk]
+        for col, i in enumerate(targets):
+            picked = top[:, col]
+            results[i].extend(zip(scores[picked, col].tolist(), rows[picked].tolist()))
+    return [heapq.nlargest(k, found) for found in results]
+
+
+def _shard_worker(conn, paths):
+    """Worker process loop: map the shards it serves and answer search requests"""
+    shards = {
+        region: (np.load(rows_path, mmap_mode='r'), np.load(vectors_path, mmap_mode='r'))
+        for region, (rows_path, vectors_path) in paths.items()
+    }
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        queries, wanted, k = message
+        conn.send(_search_shards(shards, queries, wanted, k))
+
+
+class ShardedIndex:
+    def __init__(self, vectors, regions, n_processes=None):
+        vectors = to_unit_rows(vectors)
+        regions = np.asarray([normalize_region(r) for r in regions])
+        self._dir = tempfile.mkdtemp(prefix='organ-shards-')
+        weakref.finalize(self, shutil.rmtree, self._dir, True)
+        self.shards = {}  # region -> (rows path, vectors path, row count)
+        self._nbytes = 0
+        for i, region in enumerate(sorted(set(regions.tolist()))):
+            rows = np.flatnonzero(regions == region).astype(np.int64)
+            shard = np.ascontiguousarray(vectors[rows])
+            paths = (os.path.join(self._dir, f'{i}_rows.npy'), os.path.join(self._dir, f'{i}_vectors.npy'))
+            np.save(paths[0], rows)
+            np.save(paths[1], shard)
+            self.shards[region] = paths + (len(rows),)
+            self._nbytes += rows.nbytes + shard.nbytes
+        self.n_rows = len(vectors)
+        self.n_processes = min(n_processes or os.cpu_count() or 1, len(self.shards)) or 1
+        # Spread shards over processes, largest first, onto the least loaded process
+        self.placement = {}
+        load = [(0, p) for p in range(self.n_processes)]
+        for region in sorted(self.shards, key=lambda r: -self.shards[r][2]):
+            size, p = heapq.heappop(load)
+            self.placement[region] = p
+            heapq.heappush(load, (size + self.shards[region][2], p))
+        self._workers = []
+        self._pid = None
+        self._lock = threading.RLock()
+
+    @property
+    def nbytes(self):
+        # Held once, as file-backed pages mapped by the worker processes
+        return self._nbytes
+
+    def start(self):
+        """Start one worker process per group of shards (again after a fork)"""
+        self.close()
+        self._workers = []
+        if self not in _open_indexes:
+            _open_indexes.append(self)
+        ctx = multiprocessing.get_context('spawn')
+        for p in range(self.n_processes):
+            parent, child = ctx.Pipe()
+            hosted = {r: shard[:2] for r, shard in self.shards.items() if self.placement[r] == p}
+            process = ctx.Process(target=_shard_worker, args=(child, hosted), daemon=True)
+            process.start()
+            child.close()
+            self._workers.append((process, parent))
+        self._pid = os.getpid()
+
+    def close(self):
+        # Workers inherited through a fork belong to the parent process
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            for process, conn in self._workers:
+                try:
+                    conn.send(None)
+                    conn.close()
+                except (OSError, EOFError):
+                    pass
+                process.join(timeout=1)
+            self._workers = []
+            # A later search starts fresh workers
+            self._pid = None
+        if self in _open_indexes:
+            _open_indexes.remove(self)
+
+    def search(self, queries, n_neighbors=10, regions=None):
+        """
+        Scatter queries to the shards of their regions and merge the top-k lists
+
+        Args:
+            queries: Sparse or dense query vectors
+            n_neighbors (int): Number of neighbors per query
+            regions (list): Per query, a region name, a collection of regions,
+                or None to search every shard
+
+        Returns:
+            tuple: (distances, indices) like NearestNeighbors.kneighbors, padded with -1
+        """
+        queries = to_unit_rows(queries)
+        n_neighbors = min(n_neighbors, self.n_rows)
+        wanted = [self._resolve(r) for r in (regions or [None] * len(queries))]
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self.start()
+            # Scatter to every process holding a wanted shard, then gather
+            busy = set()
+            for region, p in self.placement.items():
+                if any(w is None or region in w for w in wanted):
+                    busy.add(p)
+            try:
+                for p in busy:
+                    self._workers[p][1].send((queries, wanted, n_neighbors))
+                partials = [self._workers[p][1].recv() for p in busy]
+            except Exception:
+                # Replies still in flight would be read by the next query;
+                # drop every worker so the next search starts clean ones
+                self._reset()
+                raise
+
+        distances = np.full((len(queries), n_neighbors), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), n_neighbors), -1, dtype=np.int64)
+        for i in range(len(queries)):
+            merged = heapq.nlargest(n_neighbors, (hit for partial in partials for hit in partial[i]))
+            if merged:
+                scores, rows = zip(*merged)
+                distances[i, :len(merged)] = scores_to_distances(np.asarray(scores))
+                indices[i, :len(merged)] = rows
+        return distances, indices
+
+    def _reset(self):
+        # Called with the lock held
+        for process, conn in self._workers:
+            conn.close()
+            process.terminate()
+            process.join(timeout=1)
+        self._workers = []
+        self._pid = None
+
+    def _resolve(self, region):
+        # Unknown or missing regions fall back to searching every shard
+        if region is None:
+            return None
+        wanted = {normalize_region(region)} if isinstance(region, str) else {normalize_region(r) for r in region}
+        wanted &= set(self.shards)
+        return wanted or None
+
+
+_open_indexes = []
+
+
+@atexit.register
+def _close_open_indexes():
+    for index in list(_open_indexes):
+        index.close()
@@ -0,0 +1,176 @@
+# backend/ml_vectors.py
+"""
+Cache of transformed, L2-normalized profile vectors
+
+Vectors are keyed by (kind, object id, model version) and kept in a bounded
+in-memory LRU. When persistence is enabled they are also written to the
+ProfileVector table so they survive restarts.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.utils import timezone
+from ml_memory import sampled_sizeof
+
+
+class ProfileVectorCache:
+    def __init__(self, max_entries=100000, persist=False):
+        self.max_entries = max_entries
+        self.persist = persist
+        self._entries = OrderedDict()  # (kind, id, version) -> (profile string, vector)
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'db_hits': 0, 'misses': 0}
+
+    @classmethod
+    def from_settings(cls):
+        """Build a cache configured from Django settings"""
+        return cls(
+            max_entries=getattr(settings, 'PROFILE_VECTOR_CACHE_SIZE', 100000),
+            persist=getattr(settings, 'PROFILE_VECTOR_CACHE_PERSIST', False),
+        )
+
+    def get(self, kind, object_id, model_version, profile_string):
+        """
+        Look up a cached vector
+
+        The stored profile string must match, so a changed profile is
+        never served a stale vector.
+
+        Returns:
+            tuple: (indices, weights) or None on a miss
+        """
+        return self.get_many(kind, model_version, [(object_id, profile_string)])[0]
+
+    def get_many(self, kind, model_version, entries):
+        """
+        Look up several vectors, reading memory misses from the database in one query
+
+        Args:
+            kind (str): 'donor' or 'recipient'
+            model_version (str): Fingerprint of the TF-IDF model
+            entries (list): (object_id, profile_string) pairs
+
+        Returns:
+            list: (indices, weights) or None per entry
+        """
+        vectors = [None] * len(entries)
+        missing = []
+        with self._lock:
+            for i, (object_id, profile_string) in enumerate(entries):
+                key = (kind, int(object_id), model_version)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] == profile_string:
+                    self._entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    vectors[i] = entry[1]
+                else:
+                    missing.append(i)
+
+        stored = self._load_many(kind, model_version, [entries[i] for i in missing]) if missing and self.persist else {}
+        with self._lock:
+            for i in missing:
+                object_id, profile_string = entries[i]
+                vector = stored.get((int(object_id), profile_string))
+                if vector is None:
+                    self.counters['misses'] += 1
+                else:
+                    self.counters['db_hits'] += 1
+                    self._remember((kind, int(object_id), model_version), profile_string, vector)
+                    vectors[i] = vector
+        return vectors
+
+    def put(self, kind, object_id, model_version, profile_string, vector):
+        """Store a vector in memory and, if enabled, in the database"""
+        self.put_many(kind, model_version, [(object_id, profile_string, vector)])
+
+    def put_many(self, kind, model_version, items):
+        """Store (object_id, profile_string, vector) items, writing the database in bulk"""
+        with self._lock:
+            for object_id, profile_string, vector in items:
+                self._remember((kind, int(object_id), model_version), profile_string, vector)
+        if self.persist and items:
+            self._store_many(kind, model_version, items)
+
+    def invalidate(self, kind, object_id):
+        """Drop every cached version of one object's vector"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == kind and k[1] == int(object_id)]:
+                del self._entries[key]
+        if self.persist:
+            try:
+                from main.models import ProfileVector
+                ProfileVector.objects.filter(kind=kind, object_id=object_id).delete()
+            except Exception as e:
+                print(f"Error invalidating profile vector: {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def nbytes(self):
+        """Approximate memory held by cached entries, estimated from a sample"""
+        with self._lock:
+            count = len(self._entries)
+            sample = list(itertools.islice(self._entries.items(), 200))
+        return sampled_sizeof(sample, count)
+
+    def _remember(self, key, profile_string, vector):
+        # Called with the lock held
+        self._entries[key] = (profile_string, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_many(self, kind, model_version, entries):
+        try:
+            from main.models import ProfileVector
+            rows = ProfileVector.objects.filter(
+                kind=kind, model_version=model_version,
+                object_id__in={int(object_id) for object_id, _ in entries},
+            ).values_list('object_id', 'profile', 'indices', 'weights')
+            return {(object_id, profile): (indices, weights) for object_id, profile, indices, weights in rows}
+        except Exception as e:
+            print(f"Error loading profile vectors: {e}")
+            return {}
+
+    def _store_many(self, kind, model_version, items):
+        try:
+            from main.models import ProfileVector
+            latest = {int(object_id): (profile, vector) for object_id, profile, vector in items}
+            existing = {
+                row.object_id: row for row in ProfileVector.objects.filter(
+                    kind=kind, model_version=model_version, object_id__in=list(latest)
+                ).only('id', 'object_id')
+            }
+            changed, created = [], []
+            now = timezone.now()
+            for object_id, (profile, vector) in latest.items():
+                row = existing.get(object_id) or ProfileVector(
+                    kind=kind, object_id=object_id, model_version=model_version
+                )
+                row.profile, row.indices, row.weights = profile, vector[0], vector[1]
+                # bulk_update skips auto_now
+                row.updated_at = now
+                (changed if row.pk else created).append(row)
+            if changed:
+                ProfileVector.objects.bulk_update(changed, ['profile', 'indices', 'weights', 'updated_at'])
+            if created:
+                # A concurrent writer may have stored the same key; either vector is current
+                ProfileVector.objects.bulk_create(created, ignore_conflicts=True)
+        except Exception as e:
+            print(f"Error storing profile vectors: {e}")
+
+
+def prune_profile_vectors(keep_versions):
+    """
+    Delete persisted vectors of model versions that are no longer served
+
+    Args:
+        keep_versions (set): Model versions to keep
+
+    Returns:
+        int: Number of rows deleted
+    """
+    from main.models import ProfileVector
+    deleted, _ = ProfileVector.objects.exclude(model_version__in=set(keep_versions)).delete()
+    return deleted
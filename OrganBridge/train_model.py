@@ -6,32 +6,71 @@
 """
 Machine Learning Model Training Script
 Extracted from Jupyter notebook for organ matching system
+
+Training runs as a small DAG of stages (load -> tfidf -> nn / ann / quant /
+cosine -> test). Each stage's output is cached under ml_models/.cache keyed by a
+fingerprint of its parameters and its inputs' fingerprints (the dataset's
+fingerprint is a hash of the file), so a run only recomputes the stages
+whose inputs or parameters changed. Several organs or parameter sweeps are
+trained in parallel across a process pool, and per-stage timings are
+reported.
+
+    python train_model.py --organ liver --organ heart --workers 2
+    python train_model.py --set tfidf.max_features=100,200,400
 """
 
 import pandas as pd
 import numpy as np
 import pickle
 import os
+import ast
+import json
+import hashlib
+import itertools
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.neighbors import NearestNeighbors
 from sklearn.metrics.pairwise import cosine_similarity
+from ml_ann import IVFIndex
+from ml_quantized import QuantizedStore
+
+MODEL_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ml_models')
+CACHE_DIR = os.path.join(MODEL_ROOT, '.cache')
+SWEEP_ROOT = os.path.join(MODEL_ROOT, 'sweeps')
+# Bump when a stage's code changes so old cache entries stop matching
+PIPELINE_VERSION = 1
+CACHE_KEEP = 8
+
+DEFAULT_PARAMS = {
+    'tfidf': {'max_features': 200, 'max_df': 0.25, 'min_df': 0.01},
+    'nn': {'n_neighbors': 50, 'algorithm': 'ball_tree'},
+    'ann': {'n_lists': None, 'n_probe': 8},
+    'quant': {'dtype': 'int8'},
+    'cosine': {},
+}
 
-def create_ml_models_directory():
+def create_ml_models_directory(output_dir=MODEL_ROOT):
     """Create directory for ML models if it doesn't exist"""
-    if not os.path.exists('ml_models'):
-        os.makedirs('ml_models')
-        print("Created ml_models directory")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        print(f"Created {output_dir} directory")
 
-def load_and_preprocess_data():
-    """Load and preprocess the kidney data"""
+def dataset_path(organ):
+    """Default dataset of an organ type, e.g. ml_models/KidneyData.csv"""
+    return os.path.join(MODEL_ROOT, f'{organ.capitalize()}Data.csv')
+
+def load_and_preprocess_data(data_path=None):
+    """Load and preprocess the organ data"""
     print("Loading and preprocessing data...")
     
-    # Load the data - make sure KidneyData.csv is in the same directory
+    data_path = data_path or dataset_path('kidney')
     try:
-        data = pd.read_csv('D:\\PYTHON-PRACTICE\\03-DJANGO PROJECTS PRACTICE\\OrganBridge\\OrganBrodge\\backend\\ml_models\\KidneyData.csv')  # Adjust path if needed
+        data = pd.read_csv(data_path)
         print(f"Data loaded successfully. Shape: {data.shape}")
     except FileNotFoundError:
-        print("Error: KidneyData.csv not found. Please ensure it's in the current directory.")
+        print(f"Error: {data_path} not found.")
         return None
     
     # Drop Time column if exists
@@ -59,15 +98,15 @@ def load_and_preprocess_data():
     
     return data
 
-def train_tfidf_model(data):
+def train_tfidf_model(data, max_features=200, max_df=0.25, min_df=0.01):
     """Train TF-IDF model"""
     print("Training TF-IDF model...")
     
     # Create TF-IDF vectorizer
     tf_model = TfidfVectorizer(
-        max_features=200,
-        max_df=0.25,
-        min_df=0.01,
+        max_features=max_features,
+        max_df=max_df,
+        min_df=min_df,
         stop_words='english'
     )
     
@@ -81,16 +120,34 @@ def train_tfidf_model(data):
     
     return tf_model, tf_matrix
 
-def train_nearest_neighbors(tf_matrix):
+def train_nearest_neighbors(tf_matrix, n_neighbors=50, algorithm='ball_tree'):
     """Train Nearest Neighbors model"""
     print("Training Nearest Neighbors model...")
     
-    nn_model = NearestNeighbors(n_neighbors=50, algorithm='ball_tree')
+    nn_model = NearestNeighbors(n_neighbors=n_neighbors, algorithm=algorithm)
     nn_model.fit(tf_matrix)
     
     print("Nearest Neighbors model trained successfully")
     return nn_model
 
+def train_ann_index(tf_matrix, n_lists=None, n_probe=8):
+    """Train the IVF approximate nearest-neighbor index (MATCH_INDEX_BACKEND = 'ivf')"""
+    print("Training IVF approximate nearest-neighbor index...")
+    
+    ann_index = IVFIndex(n_lists=n_lists, n_probe=n_probe).fit(tf_matrix)
+    
+    print(f"IVF index trained with {ann_index.n_lists} lists")
+    return ann_index
+
+def train_quantized_store(tf_matrix, dtype='int8'):
+    """Quantize donor vectors for MATCH_INDEX_BACKEND = 'quantized'"""
+    print(f"Quantizing donor vectors to {dtype}...")
+    
+    store = QuantizedStore(dtype=dtype).fit(tf_matrix)
+    
+    print(f"Quantized store uses {store.nbytes / 1e6:.1f} MB")
+    return store
+
 def calculate_cosine_similarity(tf_matrix):
     """Calculate cosine similarity matrix"""
     print("Calculating cosine similarity matrix...")
@@ -100,28 +157,39 @@ def calculate_cosine_similarity(tf_matrix):
     
     return cosine_sim
 
-def save_models(tf_model, tf_matrix, cosine_sim, nn_model):
+def save_models(tf_model, tf_matrix, cosine_sim, nn_model, ann_index=None, output_dir=MODEL_ROOT,
+                quant_store=None):
     """Save all models to files"""
     print("Saving models...")
     
     # Save TF-IDF model
-    with open('ml_models/tf_model.pkl', 'wb') as f:
+    with open(os.path.join(output_dir, 'tf_model.pkl'), 'wb') as f:
         pickle.dump(tf_model, f)
     print("Saved tf_model.pkl")
     
     # Save TF-IDF matrix
-    with open('ml_models/tf_matrix.pkl', 'wb') as f:
+    with open(os.path.join(output_dir, 'tf_matrix.pkl'), 'wb') as f:
         pickle.dump(tf_matrix, f)
     print("Saved tf_matrix.pkl")
     
     # Save cosine similarity matrix
-    np.save('ml_models/cosine_sim.npy', cosine_sim)
+    np.save(os.path.join(output_dir, 'cosine_sim.npy'), cosine_sim)
     print("Saved cosine_sim.npy")
     
     # Save Nearest Neighbors model
-    with open('ml_models/nn_model.pkl', 'wb') as f:
+    with open(os.path.join(output_dir, 'nn_model.pkl'), 'wb') as f:
         pickle.dump(nn_model, f)
     print("Saved nn_model.pkl")
+    
+    # Save IVF index
+    if ann_index is not None:
+        ann_index.save(os.path.join(output_dir, 'ann_index.npz'))
+        print("Saved ann_index.npz")
+    
+    # Save quantized vectors (memory-mapped by the 'quantized' backend)
+    if quant_store is not None:
+        quant_store.save(output_dir)
+        print("Saved quantized.npy, quantized_indices.npy and quantized_indptr.npy")
 
 def test_model(tf_model, nn_model, data):
     """Test the trained model with a sample query"""
@@ -145,46 +213,305 @@ def test_model(tf_model, nn_model, data):
         print(f"Test failed: {e}")
         return False
 
-def main():
-    """Main function to train and save all models"""
-    print("Starting ML model training...")
-    
-    # Create models directory
-    create_ml_models_directory()
-    
-    # Load and preprocess data
-    data = load_and_preprocess_data()
-    if data is None:
+# Stage DAG: name -> (function, upstream stages). Every function takes the
+# stage's parameters followed by its upstream outputs.
+STAGES = {
+    'load': (lambda params: load_and_preprocess_data(params['data_path']), ()),
+    'tfidf': (lambda params, data: train_tfidf_model(data, **params), ('load',)),
+    'nn': (lambda params, tfidf: train_nearest_neighbors(tfidf[1], **params), ('tfidf',)),
+    'ann': (lambda params, tfidf: train_ann_index(tfidf[1], **params), ('tfidf',)),
+    'quant': (lambda params, tfidf: train_quantized_store(tfidf[1], **params), ('tfidf',)),
+    'cosine': (lambda params, tfidf: calculate_cosine_similarity(tfidf[1]), ('tfidf',)),
+}
+
+MODEL_FILES = ('tf_model.pkl', 'tf_matrix.pkl', 'cosine_sim.npy', 'nn_model.pkl', 'ann_index.npz',
+               'quantized.npy', 'quantized_indices.npy', 'quantized_indptr.npy')
+
+def file_fingerprint(path):
+    """Content hash of a dataset file"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def merge_params(overrides=None):
+    params = {stage: dict(values) for stage, values in DEFAULT_PARAMS.items()}
+    for stage, values in (overrides or {}).items():
+        params.setdefault(stage, {}).update(values)
+    return params
+
+def stage_fingerprints(data_hash, params):
+    """Fingerprint of every stage from its parameters and its inputs' fingerprints"""
+    fingerprints = {}
+    for name, (_, inputs) in STAGES.items():
+        key = {'data': data_hash} if name == 'load' else params.get(name, {})
+        payload = json.dumps([PIPELINE_VERSION, name, key, [fingerprints[i] for i in inputs]],
+                             sort_keys=True, default=str)
+        fingerprints[name] = hashlib.sha1(payload.encode()).hexdigest()[:16]
+    return fingerprints
+
+class Pipeline:
+    """Runs the stage DAG for one dataset, reusing cached stage outputs"""
+
+    def __init__(self, data_path, params=None, cache_dir=CACHE_DIR, use_cache=True):
+        self.data_path = data_path
+        self.params = merge_params(params)
+        self.cache_dir = cache_dir
+        self.use_cache = use_cache
+        self.fingerprints = stage_fingerprints(file_fingerprint(data_path), self.params)
+        self.results = {}
+        self.timings = {}
+
+    def cache_path(self, name):
+        return os.path.join(self.cache_dir, f'{name}-{self.fingerprints[name]}.pkl')
+
+    def get(self, name):
+        """Output of a stage, from memory, the cache, or by running it"""
+        if name in self.results:
+            return self.results[name]
+        func, inputs = STAGES[name]
+        upstream = [self.get(i) for i in inputs]
+        started = time.perf_counter()
+        result, cached = self.load_cached(name), True
+        if result is None:
+            params = dict(self.params.get(name, {}), data_path=self.data_path) if name == 'load' else self.params.get(name, {})
+            result, cached = func(params, *upstream), False
+            if result is None:
+                raise RuntimeError(f"Stage '{name}' produced no output")
+            self.store(name, result)
+        self.timings[name] = {'seconds': round(time.perf_counter() - started, 3), 'cached': cached}
+        self.results[name] = result
+        return result
+
+    def load_cached(self, name):
+        path = self.cache_path(name)
+        if not self.use_cache or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def store(self, name, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(name)
+        # Write then rename so parallel runs never read a partial entry
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def run(self, stages=None):
+        for name in stages or STAGES:
+            self.get(name)
+        return self.results
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def up_to_date(output_dir, fingerprints, data_file):
+    manifest = read_manifest(output_dir)
+    files = MODEL_FILES + (data_file,)
+    return (manifest.get('fingerprints') == fingerprints
+            and all(os.path.exists(os.path.join(output_dir, name)) for name in files))
+
+def run_pipeline(data_path, output_dir, data_file, params=None, use_cache=True, force=False):
+    """
+    Train one model directory, skipping stages whose outputs are cached
+
+    Returns:
+        dict: Summary with the output directory, parameters, timings and test result
+    """
+    pipeline = Pipeline(data_path, params, use_cache=use_cache)
+    summary = {'output_dir': output_dir, 'params': pipeline.params, 'timings': pipeline.timings}
+    if not force and use_cache and up_to_date(output_dir, pipeline.fingerprints, data_file):
+        print(f"{output_dir} is up to date")
+        summary.update(status='up to date', test_ok=True)
+        return summary
+
+    create_ml_models_directory(output_dir)
+    results = pipeline.run()
+    tf_model, tf_matrix = results['tfidf']
+
+    started = time.perf_counter()
+    save_models(tf_model, tf_matrix, results['cosine'], results['nn'], results['ann'], output_dir,
+                quant_store=results['quant'])
+    try:
+        results['load'].to_csv(os.path.join(output_dir, data_file), index=False)
+        print(f"Saved processed data to {os.path.join(output_dir, data_file)}")
+    except Exception as e:
+        print(f"Error saving processed data: {e}")
+    pipeline.timings['save'] = {'seconds': round(time.perf_counter() - started, 3), 'cached': False}
+
+    started = time.perf_counter()
+    test_ok = test_model(tf_model, results['nn'], results['load'])
+    pipeline.timings['test'] = {'seconds': round(time.perf_counter() - started, 3), 'cached': False}
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump({'fingerprints': pipeline.fingerprints, 'params': pipeline.params,
+                   'timings': pipeline.timings, 'test_ok': test_ok}, f, indent=2, default=str)
+    summary.update(status='trained', test_ok=test_ok)
+    return summary
+
+def _run_task(task):
+    try:
+        return run_pipeline(**task)
+    except Exception as e:
+        print(f"Error training {task['output_dir']}: {e}")
+        return {'output_dir': task['output_dir'], 'params': task.get('params'), 'timings': {},
+                'status': f'failed: {e}', 'test_ok': False}
+
+def prime_shared_stages(tasks, use_cache=True):
+    """Run stages that several tasks share once, up front, so parallel tasks hit the cache"""
+    pipelines = [Pipeline(t['data_path'], t.get('params'), use_cache=use_cache) for t in tasks]
+    counts = {}
+    for pipeline in pipelines:
+        for name, fp in pipeline.fingerprints.items():
+            counts[(name, fp)] = counts.get((name, fp), 0) + 1
+    for pipeline in pipelines:
+        shared = [name for name, fp in pipeline.fingerprints.items() if counts[(name, fp)] > 1]
+        if not shared:
+            continue
+        pipeline.run(shared)
+        for name in shared:
+            counts[(name, pipeline.fingerprints[name])] = 0  # cached now
+
+def prune_cache(cache_dir=CACHE_DIR, keep=CACHE_KEEP):
+    """Keep the most recently written entries of each stage"""
+    if not os.path.isdir(cache_dir):
         return
+    by_stage = {}
+    for name in os.listdir(cache_dir):
+        if name.endswith('.pkl'):
+            by_stage.setdefault(name.split('-', 1)[0], []).append(os.path.join(cache_dir, name))
+    for paths in by_stage.values():
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[keep:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def print_summary(summaries):
+    print("\nStage timings (seconds):")
+    for summary in summaries:
+        print(f"  {summary['output_dir']} [{summary['status']}]")
+        for name, timing in summary['timings'].items():
+            note = ' (cached)' if timing['cached'] else ''
+            print(f"    {name:<8}{timing['seconds']:>9.3f}{note}")
+
+def train(tasks, workers=1, use_cache=True):
+    """Train several model directories, in parallel when workers > 1"""
+    if use_cache and len(tasks) > 1:
+        prime_shared_stages(tasks, use_cache)
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            summaries = list(pool.map(_run_task, tasks))
+    else:
+        summaries = [_run_task(task) for task in tasks]
+    if use_cache:
+        prune_cache(keep=max(CACHE_KEEP, len(tasks)))
+    print_summary(summaries)
+    return summaries
+
+def parse_sweep(assignments):
+    """['tfidf.max_features=100,200'] -> [{'tfidf': {'max_features': 100}}, {...: 200}]"""
+    if not assignments:
+        return []
+    axes = []
+    for assignment in assignments:
+        key, _, values = assignment.partition('=')
+        stage, _, param = key.partition('.')
+        if stage not in STAGES or not param:
+            raise ValueError(f"Expected <stage>.<param>=<values>, got {assignment!r}")
+        axes.append([(stage, param, parse_value(v)) for v in values.split(',')])
+    combinations = []
+    for combo in itertools.product(*axes):
+        params = {}
+        for stage, param, value in combo:
+            params.setdefault(stage, {})[param] = value
+        combinations.append(params)
+    return combinations
+
+def parse_value(text):
+    try:
+        return ast.literal_eval(text.strip())
+    except (ValueError, SyntaxError):
+        return text.strip()
+
+def build_tasks(organs=None, data_path=None, sweep=None, force=False, use_cache=True):
+    tasks = []
+    combinations = parse_sweep(sweep)
+    for organ in organs or [None]:
+        # --data applies when a single dataset is being trained
+        if data_path and len(organs or [None]) == 1:
+            path = data_path
+        else:
+            path = dataset_path(organ or 'kidney')
+        output_dir = os.path.join(MODEL_ROOT, organ.lower()) if organ else MODEL_ROOT
+        data_file = 'data.csv' if organ else 'processed_data.csv'
+        for params in combinations or [None]:
+            task_dir = output_dir
+            if combinations:
+                # Sweep results never overwrite the models being served
+                tag = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+                task_dir = os.path.join(SWEEP_ROOT, organ.lower() if organ else 'default', tag)
+            tasks.append({'data_path': path, 'output_dir': task_dir, 'data_file': data_file,
+                          'params': params, 'use_cache': use_cache, 'force': force})
+    return tasks
+
+def main(organ=None, data_path=None, params=None, use_cache=True, force=False):
+    """
+    Main function to train and save all models
+    
+    Without an organ the original kidney model is written to ml_models/.
+    With an organ, its dataset (default ml_models/<Organ>Data.csv) is trained
+    into ml_models/<organ>/, where the per-organ model registry looks for it.
+    Stages whose inputs and parameters are unchanged are loaded from the cache.
+    """
+    print("Starting ML model training...")
     
-    # Train TF-IDF model
-    tf_model, tf_matrix = train_tfidf_model(data)
-    
-    # Train Nearest Neighbors
-    nn_model = train_nearest_neighbors(tf_matrix)
-    
-    # Calculate cosine similarity
-    cosine_sim = calculate_cosine_similarity(tf_matrix)
-    
-    # Save all models
-    save_models(tf_model, tf_matrix, cosine_sim, nn_model)
-    
-    # Test the model
-    test_successful = test_model(tf_model, nn_model, data)
+    data_path = data_path or dataset_path(organ or 'kidney')
+    if not os.path.exists(data_path):
+        print(f"Error: {data_path} not found.")
+        return None
+    task = build_tasks([organ] if organ else None, data_path, force=force, use_cache=use_cache)[0]
+    task['params'] = params
+    summary = train([task], use_cache=use_cache)[0]
     
-    if test_successful:
+    if summary['test_ok']:
         print("\n✅ Model training completed successfully!")
-        print("Models saved in 'ml_models' directory")
-        print("You can now copy these files to your Django backend")
+        print(f"Models saved in '{summary['output_dir']}' directory")
     else:
         print("\n❌ Model training completed but testing failed")
-    
-    # Copy data file to ml_models directory
-    try:
-        data.to_csv('ml_models/processed_data.csv', index=False)
-        print("Saved processed data to ml_models/processed_data.csv")
-    except Exception as e:
-        print(f"Error saving processed data: {e}")
+    return summary
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train organ matching models")
+    parser.add_argument('--organ', action='append',
+                        help="Organ type to train into ml_models/<organ>/ (repeatable)")
+    parser.add_argument('--data', help="Dataset CSV (default ml_models/<Organ>Data.csv)")
+    parser.add_argument('--set', action='append', dest='sweep', metavar='STAGE.PARAM=V1[,V2...]',
+                        help="Override a stage parameter; several values sweep it into ml_models/sweeps/")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Processes for training several organs or sweep points")
+    parser.add_argument('--no-cache', action='store_true', help="Recompute every stage")
+    parser.add_argument('--force', action='store_true', help="Retrain even if the output is up to date")
+    args = parser.parse_args()
+
+    sweep = parse_sweep(args.sweep)
+    if len(sweep) == 1:
+        # A single value per parameter is an override of the served model, not a sweep
+        tasks = build_tasks(args.organ, args.data, force=args.force, use_cache=not args.no_cache)
+        for task in tasks:
+            task['params'] = sweep[0]
+    else:
+        tasks = build_tasks(args.organ, args.data, args.sweep, force=args.force, use_cache=not args.no_cache)
+    train(tasks, workers=args.workers, use_cache=not args.no_cache)
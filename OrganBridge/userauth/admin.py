@@ -1,7 +1,8 @@
 from django.contrib import admin
+from main.admin import DonorAdmin, WaitlistRecipientAdmin
 from . import models
 
 # Register your models here.
 # admin.site.register(models.User)
-admin.site.register(models.Donor)
-admin.site.register(models.Recipient)
\ No newline at end of file
+admin.site.register(models.Donor, DonorAdmin)
+admin.site.register(models.Recipient, WaitlistRecipientAdmin)
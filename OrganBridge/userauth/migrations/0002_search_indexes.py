@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='donor',
+            name='city',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='city',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='blood_group',
+            field=models.CharField(db_index=True, max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='organ',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('userauth', '0003_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='donor',
+            name='health_card_number',
+            field=models.CharField(db_index=True, max_length=12),
+        ),
+        migrations.AlterField(
+            model_name='recipient',
+            name='health_card_number',
+            field=models.CharField(db_index=True, max_length=12),
+        ),
+    ]
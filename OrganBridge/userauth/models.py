@@ -8,10 +8,11 @@ class Donor(models.Model):
     phone_number = models.CharField(max_length=15)
     birthday = models.DateField()
     address = models.CharField(max_length=100, null=True, blank=True)
-    city = models.CharField(max_length=50)
+    city = models.CharField(max_length=50, db_index=True)
     state = models.CharField(max_length=50)
     zipcode = models.CharField(max_length=10)
-    health_card_number = models.CharField(max_length=12)
+    health_card_number = models.CharField(max_length=12, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.user.username
@@ -20,13 +21,14 @@ class Recipient(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='recipient')
     phone_number = models.CharField(max_length=15)
     address = models.CharField(max_length=100)
-    city = models.CharField(max_length=50)
+    city = models.CharField(max_length=50, db_index=True)
     zipcode = models.CharField(max_length=10)
     state = models.CharField(max_length=50)
-    health_card_number = models.CharField(max_length=12)
+    health_card_number = models.CharField(max_length=12, db_index=True)
     birthday = models.DateField()
-    blood_group = models.CharField(max_length=3)
-    organ = models.CharField(max_length=50)
+    blood_group = models.CharField(max_length=3, db_index=True)
+    organ = models.CharField(max_length=50, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     
 